@@ -1,23 +1,34 @@
 """Module for initializing the Flask application and its components."""
 
 import logging
+from typing import Optional
 from flask import Flask
 from flask_socketio import SocketIO
 
-from .routes import setup_routes
+from .routes import setup_routes, setup_metrics_route, setup_health_routes
+from .config import MAX_MESSAGE_BYTES
 
 socketio = SocketIO(manage_session = True, cors_allowed_origins="*")
 
-def create_app(headless: bool = False) -> Flask:
+def create_app(headless: bool = False, async_mode: str = "threading", message_queue: Optional[str] = None,
+               metrics: bool = True) -> Flask:
     """
     Create and configure an instance of the Flask application.
 
+    Args:
+        headless (bool): Whether to skip the HTTP routes serving the web page.
+        async_mode (str): The Socket.IO async mode, "threading", "eventlet" or "gevent". The standard library
+                          must already be monkey patched for the green modes.
+        message_queue (Optional[str]): The URL of the message queue shared by the front-end workers, so an event
+                                       emitted by one worker reaches the clients connected to the others.
+        metrics (bool): Whether to serve the metrics of the pipeline on /metrics.
+
     Returns:
         Flask: The created Flask application.
     """
 
     app = Flask(__name__)
-    socketio.init_app(app, max_http_buffer_size=4194304)
+    socketio.init_app(app, max_http_buffer_size=MAX_MESSAGE_BYTES, async_mode=async_mode, message_queue=message_queue)
 
     logging.debug("Socket IO initialized")
 
@@ -25,7 +36,14 @@ def create_app(headless: bool = False) -> Flask:
         setup_routes(app)
         logging.debug("Serving Web page")
 
-    # Importing socket routes here to avoid circular dependencies
+    if metrics:
+        setup_metrics_route(app)
+        logging.debug("Serving metrics")
+
+    setup_health_routes(app)
+
+    # Importing socket routes here to avoid circular dependencies. The models are only declared, they are
+    # loaded by `models.start`.
     from . import socket_routes
     logging.debug("Loading socket routes")
 
@@ -2,58 +2,130 @@
 audio_processing.py
 
 This module handles the processing and transcription of audio data. It includes the AudioTranscriptionManager class, 
-which manages audio blobs, merges them, and transcribes the merged audio using the Whisper model.
+which decodes the received audio stream in memory, keeps a rolling buffer of the audio that is not transcribed for good yet,
+and incrementally transcribes it using the Whisper model. Silence is detected before inference and never sent to the model.
+Long recordings, uploaded at once or in chunks, are split on silence and their segments are transcribed in parallel
+by a RecordingTranscriber, as their audio is received.
 """
 
 import os
-import subprocess
 import tempfile
 import threading
+import itertools
 import logging
-import whisper
-
-from collections import deque
-from datetime import datetime
-from typing import Optional, Deque
-
-from .utils import purge_file, check_ffmpeg_installed, MissingPackageError
+import numpy as np
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from .utils import decode_audio_bytes, decode_audio_file, is_stream_start, StreamDecoder, check_ffmpeg_installed, MissingPackageError, SAMPLE_RATE
+from .utils import ModelUnavailableError
+from .utils.transcription_utils import HypothesisBuffer, extract_words
+from .utils.vad import EnergyVAD
+from .utils.metrics import Counter, Gauge, Histogram
+from .inference import get_inference_clients, client_for, load_transcription_engine, warm_up_transcription_engine
+from .inference import wait_for_inference_workers
+from .model_manager import models, WHISPER
+from .job_queue import CoalescingJobQueue
+from .config import get_config
+from .lifecycle import on_shutdown, on_startup
 from . import socketio
 
+if TYPE_CHECKING:
+    from .transcription_engine import TranscriptionEngine
+    from .upload_store import Upload, UploadStore
+
 import logging
 
-# Load Whisper model globally.
-audio_model = whisper.load_model("base")
+whisper_config = get_config().whisper
+
+# Longest uncommitted audio kept in the buffer, the tentative text is committed as is past this length
+MAX_BUFFER_SECONDS = 25
+
+# Silence after speech marking the end of an utterance, its transcription is then finalized
+END_OF_UTTERANCE_SECONDS = whisper_config.end_of_utterance_seconds
+
+# Uploaded recordings longer than a segment are split on silence, each cut is placed in the last third of a segment
+FILE_SEGMENT_SECONDS = whisper_config.file_segment_seconds
+FILE_SEGMENT_MIN_SECONDS = FILE_SEGMENT_SECONDS * 2 / 3
+
+# Segments of a recording queued per transcription worker, past which the reception of its audio is paused
+FILE_PENDING_SEGMENTS = 2
+
+# Length of the windows an uploaded file is decoded in when its format cannot be decoded from a pipe, in seconds
+FILE_DECODE_WINDOW_SECONDS = 300.0
+
+AUDIO_DECODE_SECONDS = Histogram("chronos_audio_decode_seconds", "Time to decode a complete recording with ffmpeg")
+AUDIO_WRITE_SECONDS = Histogram("chronos_audio_write_seconds", "Time to feed a streamed audio blob to the ffmpeg decoder")
+TRANSCRIPTION_SECONDS = Histogram("chronos_transcription_seconds", "Time of a Whisper transcription pass, batching wait included")
+TRANSCRIBED_AUDIO_SECONDS = Counter("chronos_transcribed_audio_seconds_total", "Audio sent to the Whisper model")
+SKIPPED_AUDIO_SECONDS = Counter("chronos_skipped_audio_seconds_total", "Silent audio dropped without inference")
+FILE_TRANSCRIPTION_SECONDS = Histogram("chronos_file_transcription_seconds", "Time to transcribe an uploaded recording, decoding included")
 
 
 class AudioTranscriptionManager:
-    """Manages the transcription of audio data for a session.
+    """Manages the streaming transcription of audio data for a session.
+
+    This class feeds the received audio stream to a long-lived ffmpeg decoder, whose PCM output is appended
+    to a rolling buffer by a background reader. Each transcription pass only decodes this buffer, which holds
+    the audio that follows the committed transcript: text that two consecutive passes agree on is frozen and
+    its audio is trimmed from the buffer, so the cost of a pass does not grow with the length of the utterance.
 
-    This class handles audio blobs, stores them in a queue, and uses the Whisper model for transcription. 
-    It also manages a temporary folder for storing audio files and keeps track of the session ID.
+    A voice activity detector gates the passes: a silent buffer is dropped without inference, leading and
+    trailing silence are trimmed from the audio sent to the model, and a long enough silence after speech
+    ends the utterance, whose transcription is then committed as final.
+    It also manages a temporary folder for the session and keeps track of the session ID.
 
     Attributes:
-        transcription (str): The current transcription text.
-        audio_blobs (deque): A queue of audio blob file paths.
-        model (whisper.Whisper): The Whisper model used for transcription.
-        _temp_folder (tempfile.TemporaryDirectory): The temporary folder for audio files.
+        transcription (str): The current transcription text, committed and tentative.
+        audio_buffer (np.ndarray): The uncommitted audio, as float32 16 kHz mono samples.
+        buffer_offset (float): The stream time of the first sample of `audio_buffer`, in seconds.
+        hypothesis (HypothesisBuffer): The committed and tentative words of the transcription.
+        decoder (Optional[StreamDecoder]): The ffmpeg decoder of the current recording, if any.
+        vad (EnergyVAD): The voice activity detector gating the transcription passes.
+        utterance_ended (bool): Whether the last pass finalized the utterance.
+        skipped_seconds (float): The silent audio dropped without being transcribed, in seconds.
+        trimmed_seconds (float): The silence dropped around the speech before inference, in seconds: the leading
+            silence of the buffer, and the edges of complete recordings.
+        engine (TranscriptionEngine): The engine running the Whisper model, shared by all sessions, or the
+            client of the inference worker running it.
+        _temp_folder (tempfile.TemporaryDirectory): The temporary folder for the session.
         temp_folder_name (str): The name/path of the temporary folder.
         _session_id (str): The ID of the session associated with this manager.
     """
 
-    def __init__(self, temp_folder: Optional[tempfile.TemporaryDirectory] = None, session_id : Optional[str] = None):
+    def __init__(self, temp_folder: Optional[tempfile.TemporaryDirectory] = None, session_id : Optional[str] = None,
+                 engine: Optional["TranscriptionEngine"] = None):
         """Initializes the AudioTranscriptionManager with an optional temporary folder and session ID.
 
-        If no temporary folder is provided, a new one is created. The temporary folder is used for storing audio files.
+        If no temporary folder is provided, a new one is created.
         The session ID, if provided, is used to identify the session associated with this manager.
 
         Args:
-            temp_folder (Optional[tempfile.TemporaryDirectory]): The temporary folder for storing audio files.
+            temp_folder (Optional[tempfile.TemporaryDirectory]): The temporary folder for the session.
             session_id (Optional[str]): The ID of the session.
+            engine (Optional[TranscriptionEngine]): The transcription engine, defaults to the shared one, or to the
+                inference worker of the session when the model runs in inference workers.
         """
 
+        self._lock = threading.Lock()
+        self._transcription_lock = threading.Lock()
+
         self.transcription = ""
-        self.audio_blobs: Deque[str] = deque()
-        self.model : whisper.Whisper = audio_model
+        self.audio_buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_offset = 0.0
+        self.hypothesis = HypothesisBuffer()
+        self.decoder: Optional[StreamDecoder] = None
+        self._engine = engine
+
+        self._finish_requested = False
+        # Incremented by `renew`, a recording being transcribed when it changes is abandoned
+        self._renewals = 0
+
+        self.vad = EnergyVAD()
+        self.utterance_ended = False
+        self.skipped_seconds = 0.0
+        self.trimmed_seconds = 0.0
 
         self._temp_folder = temp_folder or tempfile.TemporaryDirectory()
         self.temp_folder_name = self._temp_folder.name
@@ -63,6 +135,16 @@ class AudioTranscriptionManager:
         self.ffmpeg_installed = check_ffmpeg_installed()
 
 
+    @property
+    def engine(self) -> "TranscriptionEngine":
+        """The engine of the session, the shared engine is loaded on first use in lazy mode.
+
+        Raises:
+            ModelUnavailableError: If the speech model is disabled or failed to load.
+        """
+        return self._engine or client_for(self._session_id) or models.get(WHISPER)
+
+
     @property
     def transcription(self) -> str:
         """
@@ -84,133 +166,793 @@ class AudioTranscriptionManager:
         self._transcription = transcription
 
 
-    def append_audio(self, blob_file: str) -> threading.Thread:
-        """Appends an audio blob file to the queue and initiates merging and transcription if necessary.
+    @property
+    def buffered_bytes(self) -> int:
+        """The size of the uncommitted audio, in bytes."""
+        return self.audio_buffer.nbytes
+
+
+    @property
+    def stable_transcription(self) -> str:
+        """The committed part of the transcription, which will not change anymore."""
+        return self.hypothesis.stable_text
+
 
-        This method adds a new audio blob to the queue. If the queue exceeds 10 blobs, the oldest blob is removed 
-        and its file is purged. It then calls the `merge_audio_blobs` method to merge and transcribe the audio.
+    @property
+    def tentative_transcription(self) -> str:
+        """The part of the transcription that may still be revised by the next pass."""
+        return self.hypothesis.tentative_text
+
+
+    def append_audio(self, data: bytes):
+        """Feeds an audio blob to the session decoder.
+
+        A blob starting with a container header begins a new recording: the previous decoder, if any, is flushed
+        and a new one is started. Other blobs continue the current recording. This method does not wait for the
+        decoding of the blob, the samples reach the buffer through the decoder reader.
 
         Args:
-            blob_file (str): The file path of the audio blob to be appended.
+            data (bytes): The encoded audio blob, as received from the client.
+        """
+        if is_stream_start(data):
+            with self._lock:
+                previous, self.decoder = self.decoder, None
+            if previous is not None:
+                # Both decoders append to the same buffer, the tail of the previous recording must reach it first
+                previous.close()
 
-        Returns:
-            threading.Thread: The thread initiated for merging and transcribing the audio blobs.
+            decoder = StreamDecoder(self._append_samples)
+            logging.debug(f"Started audio decoder for session {self._session_id}")
+
+            with self._lock:
+                self.decoder = decoder
+                self._finish_requested = False
+
+        decoder = self.decoder
+        with AUDIO_WRITE_SECONDS.time():
+            written = decoder is not None and decoder.write(data)
+        if not written:
+            logging.warning(f"No running audio decoder for session {self._session_id}, dropping audio blob")
+
+
+    def finish_audio(self):
+        """Marks the end of the current recording.
+
+        The next transcription pass flushes the decoder, so the buffer holds the whole recording,
+        then commits the tentative text.
         """
-        self.audio_blobs.append(blob_file)
+        with self._lock:
+            self._finish_requested = True
 
-        if len(self.audio_blobs) > 10:
-            oldest_blob = self.audio_blobs.popleft()
-            try:
-                purge_file(oldest_blob)
-            except Exception as e:
-                logging.error(f"Error purging audio blob: {e}")
 
-        thread = self.merge_audio_blobs()
+    def end_stream(self):
+        """Closes the current decoder, once all the audio it received is decoded into the buffer."""
+        with self._lock:
+            decoder, self.decoder = self.decoder, None
+        if decoder is not None:
+            decoder.close()
+            logging.debug(f"Closed audio decoder for session {self._session_id}")
 
-        return thread
 
-    def merge_audio_blobs(self) -> threading.Thread:
-        """Merges multiple audio blobs into a single audio file using FFmpeg and starts the transcription process.
+    def _append_samples(self, samples: np.ndarray):
+        """Decoder callback, appends decoded samples to the audio buffer."""
+        with self._lock:
+            self.audio_buffer = np.concatenate((self.audio_buffer, samples))
 
-        This method concatenates audio files listed in `self.audio_blobs` using FFmpeg, then starts a new thread to 
-        transcribe the merged audio file. The merged file is named with a current timestamp.
 
-        Returns:
-            threading.Thread: The thread object for the transcription process.
+    def process_buffer(self, final: bool = False):
+        """Runs a transcription pass over the uncommitted audio and commits the agreed prefix.
+
+        The buffer first goes through voice activity detection: if it holds no speech, it is dropped and no
+        inference runs. Otherwise its leading silence is dropped and its trailing silence is left out of the pass.
+
+        The words two consecutive passes agree on are committed and the audio up to the last committed
+        word is trimmed from the buffer. If the buffer still exceeds `MAX_BUFFER_SECONDS`, if the speech is
+        followed by `END_OF_UTTERANCE_SECONDS` of silence, or if this is the final pass of a recording, the
+        tentative words are committed as is.
+
+        Args:
+            final (bool): Whether this is the last pass of the recording. A pass following a call to
+                          `finish_audio` is always final.
+
+        Raises:
+            Exception: Propagates any exceptions that occur during transcription.
         """
+        with self._transcription_lock:
+            with self._lock:
+                final, self._finish_requested = final or self._finish_requested, False
 
-        filename_date = datetime.now().strftime("%Y%m%d_%H%M%S")
-        list_file = os.path.join(self.temp_folder_name, "filelist.txt")
+            if final:
+                self.end_stream()
 
-        with open(list_file, 'w') as f:
-            for file_path in self.audio_blobs:
-                f.write(f"file '{file_path}'\n")
-        current_audio_file = os.path.join(self.temp_folder_name, f"combined-{filename_date}.webm")
+            with self._lock:
+                audio, end_of_utterance = self._speech_audio()
+                offset = self.buffer_offset
 
-        ffmpeg_cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", current_audio_file]
+            final = final or end_of_utterance
+            self.utterance_ended = False
 
-        try:
-            subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"An error occurred during FFmpeg processing: {e}")
-            raise
-        except FileNotFoundError as fnfe:
-            logging.error(f"SubProcess Raised a FileNotFound Error, check that ffmpeg is installed on your system: {fnfe}")
-            raise
+            if len(audio) == 0 and not final:
+                return
+
+            words = None
+            if len(audio) > 0:
+                try:
+                    TRANSCRIBED_AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
+                    with TRANSCRIPTION_SECONDS.time():
+                        result = self.engine.transcribe(audio, word_timestamps=True)
+                    words = extract_words(result, offset)
+                except Exception as e:
+                    logging.error(f"Error during transcription: {e}")
+                    raise
 
-        logging.debug("Merging Done, starting transcription thread")
-        thread = threading.Thread(target=self.transcribe_audio, args=(current_audio_file,))
-        thread.start()
-        logging.debug(f"Transcription thread {thread.ident} started for file {current_audio_file}")
+            with self._lock:
+                committed = self.hypothesis.insert(words) if words is not None else []
 
-        purge_file(list_file)
+                if final or len(self.audio_buffer) / SAMPLE_RATE > MAX_BUFFER_SECONDS:
+                    logging.debug(f"Committing tentative text of session {self._session_id}, final pass: {final}")
+                    committed = self.hypothesis.flush()
+                    if not committed:
+                        self._trim_buffer(offset + len(audio) / SAMPLE_RATE)
 
-        return thread
+                if committed:
+                    self._trim_buffer(self.hypothesis.last_committed_time)
 
+                self.utterance_ended = final
+                self.transcription = " ".join(part for part in (self.stable_transcription, self.tentative_transcription) if part)
 
-    def transcribe_audio(self, current_audio_file : str):
-        """Transcribes the given audio file using the Whisper model.
+            logging.debug(f"Transcription pass completed, {len(committed)} words committed.")
+
+
+    def _speech_audio(self):
+        """Applies voice activity detection to the buffer. Must be called with `_lock` held.
+
+        Silence before the speech is dropped from the buffer, a silent buffer is dropped entirely except
+        for its last samples, which may hold the beginning of a word.
+
+        Returns:
+            np.ndarray: The audio to transcribe, without trailing silence. Empty if the buffer is silent.
+            bool: Whether the speech is followed by enough silence to end the utterance.
+        """
+        bounds = self.vad.speech_bounds(self.audio_buffer)
+
+        if bounds is None:
+            skipped = max(0, len(self.audio_buffer) - self.vad.padding)
+            self.skipped_seconds += skipped / SAMPLE_RATE
+            SKIPPED_AUDIO_SECONDS.inc(skipped / SAMPLE_RATE)
+            self._trim_buffer(self.buffer_offset + skipped / SAMPLE_RATE)
+            return np.zeros(0, dtype=np.float32), False
+
+        start, end = bounds
+        if start > 0:
+            self.trimmed_seconds += start / SAMPLE_RATE
+            self._trim_buffer(self.buffer_offset + start / SAMPLE_RATE)
+            end -= start
+
+        # The trailing silence stays in the buffer, it is only counted once a later pass drops it as leading silence
+        end_of_utterance = self.vad.trailing_silence(self.audio_buffer) >= END_OF_UTTERANCE_SECONDS
+
+        return self.audio_buffer[:end], end_of_utterance
+
+
+    def transcribe_audio(self, data: bytes, on_progress: Optional[Callable[[int, Optional[int]], None]] = None) -> bool:
+        """Transcribes a complete recording, outside of the streaming buffer.
+
+        The recording is decoded once to 16 kHz mono samples. A recording of at most one segment is transcribed in
+        a single pass, a longer one is split on silence and its segments are transcribed in parallel, see
+        `_transcribe_segments`. Silence at the edges of each part is trimmed, a silent part is not transcribed.
 
         Args:
-            current_audio_file (str): The path to the audio file to be transcribed.
+            data (bytes): The encoded audio data to be transcribed.
+            on_progress (Optional[Callable[[int, Optional[int]], None]]): Called with the number of transcribed segments
+                and the number of segments, None until it is known, each time a segment of a long recording is
+                transcribed, but the last one.
+
+        Returns:
+            bool: True once transcribed, False if the manager was renewed meanwhile.
 
         Raises:
             Exception: Propagates any exceptions that occur during transcription.
         """
         try:
-            result = self.model.transcribe(current_audio_file, word_timestamps=True)
-            self.transcription = str(result['text'])
-            logging.debug("Transcription completed successfully.")
-            purge_file(current_audio_file)
+            with FILE_TRANSCRIPTION_SECONDS.time():
+                with AUDIO_DECODE_SECONDS.time():
+                    audio = decode_audio_bytes(data)
+
+                if len(audio) > FILE_SEGMENT_SECONDS * SAMPLE_RATE:
+                    return self._transcribe_segments(audio, on_progress)
+
+                bounds = self.vad.speech_bounds(audio)
+                if bounds is None:
+                    self.skipped_seconds += len(audio) / SAMPLE_RATE
+                    SKIPPED_AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
+                    self.transcription = ""
+                    return True
+
+                start, end = bounds
+                self.trimmed_seconds += (len(audio) - (end - start)) / SAMPLE_RATE
+
+                TRANSCRIBED_AUDIO_SECONDS.inc((end - start) / SAMPLE_RATE)
+                with TRANSCRIPTION_SECONDS.time():
+                    result = self.engine.transcribe(audio[start:end])
+                self.transcription = str(result['text']).strip()
+                logging.debug("Transcription completed successfully.")
+                return True
         except Exception as e:
             logging.error(f"Error during transcription: {e}")
             raise
 
 
-    def renew(self):
-        """Resets the transcription manager, clearing any stored transcriptions
-        and audio blobs, and cleans up related temporary files.
+    def _transcribe_segments(self, audio: np.ndarray, on_progress: Optional[Callable[[int, Optional[int]], None]]) -> bool:
+        """Transcribes a long recording, split on silence into segments transcribed in parallel by a `RecordingTranscriber`.
+
+        Each time a segment completes, the transcription holds the text of the segments completed so far, in order,
+        up to the first one still in flight.
+
+        Returns:
+            bool: True once transcribed, False if the manager was renewed meanwhile.
         """
+        with self._lock:
+            renewals = self._renewals
+
+        def report(done: int, total: Optional[int]):
+            if self._renewals != renewals:
+                # The segments not started yet are dropped
+                transcriber.cancel()
+                return
+            self.transcription = transcriber.text
+            if on_progress is not None:
+                on_progress(done, total)
+
+        transcriber = RecordingTranscriber(self._segment_engines, on_progress=report, name=f"session {self._session_id}")
+        logging.debug(f"Transcribing a {len(audio) / SAMPLE_RATE:.0f}s recording of session {self._session_id}, "
+                      f"{transcriber.workers} segments at a time")
 
         self.transcription = ""
+        transcriber.add_samples(audio)
+        text = transcriber.finish()
+        self.skipped_seconds += transcriber.skipped_seconds
+        self.trimmed_seconds += transcriber.trimmed_seconds
+
+        if transcriber.cancelled or self._renewals != renewals:
+            logging.debug(f"Transcription of the recording of session {self._session_id} abandoned")
+            return False
+        self.transcription = text
+        return True
+
+
+    def _segment_engines(self) -> List["TranscriptionEngine"]:
+        """The engines the segments of a long recording are spread over, every inference worker when they run the model."""
+        if self._engine is not None:
+            return [self._engine]
+        return segment_engines()
+
+
+    def _trim_buffer(self, until: float):
+        """Drops the buffered audio before the given stream time. Must be called with `_lock` held.
+
+        Args:
+            until (float): The stream time, in seconds, of the first sample to keep.
+        """
+        cut = int(max(0.0, until - self.buffer_offset) * SAMPLE_RATE)
+        cut = min(cut, len(self.audio_buffer))
+
+        self.audio_buffer = self.audio_buffer[cut:]
+        self.buffer_offset += cut / SAMPLE_RATE
+
+
+    def renew(self):
+        """Resets the transcription manager, stopping the audio decoder and clearing any stored
+        transcriptions and buffered audio.
+        """
+
+        with self._lock:
+            decoder, self.decoder = self.decoder, None
+        if decoder is not None:
+            decoder.kill()
+
+        with self._lock:
+            self._renewals += 1
+            self._finish_requested = False
+            self.transcription = ""
+            self.audio_buffer = np.zeros(0, dtype=np.float32)
+            self.buffer_offset = 0.0
+            self.hypothesis = HypothesisBuffer()
+            self.utterance_ended = False
+
+
+def segment_engines() -> List["TranscriptionEngine"]:
+    """The engines the segments of a long recording are spread over, every inference worker when they run the model.
+
+    Raises:
+        ModelUnavailableError: If the speech model is disabled or failed to load.
+    """
+    return list(get_inference_clients()) or [models.get(WHISPER)]
+
+
+def segment_workers() -> int:
+    """The number of segments of a recording transcribed concurrently."""
+    return whisper_config.file_segment_workers or whisper_config.max_batch_size * max(1, len(get_inference_clients()))
+
+
+class RecordingTranscriber:
+    """Transcribes a long recording as its audio arrives, split on silence into segments transcribed in parallel.
+
+    The decoded audio is appended with `add_samples`. Each time more than a segment is buffered, a segment is cut
+    in the longest silence of its last third and queued, so the transcription starts before the end of the recording
+    is received. The segments are spread over the engines, which decode them in batches, and at most `workers` of
+    them are in flight, so the live transcriptions of the other sessions never wait behind a whole recording.
+    Silence is trimmed from each segment, and a silent segment is not transcribed.
+
+    Attributes:
+        workers (int): The maximum number of segments in flight.
+        completed (int): The number of transcribed segments.
+        finished (bool): Whether the whole recording was received, the number of segments is then known.
+        cancelled (bool): Whether the transcription was abandoned.
+        received_samples (int): The number of samples received.
+        skipped_seconds (float): The silent segments dropped without being transcribed, in seconds.
+        trimmed_seconds (float): The silence trimmed from the edges of the segments, in seconds.
+    """
+
+    def __init__(self, engines: Callable[[], List["TranscriptionEngine"]], workers: Optional[int] = None,
+                 on_progress: Optional[Callable[[int, Optional[int]], None]] = None, name: str = ""):
+        """Initializes the transcriber, its worker threads only start with the first segment.
 
-        while self.audio_blobs:
-            blob = self.audio_blobs.popleft()
-            purge_file(blob)
+        Args:
+            engines (Callable[[], List[TranscriptionEngine]]): Returns the engines to spread the segments over,
+                called by the workers, so a model loading on first use does not delay the reception of the audio.
+            workers (Optional[int]): The maximum number of segments in flight, `segment_workers()` if None.
+            on_progress (Optional[Callable[[int, Optional[int]], None]]): Called from a worker thread with the number
+                of transcribed segments and the number of segments, None until the recording is finished, each time
+                a segment is transcribed, but the last one.
+            name (str): Identifies the recording in logs.
+        """
+        self._engines = engines
+        self.workers = workers or segment_workers()
+        self._on_progress = on_progress
+        self._name = name
+
+        self.vad = EnergyVAD()
+        self._condition = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="file-segments")
+        self._segment_samples = int(FILE_SEGMENT_SECONDS * SAMPLE_RATE)
+
+        # Decoded blocks not cut into a segment yet
+        self._blocks: List[np.ndarray] = []
+        self._buffered_samples = 0
+        # Samples of the segments queued or in flight
+        self._pending_samples = 0
+
+        self._futures: List[Future] = []
+        self._texts: List[Optional[str]] = []
+        self._error: Optional[BaseException] = None
+
+        self.completed = 0
+        self.finished = False
+        self.cancelled = False
+        self.received_samples = 0
+        self.skipped_seconds = 0.0
+        self.trimmed_seconds = 0.0
 
-        list_file = os.path.join(self.temp_folder_name, "filelist.txt")
-        purge_file(list_file)
 
+    @property
+    def text(self) -> str:
+        """The text of the segments transcribed so far, in order, up to the first one still in flight."""
+        with self._condition:
+            completed = itertools.takewhile(lambda text: text is not None, self._texts)
+            return " ".join(text for text in completed if text)
 
-DEFAULT_TIMEOUT = 8 # in seconds
 
-def process_transcription(filename: str, transcription_manager: AudioTranscriptionManager, session_id: str, timeout = DEFAULT_TIMEOUT):
-    """Process the transcription of an audio file.
+    @property
+    def backlogged(self) -> bool:
+        """Whether the audio waiting for transcription exceeds `FILE_PENDING_SEGMENTS` segments per worker."""
+        pending = self._pending_samples + self._buffered_samples
+        return pending > FILE_PENDING_SEGMENTS * self.workers * self._segment_samples
+
+
+    def add_samples(self, samples: np.ndarray):
+        """Appends decoded audio, and queues the segments it completes. Never blocks, see `wait_for_capacity`."""
+        with self._condition:
+            if self.cancelled or self.finished or len(samples) == 0:
+                return
+            self._blocks.append(samples)
+            self._buffered_samples += len(samples)
+            self.received_samples += len(samples)
+            if self._buffered_samples <= self._segment_samples:
+                return
+
+            buffer = self._blocks[0] if len(self._blocks) == 1 else np.concatenate(self._blocks)
+            while len(buffer) > self._segment_samples:
+                # A segment plus a frame always holds a cut, which is placed where the segment would end at most
+                window = buffer[:self._segment_samples + self.vad.frame_size]
+                _, cut = self.vad.split(window, FILE_SEGMENT_SECONDS, FILE_SEGMENT_MIN_SECONDS)[0]
+                self._submit(buffer[:cut])
+                buffer = buffer[cut:]
+
+            self._blocks = [buffer]
+            self._buffered_samples = len(buffer)
+
+
+    def wait_for_capacity(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the transcription is not backlogged anymore, for producers which can be paused.
+
+        Returns:
+            bool: False if the wait timed out.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.backlogged or self.cancelled or self._error is not None, timeout)
+
+
+    def finish(self) -> str:
+        """Queues the end of the recording, then waits until every segment is transcribed.
+
+        Returns:
+            str: The transcription of the recording, partial if it was cancelled.
+
+        Raises:
+            Exception: The first error of the transcription of a segment.
+        """
+        with self._condition:
+            if self._blocks and not self.cancelled:
+                self._submit(np.concatenate(self._blocks))
+            self._blocks = []
+            self._buffered_samples = 0
+            self.finished = True
+            futures = list(self._futures)
+
+        logging.debug(f"Recording of {self._name} received, {self.received_samples / SAMPLE_RATE:.0f}s "
+                      f"in {len(futures)} segments")
+        wait(futures)
+        self._pool.shutdown()
+
+        if self._error is not None:
+            raise self._error
+        return self.text
+
+
+    def cancel(self):
+        """Abandons the transcription, the segments not started yet are dropped."""
+        with self._condition:
+            self.cancelled = True
+            self._blocks = []
+            self._buffered_samples = 0
+            futures = list(self._futures)
+            self._condition.notify_all()
+
+        for future in futures:
+            future.cancel()
+        self._pool.shutdown(wait=False)
+
+
+    def _submit(self, audio: np.ndarray):
+        """Queues a segment for transcription. Must be called with `_condition` held."""
+        bounds = self.vad.speech_bounds(audio)
+        if bounds is None:
+            self.skipped_seconds += len(audio) / SAMPLE_RATE
+            SKIPPED_AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
+            return
+
+        start, end = bounds
+        self.trimmed_seconds += (len(audio) - (end - start)) / SAMPLE_RATE
+
+        index = len(self._texts)
+        self._texts.append(None)
+        self._pending_samples += end - start
+        future = self._pool.submit(self._transcribe, index, audio[start:end])
+        self._futures.append(future)
+        future.add_done_callback(lambda future: self._complete(index, end - start, future))
+
+
+    def _transcribe(self, index: int, segment: np.ndarray) -> str:
+        engines = self._engines()
+        TRANSCRIBED_AUDIO_SECONDS.inc(len(segment) / SAMPLE_RATE)
+        with TRANSCRIPTION_SECONDS.time():
+            result = engines[index % len(engines)].transcribe(segment)
+        return str(result['text']).strip()
+
+
+    def _complete(self, index: int, samples: int, future: Future):
+        """Done callback of a segment, records its text and reports the progress."""
+        with self._condition:
+            self._pending_samples -= samples
+            self._condition.notify_all()
+            if future.cancelled() or self.cancelled:
+                return
+            error = future.exception()
+            if error is None:
+                self._texts[index] = future.result()
+                self.completed += 1
+                done, total = self.completed, len(self._texts) if self.finished else None
+            elif self._error is not None:
+                return
+            else:
+                self._error = error
+                futures = list(self._futures)
+
+        if error is not None:
+            logging.error(f"Error during the transcription of segment {index} of {self._name}: {error}")
+            # The segments not started yet are dropped
+            for other in futures:
+                other.cancel()
+            return
+
+        if self._on_progress is not None and (total is None or done < total):
+            try:
+                self._on_progress(done, total)
+            except Exception as e:
+                logging.error(f"Error while reporting the progress of {self._name}: {e}")
+
+
+class UploadTranscription:
+    """Transcribes an audio file while it is uploaded.
+
+    The chunks are fed to a streaming decoder as they are written to disk, and a `RecordingTranscriber` transcribes
+    the decoded audio, so the beginning of the file is transcribed while the rest is uploaded. A format which cannot
+    be decoded from a pipe, e.g. an MP4 file with its index at the end, yields no audio: the committed file is then
+    decoded from disk, a window at a time.
+    """
+
+    def __init__(self, name: str, on_progress: Optional[Callable[[int, Optional[int]], None]] = None):
+        """Starts the decoder of the upload.
+
+        Args:
+            name (str): Identifies the upload in logs.
+            on_progress (Optional[Callable[[int, Optional[int]], None]]): See `RecordingTranscriber`.
+
+        Raises:
+            FileNotFoundError: If ffmpeg is not installed.
+        """
+        self._name = name
+        self.transcriber = RecordingTranscriber(segment_engines, on_progress=on_progress, name=name)
+        self._decoder = StreamDecoder(self.transcriber.add_samples)
+
+
+    @property
+    def backlogged(self) -> bool:
+        """Whether the client should pause the upload, so the audio waiting for transcription stays bounded."""
+        return self.transcriber.backlogged
+
+
+    def feed(self, data: bytes):
+        """Feeds the next chunk of the file to the decoder."""
+        with AUDIO_WRITE_SECONDS.time():
+            written = self._decoder.write(data)
+        if not written:
+            logging.debug(f"Decoder of {self._name} stopped, the file will be decoded once complete")
+
+
+    def finish(self, path: str) -> str:
+        """Flushes the decoder, then waits until the whole file is transcribed.
+
+        Args:
+            path (str): The complete uploaded file.
+
+        Returns:
+            str: The transcription of the file, partial if it was cancelled.
+        """
+        self._decoder.close()
+        if self.transcriber.received_samples == 0 and not self.transcriber.cancelled:
+            logging.info(f"{self._name} could not be decoded as a stream, decoding the file")
+            start = 0.0
+            while not self.transcriber.cancelled:
+                self.transcriber.wait_for_capacity()
+                with AUDIO_DECODE_SECONDS.time():
+                    audio = decode_audio_file(path, start, FILE_DECODE_WINDOW_SECONDS)
+                if len(audio) == 0:
+                    break
+                self.transcriber.add_samples(audio)
+                start += FILE_DECODE_WINDOW_SECONDS
+        return self.transcriber.finish()
+
+
+    def cancel(self):
+        """Stops the decoder and abandons the transcription."""
+        self._decoder.kill()
+        self.transcriber.cancel()
+
+
+# Transcription passes run in the background, with at most one pending and one running pass per session.
+transcription_jobs = CoalescingJobQueue(num_workers=whisper_config.transcription_workers or whisper_config.max_batch_size,
+                                        name="transcription")
+Gauge("chronos_transcription_jobs_pending", "Transcription passes waiting for a worker",
+      function=lambda: transcription_jobs.pending_count)
+
+# Complete recordings hold their worker until every segment is transcribed, they run on their own workers so the
+# streaming passes of the live sessions always find a free one.
+file_transcription_jobs = CoalescingJobQueue(num_workers=whisper_config.file_transcription_workers,
+                                             name="file-transcription")
+Gauge("chronos_file_transcription_jobs_pending", "Recording transcriptions waiting for a worker",
+      function=lambda: file_transcription_jobs.pending_count)
+
+
+def start_transcription():
+    """Declares the speech model and starts the transcription workers, when the server starts.
+
+    Importing the module neither declares the model nor starts a worker, so it can be imported by the
+    benchmarks, or by a process of the inference role, which declares the model itself.
+    """
+    if get_inference_clients():
+        # The model runs in the inference workers, each session transcribes on the worker its conversation is
+        # routed to, whose engine batches the requests of every front-end worker.
+        models.register(WHISPER, wait_for_inference_workers, enabled=get_config().server.uses_speech_model())
+    else:
+        # Every session shares the same engine, which batches their transcription requests. It is loaded by the
+        # model manager, at startup or on the first recording.
+        models.register(WHISPER, lambda: load_transcription_engine(whisper_config), warmup=warm_up_transcription_engine,
+                        stop=lambda engine: engine.stop(), enabled=get_config().server.uses_speech_model())
+    on_shutdown("transcription engine", lambda: models.stop(WHISPER))
+
+    transcription_jobs.start()
+    on_shutdown("transcription jobs", lambda: transcription_jobs.stop(get_config().server.shutdown_timeout))
+    file_transcription_jobs.start()
+    on_shutdown("file transcription jobs", lambda: file_transcription_jobs.stop(get_config().server.shutdown_timeout))
+
+on_startup("transcription", start_transcription)
+
+
+def process_transcription(data: bytes, transcription_manager: AudioTranscriptionManager, session_id: str, streaming: bool = True):
+    """Process the transcription of an audio blob.
+
+    Streamed blobs are fed to the session decoder and a transcription pass is queued, complete recordings
+    are queued for a single pass. This function returns immediately, the 'transcription' event is sent
+    once the job completes. If a pass is still waiting in the queue for this session, it is replaced by
+    the new one, which covers the same audio and more.
 
     Args:
-        filename (str): The path to the audio file to be transcribed.
+        data (bytes): The encoded audio data to be transcribed.
         transcription_manager (AudioTranscriptionManager): The manager handling audio transcriptions.
         session_id (str): The ID of the current session.
+        streaming (bool): Whether the data is the next chunk of a live stream, or a complete recording
+                          transcribed in one pass.
 
     Raises:
-        Exception: Propagates exceptions that occur during processing.
-        TimeoutError: If the thread processing the transcription exceeds the allowed time.
+        MissingPackageError: If ffmpeg is not installed.
+        ModelUnavailableError: If the speech model is disabled on this server.
+        Exception: Propagates exceptions that occur while feeding the decoder.
     """
+    if not models.enabled(WHISPER):
+        raise ModelUnavailableError("The speech model is disabled")
 
     if not transcription_manager.ffmpeg_installed:
         logging.warning("ffmpeg package is not installed on the system, the transcription will be unavailable")
         raise MissingPackageError("ffmpeg not installed on system")
 
     try:
-        thread = transcription_manager.append_audio(filename)
-        thread.join(timeout=timeout)
-
-        if thread.is_alive():
-            logging.error(f"Processing thread for session {session_id} is taking longer than expected.")
-            raise TimeoutError(f"Timeout reached when processing thread {thread} for session {session_id}")
-
-        transcription = transcription_manager.transcription
-        socketio.emit('transcription', {'text': transcription}, to=session_id)
+        if streaming:
+            transcription_manager.append_audio(data)
+            transcription_jobs.submit(session_id, run_transcription_job, transcription_manager, session_id)
+        else:
+            file_transcription_jobs.submit((session_id, "file"), run_file_transcription_job, data, transcription_manager, session_id)
     except Exception as ex:
         logging.error(f"Error processing transcription: {ex}")
         raise
+
+
+def process_audio_end(transcription_manager: AudioTranscriptionManager, session_id: str):
+    """Process the end of a live recording, queueing the pass that flushes its decoder and finalizes the transcription.
+
+    Args:
+        transcription_manager (AudioTranscriptionManager): The manager handling audio transcriptions.
+        session_id (str): The ID of the current session.
+    """
+    if not models.enabled(WHISPER):
+        return
+    transcription_manager.finish_audio()
+    transcription_jobs.submit(session_id, run_transcription_job, transcription_manager, session_id)
+
+
+def cancel_transcription(session_id: str):
+    """Discard the transcription jobs still waiting in the queue for a session."""
+    transcription_jobs.cancel(session_id)
+    file_transcription_jobs.cancel((session_id, "file"))
+
+
+def run_transcription_job(transcription_manager: AudioTranscriptionManager, session_id: str):
+    """Background job, runs a streaming transcription pass and sends the result."""
+    transcription_manager.process_buffer()
+    emit_transcription(transcription_manager, session_id)
+
+
+def run_file_transcription_job(data: bytes, transcription_manager: AudioTranscriptionManager, session_id: str):
+    """Background job, transcribes a complete recording and sends the result, and the partial results of a long one."""
+    def emit_progress(done: int, total: Optional[int]):
+        emit_file_progress(session_id, transcription_manager.transcription, done, total)
+
+    if transcription_manager.transcribe_audio(data, on_progress=emit_progress):
+        emit_transcription(transcription_manager, session_id, streaming=False)
+
+
+def process_upload_start(upload_store: "UploadStore", session_id: str, name: str, size: int) -> "Upload":
+    """Start the chunked upload of an audio file, whose transcription starts with its first chunks.
+
+    The partial transcriptions are sent to the session the upload belongs to, which changes when the client resumes
+    the upload after a reconnect.
+
+    Args:
+        upload_store (UploadStore): The store receiving the uploads.
+        session_id (str): The ID of the session sending the file.
+        name (str): The name of the file on the client.
+        size (int): The size of the file, in bytes.
+
+    Returns:
+        Upload: The started upload.
+
+    Raises:
+        MissingPackageError: If ffmpeg is not installed.
+        ModelUnavailableError: If the speech model is disabled on this server.
+        UploadError: If the size is invalid, or the file is too large.
+    """
+    if not models.enabled(WHISPER):
+        raise ModelUnavailableError("The speech model is disabled")
+
+    if not check_ffmpeg_installed():
+        logging.warning("ffmpeg package is not installed on the system, the transcription will be unavailable")
+        raise MissingPackageError("ffmpeg not installed on system")
+
+    upload = upload_store.begin(session_id, name, size)
+
+    def emit_progress(done: int, total: Optional[int]):
+        emit_file_progress(upload.session_id, upload.transcription.transcriber.text, done, total) # type: ignore
+
+    try:
+        upload.transcription = UploadTranscription(f"upload {upload.upload_id}", on_progress=emit_progress)
+    except Exception:
+        upload_store.discard(upload.upload_id)
+        raise
+    return upload
+
+
+def process_upload_commit(upload_store: "UploadStore", upload: "Upload"):
+    """Queue the end of the transcription of a committed upload, its result is sent once the job completes.
+
+    Args:
+        upload_store (UploadStore): The store the upload is removed from once transcribed.
+        upload (Upload): The committed upload.
+    """
+    # Finishing holds the worker until the whole file is transcribed, like the transcription of a complete recording
+    file_transcription_jobs.submit((upload.upload_id, "upload"), run_upload_transcription_job, upload_store, upload)
+
+
+def run_upload_transcription_job(upload_store: "UploadStore", upload: "Upload"):
+    """Background job, waits for the transcription of a committed upload and sends the result, then removes the file."""
+    try:
+        with FILE_TRANSCRIPTION_SECONDS.time():
+            text = upload.transcription.finish(upload.path) # type: ignore
+        if not upload.transcription.transcriber.cancelled: # type: ignore
+            socketio.emit('transcription', {'text': text, 'stable': text, 'tentative': '', 'final': True}, to=upload.session_id)
+    finally:
+        upload_store.discard(upload.upload_id)
+
+
+def emit_file_progress(session_id: str, text: str, done: int, total: Optional[int]):
+    """Send the partial transcription of a long recording on the 'transcription' channel.
+
+    Args:
+        session_id (str): The ID of the session to send the transcription to.
+        text (str): The transcription of the segments completed so far.
+        done (int): The number of transcribed segments.
+        total (Optional[int]): The number of segments of the recording, None while it is still received.
+    """
+    socketio.emit('transcription', {'text': text, 'stable': text, 'tentative': '', 'final': False,
+                                    'progress': done / total if total else None}, to=session_id)
+
+
+def emit_transcription(transcription_manager: AudioTranscriptionManager, session_id: str, streaming: bool = True):
+    """Send the current transcription of a session on the 'transcription' channel.
+
+    The 'final' flag is set once the utterance ended, i.e. when the transcription will not change anymore.
+
+    Args:
+        transcription_manager (AudioTranscriptionManager): The manager handling audio transcriptions.
+        session_id (str): The ID of the session to send the transcription to.
+        streaming (bool): Whether the transcription comes from the streaming buffer, whose tentative part
+                          is sent separately.
+    """
+    if streaming:
+        stable = transcription_manager.stable_transcription
+        tentative = transcription_manager.tentative_transcription
+        final = transcription_manager.utterance_ended
+    else:
+        stable, tentative, final = transcription_manager.transcription, "", True
+
+    socketio.emit('transcription', {'text': transcription_manager.transcription, 'stable': stable, 'tentative': tentative, 'final': final}, to=session_id)
@@ -0,0 +1,398 @@
+"""
+config.py
+
+Runtime configuration of the models and of the components serving them. Every setting has a default,
+which can be overridden, in order of precedence, by a JSON configuration file, by environment variables
+(including the .env file) and by command line options. The configuration is validated once at startup.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import re
+import typing
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from .utils.audio_utils import SPEECH_ENCODERS
+from .utils.custom_exceptions import ConfigurationError
+
+DEFAULT_MODEL_URL = "https://huggingface.co/TheBloke/zephyr-7B-beta-GGUF/resolve/main/zephyr-7b-beta.Q6_K.gguf"
+
+WHISPER_MODELS = ("tiny.en", "tiny", "base.en", "base", "small.en", "small", "medium.en", "medium",
+                  "large-v1", "large-v2", "large-v3", "large", "large-v3-turbo", "turbo")
+
+# Length of the audio Whisper decodes at once, longer requests cannot be batched
+WHISPER_WINDOW_SECONDS = 30.0
+
+SERVER_WORKERS = ("werkzeug", "eventlet", "gevent")
+
+# all: a single process serving the clients and running the models, web: a front-end worker whose models run
+# in the inference workers, inference: a worker running the models for the front-end workers
+SERVER_ROLES = ("all", "web", "inference")
+
+# all: chat and transcription, text: chat without the speech model, audio: transcription without the text model
+PIPELINES = ("all", "text", "audio")
+
+# eager: the models load in parallel at startup, lazy: each model loads on its first use
+MODEL_LOADING = ("eager", "lazy")
+
+# Largest Socket.IO message accepted from a client
+MAX_MESSAGE_BYTES = 4 * 1024 ** 2
+
+# Room left in a message for the fields of an upload chunk besides its data
+UPLOAD_CHUNK_OVERHEAD_BYTES = 64 * 1024
+
+# Tokens kept free in the context besides the history budget and the answer, for the system template
+CONTEXT_MARGIN_TOKENS = 512
+
+
+def setting(default: Any, env: str, help: str) -> Any:
+    """Declares a configuration field, with the environment variable overriding it and its description."""
+    return field(default=default, metadata={"env": env, "help": help})
+
+
+@dataclass
+class LlamaConfig:
+    """Settings of the Llama text model and of its scheduling."""
+
+    model_path: Optional[str] = setting(None, "LLAMA_MODEL_PATH", "Local path of the GGUF model")
+    model_url: str = setting(DEFAULT_MODEL_URL, "LLAMA_MODEL_URL", "URL the model is downloaded from when missing")
+    model_sha256: Optional[str] = setting(None, "LLAMA_MODEL_SHA256", "SHA-256 digest the downloaded model is verified against")
+    download_workers: int = setting(4, "LLAMA_DOWNLOAD_WORKERS", "Ranges of the model downloaded in parallel")
+    n_ctx: int = setting(8192, "LLAMA_N_CTX", "Context size, in tokens")
+    n_batch: int = setting(128, "LLAMA_N_BATCH", "Prompt evaluation batch size, in tokens")
+    n_threads: Optional[int] = setting(None, "LLAMA_N_THREADS", "Threads used for generation, llama.cpp default if unset")
+    n_threads_batch: Optional[int] = setting(None, "LLAMA_N_THREADS_BATCH", "Threads used for prompt evaluation, llama.cpp default if unset")
+    use_mmap: bool = setting(True, "LLAMA_USE_MMAP", "Memory-map the model file instead of reading it")
+    use_mlock: bool = setting(False, "LLAMA_USE_MLOCK", "Lock the model in RAM so it is never swapped out")
+    max_answer_tokens: int = setting(2048, "MAX_ANSWER_TOKENS", "Maximum length of an answer, in tokens")
+    history_token_budget: int = setting(4096, "HISTORY_TOKEN_BUDGET", "Maximum length of the conversation history, in tokens")
+    stream_flush_interval: float = setting(0.04, "STREAM_FLUSH_INTERVAL", "Minimum time between two streamed frames of an answer, in seconds")
+    stream_flush_chars: int = setting(256, "STREAM_FLUSH_CHARS", "Buffered answer text sending a frame regardless of the interval")
+    max_queue_size: int = setting(16, "LLM_MAX_QUEUE_SIZE", "Maximum number of requests waiting for the model")
+    prompt_cache_bytes: int = setting(2 * 1024 ** 3, "PROMPT_CACHE_BYTES", "Memory budget of the cached context states")
+    prompt_cache_dir: Optional[str] = setting(None, "PROMPT_CACHE_DIR", "Folder the evicted context states spill to")
+    prompt_cache_disk_bytes: Optional[int] = setting(None, "PROMPT_CACHE_DISK_BYTES", "Disk budget of the spilled context states")
+
+
+@dataclass
+class WhisperConfig:
+    """Settings of the Whisper speech model and of the transcription pipeline."""
+
+    model: str = setting("base", "WHISPER_MODEL", "Whisper model size, or path to a checkpoint")
+    device: Optional[str] = setting(None, "WHISPER_DEVICE", "Torch device, cuda if available else cpu when unset")
+    download_root: Optional[str] = setting(None, "WHISPER_DOWNLOAD_ROOT", "Folder the Whisper checkpoints are stored in")
+    num_threads: Optional[int] = setting(None, "WHISPER_THREADS", "Torch intra-op threads, torch default if unset")
+    max_batch_size: int = setting(8, "WHISPER_MAX_BATCH_SIZE", "Maximum number of requests decoded together")
+    max_batch_wait: float = setting(0.05, "WHISPER_MAX_BATCH_WAIT", "Maximum time a request waits for a batch, in seconds")
+    transcription_workers: Optional[int] = setting(None, "TRANSCRIPTION_WORKERS", "Concurrent transcription jobs, the batch size if unset")
+    end_of_utterance_seconds: float = setting(0.8, "END_OF_UTTERANCE_SECONDS", "Silence ending an utterance, in seconds")
+    file_segment_seconds: float = setting(30.0, "FILE_SEGMENT_SECONDS", "Maximum length of the segments a long uploaded recording is split into, at most 30s (one Whisper window)")
+    file_segment_workers: Optional[int] = setting(None, "FILE_SEGMENT_WORKERS", "Segments of an uploaded recording transcribed concurrently, the batch size times the number of inference workers if unset")
+    file_transcription_workers: int = setting(2, "FILE_TRANSCRIPTION_WORKERS", "Uploaded recordings transcribed concurrently, on workers separate from the live transcription passes")
+
+
+@dataclass
+class TTSConfig:
+    """Settings of the speech synthesis of the answers."""
+
+    enabled: bool = setting(True, "TTS_ENABLED", "Synthesize the speech of the answers")
+    timeout: float = setting(10.0, "TTS_TIMEOUT", "Maximum time the synthesis of a sentence takes, in seconds")
+    voice: Optional[str] = setting(None, "TTS_VOICE", "Engine voice ID, the engine default if unset")
+    rate: Optional[int] = setting(None, "TTS_RATE", "Speech rate in words per minute, the engine default if unset")
+    audio_format: str = setting("ogg", "TTS_AUDIO_FORMAT", "Format of the speech sent to the clients: ogg (Opus), mp3 or wav")
+    segment_min_chars: int = setting(40, "TTS_SEGMENT_MIN_CHARS", "Minimum length of a synthesized segment, shorter sentences are grouped")
+    segment_first_min_chars: int = setting(10, "TTS_SEGMENT_FIRST_MIN_CHARS", "Minimum length of the first segment of an answer")
+    segment_max_chars: int = setting(250, "TTS_SEGMENT_MAX_CHARS", "Maximum length of a synthesized segment")
+    segment_max_delay: float = setting(2.0, "TTS_SEGMENT_MAX_DELAY", "Time after which pending text is synthesized, in seconds")
+    cache_bytes: int = setting(64 * 1024 ** 2, "TTS_CACHE_BYTES", "Memory budget of the cached speech, 0 to disable the cache")
+    cache_dir: Optional[str] = setting(None, "TTS_CACHE_DIR", "Folder the cached speech is kept in across restarts")
+    cache_disk_bytes: Optional[int] = setting(None, "TTS_CACHE_DISK_BYTES", "Disk budget of the cached speech")
+
+
+@dataclass
+class ServerConfig:
+    """Settings of the web server."""
+
+    host: str = setting("0.0.0.0", "FLASK_HOST", "Address the server listens on")
+    port: int = setting(5000, "FLASK_PORT", "Port the server listens on")
+    debug: bool = setting(False, "FLASK_DEBUG", "Run Flask in debug mode, with the reloader")
+    worker: str = setting("werkzeug", "SERVER_WORKER", "Server implementation: werkzeug (development), eventlet or gevent")
+    max_connections: Optional[int] = setting(None, "MAX_CONNECTIONS", "Maximum number of connected clients, no limit if unset")
+    shutdown_timeout: float = setting(30.0, "SHUTDOWN_TIMEOUT", "Time given to the running requests to complete on shutdown, in seconds")
+    metrics: bool = setting(True, "METRICS_ENABLED", "Serve the latency and throughput metrics on /metrics, in the Prometheus format")
+    session_idle_timeout: Optional[float] = setting(1800.0, "SESSION_IDLE_TIMEOUT", "Inactivity after which a session is closed, in seconds, never if unset")
+    session_memory_bytes: Optional[int] = setting(512 * 1024 ** 2, "SESSION_MEMORY_BYTES", "Memory budget of the histories and audio buffers, the least recently active sessions are closed past it")
+    session_sweep_interval: float = setting(30.0, "SESSION_SWEEP_INTERVAL", "Time between two checks of the idle sessions and of the memory budget, in seconds")
+    role: str = setting("all", "SERVER_ROLE", "Process role: all (single process), web (front-end worker) or inference (model worker)")
+    message_queue: Optional[str] = setting(None, "SOCKETIO_MESSAGE_QUEUE", "Message queue URL shared by the front-end workers, e.g. redis://localhost:6379/0")
+    inference_endpoints: Optional[str] = setting(None, "INFERENCE_ENDPOINTS", "Comma separated host:port of the inference workers of a front-end worker")
+    inference_bind: str = setting("127.0.0.1:6000", "INFERENCE_BIND", "Address an inference worker listens on, as host:port")
+    inference_authkey: Optional[str] = setting(None, "INFERENCE_AUTHKEY", "Secret shared by the front-end and inference workers")
+    pipeline: str = setting("all", "PIPELINE", "Features served: all, text (chat only, no speech model) or audio (transcription only, no text model)")
+    model_loading: str = setting("eager", "MODEL_LOADING", "When the models load: eager (in parallel at startup) or lazy (on first use)")
+    model_warmup: bool = setting(False, "MODEL_WARMUP", "Run a short inference once a model is loaded, so the first request is not slower")
+    upload_chunk_bytes: int = setting(1024 ** 2, "UPLOAD_CHUNK_BYTES", "Size of the chunks audio files are uploaded in, below the 4 MiB message limit")
+    upload_max_bytes: int = setting(1024 ** 3, "UPLOAD_MAX_BYTES", "Maximum size of an uploaded audio file")
+    upload_resume_timeout: float = setting(600.0, "UPLOAD_RESUME_TIMEOUT", "Time an interrupted upload can be resumed for, in seconds, its file is removed past it")
+    upload_dir: Optional[str] = setting(None, "UPLOAD_DIR", "Folder the uploaded files are written to, a temporary folder if unset")
+
+
+    def uses_text_model(self) -> bool:
+        return self.pipeline in ("all", "text")
+
+
+    def uses_speech_model(self) -> bool:
+        return self.pipeline in ("all", "audio")
+
+
+    def inference_addresses(self) -> List[Tuple[str, int]]:
+        """Returns the addresses of the inference workers, empty when the models run in this process."""
+        if not self.inference_endpoints:
+            return []
+        return [parse_address(endpoint) for endpoint in self.inference_endpoints.split(",") if endpoint.strip()]
+
+
+@dataclass
+class RuntimeConfig:
+    """Configuration of the whole application."""
+
+    llama: LlamaConfig = field(default_factory=LlamaConfig)
+    whisper: WhisperConfig = field(default_factory=WhisperConfig)
+    tts: TTSConfig = field(default_factory=TTSConfig)
+    server: ServerConfig = field(default_factory=ServerConfig)
+
+
+    def validate(self):
+        """Checks the consistency of the settings.
+
+        Raises:
+            ConfigurationError: Listing every invalid setting.
+        """
+        errors: List[str] = []
+
+        for name in ("n_ctx", "n_batch", "download_workers", "max_answer_tokens", "stream_flush_chars",
+                     "history_token_budget", "max_queue_size", "prompt_cache_bytes"):
+            if getattr(self.llama, name) < 1:
+                errors.append(f"llama.{name} must be positive")
+        for name in ("n_threads", "n_threads_batch", "prompt_cache_disk_bytes"):
+            value = getattr(self.llama, name)
+            if value is not None and value < 1:
+                errors.append(f"llama.{name} must be positive")
+
+        required_context = self.llama.history_token_budget + self.llama.max_answer_tokens + CONTEXT_MARGIN_TOKENS
+        if self.llama.n_ctx < required_context:
+            errors.append(f"llama.n_ctx ({self.llama.n_ctx}) must hold the history budget, the answer and the template "
+                          f"({required_context} tokens)")
+        if self.llama.n_batch > self.llama.n_ctx:
+            errors.append("llama.n_batch cannot exceed llama.n_ctx")
+        if self.llama.model_sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", self.llama.model_sha256):
+            errors.append("llama.model_sha256 must be a hexadecimal SHA-256 digest")
+        if self.llama.stream_flush_interval < 0:
+            errors.append("llama.stream_flush_interval cannot be negative")
+        # The web workers do not load the models, the audio pipeline has no text model
+        if not self.llama.model_path and self.server.role != "web" and self.server.uses_text_model():
+            errors.append("llama.model_path is not set (LLAMA_MODEL_PATH)")
+
+        if self.whisper.model not in WHISPER_MODELS and not os.path.isfile(self.whisper.model):
+            errors.append(f"whisper.model must be one of {', '.join(WHISPER_MODELS)} or a checkpoint file, got {self.whisper.model}")
+        for name in ("num_threads", "transcription_workers", "file_segment_workers", "file_transcription_workers"):
+            value = getattr(self.whisper, name)
+            if value is not None and value < 1:
+                errors.append(f"whisper.{name} must be positive")
+        if self.whisper.max_batch_size < 1:
+            errors.append("whisper.max_batch_size must be positive")
+        if self.whisper.max_batch_wait < 0:
+            errors.append("whisper.max_batch_wait cannot be negative")
+        if self.whisper.end_of_utterance_seconds <= 0:
+            errors.append("whisper.end_of_utterance_seconds must be positive")
+        if not WHISPER_WINDOW_SECONDS / 6 <= self.whisper.file_segment_seconds <= WHISPER_WINDOW_SECONDS:
+            errors.append(f"whisper.file_segment_seconds must be between {WHISPER_WINDOW_SECONDS / 6:.0f} and {WHISPER_WINDOW_SECONDS:.0f} seconds")
+
+        if self.tts.timeout <= 0:
+            errors.append("tts.timeout must be positive")
+        if self.tts.audio_format not in SPEECH_ENCODERS:
+            errors.append(f"tts.audio_format must be one of {', '.join(SPEECH_ENCODERS)}")
+        if not 0 < self.tts.segment_first_min_chars <= self.tts.segment_max_chars \
+                or not 0 < self.tts.segment_min_chars <= self.tts.segment_max_chars:
+            errors.append("tts.segment_min_chars and tts.segment_first_min_chars must be positive and not exceed tts.segment_max_chars")
+        if self.tts.segment_max_delay <= 0:
+            errors.append("tts.segment_max_delay must be positive")
+        if self.tts.cache_bytes < 0:
+            errors.append("tts.cache_bytes cannot be negative")
+        for name in ("rate", "cache_disk_bytes"):
+            value = getattr(self.tts, name)
+            if value is not None and value < 1:
+                errors.append(f"tts.{name} must be positive")
+
+        if self.server.worker not in SERVER_WORKERS:
+            errors.append(f"server.worker must be one of {', '.join(SERVER_WORKERS)}")
+        if not 0 < self.server.port < 65536:
+            errors.append("server.port must be a valid port number")
+        if self.server.max_connections is not None and self.server.max_connections < 1:
+            errors.append("server.max_connections must be positive")
+        if self.server.shutdown_timeout < 0:
+            errors.append("server.shutdown_timeout cannot be negative")
+        for name in ("session_idle_timeout", "session_memory_bytes"):
+            value = getattr(self.server, name)
+            if value is not None and value <= 0:
+                errors.append(f"server.{name} must be positive")
+        if self.server.session_sweep_interval <= 0:
+            errors.append("server.session_sweep_interval must be positive")
+        if not 0 < self.server.upload_chunk_bytes <= MAX_MESSAGE_BYTES - UPLOAD_CHUNK_OVERHEAD_BYTES:
+            errors.append(f"server.upload_chunk_bytes must be positive and at most {MAX_MESSAGE_BYTES - UPLOAD_CHUNK_OVERHEAD_BYTES} bytes")
+        if self.server.upload_max_bytes <= 0:
+            errors.append("server.upload_max_bytes must be positive")
+        if self.server.upload_resume_timeout <= 0:
+            errors.append("server.upload_resume_timeout must be positive")
+        if self.server.role not in SERVER_ROLES:
+            errors.append(f"server.role must be one of {', '.join(SERVER_ROLES)}")
+        try:
+            parse_address(self.server.inference_bind)
+            addresses = self.server.inference_addresses()
+        except ConfigurationError as e:
+            errors.append(str(e))
+        else:
+            if self.server.role == "web" and not addresses:
+                errors.append("server.inference_endpoints must list the inference workers of a web worker (INFERENCE_ENDPOINTS)")
+            if self.server.role == "inference" and addresses:
+                errors.append("server.inference_endpoints is only used by the web workers")
+        if self.server.pipeline not in PIPELINES:
+            errors.append(f"server.pipeline must be one of {', '.join(PIPELINES)}")
+        if self.server.model_loading not in MODEL_LOADING:
+            errors.append(f"server.model_loading must be one of {', '.join(MODEL_LOADING)}")
+        if self.server.role != "all" and not self.server.inference_authkey:
+            errors.append("server.inference_authkey must be set when the models run in inference workers (INFERENCE_AUTHKEY)")
+
+        if errors:
+            raise ConfigurationError("Invalid configuration: " + "; ".join(errors))
+
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+
+def parse_address(value: str) -> Tuple[str, int]:
+    """Converts a host:port string to an address.
+
+    Raises:
+        ConfigurationError: If the string is not a valid address.
+    """
+    host, _, port = value.strip().rpartition(":")
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ConfigurationError(f"Invalid address {value!r}, expected host:port")
+    return host, int(port)
+
+
+def parse_value(raw: Any, annotation: Any) -> Any:
+    """Converts a raw setting value (string from the environment or JSON value) to the field type.
+
+    Raises:
+        ConfigurationError: If the value cannot be converted.
+    """
+    if annotation is Optional[int] or annotation is Optional[str] or annotation is Optional[float]:
+        if raw is None or raw == "":
+            return None
+        annotation = typing.get_args(annotation)[0]
+
+    try:
+        if annotation is bool:
+            if isinstance(raw, bool):
+                return raw
+            if str(raw).lower() in ("1", "true", "yes", "on"):
+                return True
+            if str(raw).lower() in ("0", "false", "no", "off"):
+                return False
+            raise ValueError(f"not a boolean: {raw}")
+        return annotation(raw)
+    except (TypeError, ValueError) as e:
+        raise ConfigurationError(f"Invalid value {raw!r}: {e}") from e
+
+
+def apply_overrides(section: Any, values: Dict[str, Any], origin: str):
+    """Sets the fields of a configuration section from a dict of raw values.
+
+    Raises:
+        ConfigurationError: If a key is not a field of the section, or a value cannot be converted.
+    """
+    hints = typing.get_type_hints(type(section))
+    for name, raw in values.items():
+        if name not in hints:
+            raise ConfigurationError(f"Unknown setting {name} in {origin}")
+        try:
+            setattr(section, name, parse_value(raw, hints[name]))
+        except ConfigurationError as e:
+            raise ConfigurationError(f"{name} in {origin}: {e}") from e
+
+
+def load_config(config_file: Optional[str] = None, overrides: Optional[Dict[str, Dict[str, Any]]] = None) -> RuntimeConfig:
+    """Builds the runtime configuration from the defaults, the configuration file, the environment and the overrides.
+
+    Args:
+        config_file (Optional[str]): Path of a JSON file with 'llama', 'whisper', 'tts' and 'server' sections.
+                                     Defaults to the APP_CONFIG environment variable, if set.
+        overrides (Optional[Dict[str, Dict[str, Any]]]): Values taking precedence over everything else, by
+                                                         section, e.g. from the command line. None values are ignored.
+
+    Returns:
+        RuntimeConfig: The configuration, not validated yet.
+
+    Raises:
+        ConfigurationError: If the file cannot be read or holds unknown or invalid settings.
+    """
+    config = RuntimeConfig()
+    sections = {"llama": config.llama, "whisper": config.whisper, "tts": config.tts, "server": config.server}
+
+    config_file = config_file or os.getenv("APP_CONFIG")
+    if config_file:
+        try:
+            with open(config_file) as file:
+                file_values = json.load(file)
+        except (OSError, json.JSONDecodeError) as e:
+            raise ConfigurationError(f"Cannot read configuration file {config_file}: {e}") from e
+
+        for section_name, values in file_values.items():
+            if section_name not in sections:
+                raise ConfigurationError(f"Unknown section {section_name} in {config_file}")
+            apply_overrides(sections[section_name], values, config_file)
+
+    for section in sections.values():
+        env_values = {}
+        for section_field in dataclasses.fields(section):
+            raw = os.getenv(section_field.metadata["env"])
+            if raw is not None:
+                env_values[section_field.name] = raw
+        apply_overrides(section, env_values, "environment")
+
+    for section_name, values in (overrides or {}).items():
+        apply_overrides(sections[section_name], {name: value for name, value in values.items() if value is not None}, "command line")
+
+    return config
+
+
+_config: Optional[RuntimeConfig] = None
+
+
+def set_config(config: RuntimeConfig):
+    """Sets the configuration used by the application, must be called before the models are loaded."""
+    global _config
+    _config = config
+
+
+def get_config() -> RuntimeConfig:
+    """Returns the configuration used by the application, loaded from the environment if none was set."""
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+
+def log_config(config: RuntimeConfig):
+    """Logs the effective settings, secrets excluded."""
+    settings = config.as_dict()
+    if settings["server"]["inference_authkey"]:
+        settings["server"]["inference_authkey"] = "***"
+    logging.info(f"Runtime configuration: {json.dumps(settings, sort_keys=True)}")
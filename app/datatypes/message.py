@@ -1,10 +1,12 @@
 import uuid
+from typing import Optional
 
 class Message:
-    def __init__(self, emitter: str, content: str = "") -> None:
+    def __init__(self, emitter: str, content: str = "", token_count: Optional[int] = None) -> None:
         self.id = uuid.uuid4()
         self.emitter = emitter
         self.content = content
+        self.token_count = token_count
 
     @property
     def emitter(self):
@@ -21,3 +23,14 @@ class Message:
     @content.setter
     def content(self, content):
         self._content = content
+        # The cached token count no longer matches the content
+        self._token_count = None
+
+    @property
+    def token_count(self) -> Optional[int]:
+        """The number of model tokens of the content, None until counted."""
+        return self._token_count
+
+    @token_count.setter
+    def token_count(self, token_count: Optional[int]):
+        self._token_count = token_count
@@ -0,0 +1,345 @@
+"""
+inference.py
+
+Runs the models either in the process serving the clients or in dedicated inference workers, so CPU capacity
+can be added by starting more processes, on the same node or on others.
+
+The front-end code only uses the `generate`, `count_tokens` and `discard` methods of a text generator and the
+`transcribe` method of a transcription engine. `TextGenerator` and `TranscriptionEngine` implement them with the
+models of the current process, `InferenceClient` forwards them to an inference worker over a
+`multiprocessing.managers` connection. An inference worker serves `InferenceService`, which queues the
+generations of every front-end worker on its own `LLMScheduler` and batches their transcriptions on its own
+`TranscriptionEngine`.
+
+Each session is routed to one inference worker, chosen from its ID, so its context state stays in the prompt
+cache of that worker from one turn to the next.
+"""
+
+import itertools
+import logging
+import queue
+import time
+import zlib
+
+from multiprocessing.managers import BaseManager, IteratorProxy
+from typing import TYPE_CHECKING, Any, Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .llm_scheduler import LLMScheduler
+from .lifecycle import is_shutting_down, on_shutdown
+from .model_manager import models, LLM, WHISPER, DISABLED, FAILED
+from .prompts import DEFAULT_TEMPLATE, USER_PROMPT
+from .utils import load_text_model, load_audio_model, SAMPLE_RATE
+from .utils.custom_exceptions import ModelUnavailableError
+from .utils.prompt_cache import PromptStateCache
+from .utils.concurrency import run_blocking, iterate_blocking
+
+if TYPE_CHECKING:
+    from .config import LlamaConfig, RuntimeConfig, WhisperConfig
+    from .transcription_engine import TranscriptionEngine
+
+# Time between two attempts to reach an inference worker that is not ready yet, in seconds
+CONNECT_RETRY_INTERVAL = 2.0
+
+# The session of the warm-up generation, whose context state is discarded afterwards
+WARMUP_SESSION = "warmup"
+
+_END = object()
+
+_clients: Optional[List["InferenceClient"]] = None
+
+
+class TextGenerator:
+    """Generates the answers with the Llama model of the current process.
+
+    The context state of the session is restored from the prompt cache before the generation and saved after
+    it, so only the tokens added since the previous turn are evaluated.
+    """
+
+    def __init__(self, llm, prompt_cache: PromptStateCache):
+        self.llm = llm
+        self.prompt_cache = prompt_cache
+
+
+    def generate(self, session_id: str, prompt: str, max_tokens: int) -> Iterator[str]:
+        """Streams the text of the answer to a prompt, token by token.
+
+        Args:
+            session_id (str): The session the prompt belongs to.
+            prompt (str): The whole conversation, ending with the turn to answer.
+            max_tokens (int): The maximum length of the answer, in tokens.
+        """
+        run_blocking(self.prompt_cache.restore, self.llm, session_id)
+        output = self.llm(prompt, max_tokens=max_tokens, echo=False, stream=True)
+        # Each token is computed outside of the event loop when running on a green server
+        for item in iterate_blocking(output):
+            yield item['choices'][0]['text']
+        run_blocking(self.prompt_cache.save, self.llm, session_id)
+
+
+    def count_tokens(self, text: str) -> int:
+        """Returns the number of tokens of a text, template tags included."""
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+
+    def discard(self, session_id: str):
+        """Drops the cached context state of a session."""
+        self.prompt_cache.discard(session_id)
+
+
+def load_text_generator(config: "LlamaConfig", prompt_cache: PromptStateCache) -> TextGenerator:
+    """Loads the text model and caches the state of the system template, which starts every conversation."""
+    llm = run_blocking(load_text_model, config)
+    run_blocking(prompt_cache.prime, llm, DEFAULT_TEMPLATE)
+    return TextGenerator(llm, prompt_cache)
+
+
+def warm_up_text_generator(generator: TextGenerator):
+    """Generates one token, so the first answer does not pay for the lazy initializations of llama.cpp."""
+    prompt = DEFAULT_TEMPLATE + USER_PROMPT.replace('{INSERT_PROMPT_HERE}', "Hello")
+    for _ in generator.generate(WARMUP_SESSION, prompt, 1):
+        pass
+    generator.discard(WARMUP_SESSION)
+
+
+def load_transcription_engine(config: "WhisperConfig") -> "TranscriptionEngine":
+    """Loads the speech model and starts the engine batching the transcriptions of every session."""
+    # torch and whisper are only imported by the processes running the speech model
+    from .transcription_engine import TranscriptionEngine
+
+    engine = TranscriptionEngine(run_blocking(load_audio_model, config),
+                                 max_batch_size=config.max_batch_size,
+                                 max_wait=config.max_batch_wait)
+    engine.start()
+    return engine
+
+
+def warm_up_transcription_engine(engine: "TranscriptionEngine"):
+    """Transcribes a second of silence, so the first transcription does not pay for the initializations of torch."""
+    engine.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32))
+
+
+def wait_for_inference_workers() -> List["InferenceClient"]:
+    """Waits until every inference worker of the configuration is ready, the models of a web worker."""
+    return [run_blocking(client.wait_ready) for client in get_inference_clients()]
+
+
+def route(session_id: str, count: int) -> int:
+    """Returns the index of the inference worker serving a session, the same for every turn of the session."""
+    return zlib.crc32(session_id.encode("utf-8")) % count
+
+
+class InferenceService:
+    """The models of an inference worker, shared by the front-end workers connected to it.
+
+    The generations are queued on the scheduler of the worker, and their tokens handed to the front-end as they
+    are produced. A front-end worker leaving in the middle of an answer does not block the worker, the
+    generation completes and its remaining tokens are dropped.
+    """
+
+    def __init__(self, config: "RuntimeConfig"):
+        self.config = config
+        self.prompt_cache = PromptStateCache(capacity_bytes=config.llama.prompt_cache_bytes,
+                                             spill_dir=config.llama.prompt_cache_dir,
+                                             disk_capacity_bytes=config.llama.prompt_cache_disk_bytes)
+        self.scheduler = LLMScheduler(lambda: models.wait(LLM), max_queue_size=config.llama.max_queue_size)
+        self._request_ids = itertools.count()
+
+
+    def start(self):
+        """Starts loading the models of the pipeline of the worker, in parallel or on first use."""
+        server = self.config.server
+        models.register(LLM, lambda: load_text_generator(self.config.llama, self.prompt_cache),
+                        warmup=warm_up_text_generator, enabled=server.uses_text_model())
+        models.register(WHISPER, lambda: load_transcription_engine(self.config.whisper),
+                        warmup=warm_up_transcription_engine, stop=lambda engine: engine.stop(),
+                        enabled=server.uses_speech_model())
+
+        if models.enabled(LLM):
+            self.scheduler.start()
+            on_shutdown("LLM scheduler", lambda: self.scheduler.stop(server.shutdown_timeout))
+        on_shutdown("transcription engine", lambda: models.stop(WHISPER))
+
+        models.start(lazy=server.model_loading == "lazy", warmup=server.model_warmup)
+
+
+    def ready(self) -> bool:
+        """Whether the models are loaded, or will load on first use."""
+        return models.ready()
+
+
+    def generate(self, session_id: str, prompt: str, max_tokens: int) -> Iterator[str]:
+        """Queues the generation of an answer and returns the stream of its tokens.
+
+        Raises:
+            ServerBusyError: If the queue of the worker is full.
+            ModelUnavailableError: If the text model is disabled on the worker or failed to load.
+        """
+        if models.load(LLM).state in (DISABLED, FAILED):
+            raise ModelUnavailableError(f"Text model is {models.state(LLM)} on this worker")
+        tokens: queue.Queue = queue.Queue()
+
+        def job(generator: TextGenerator):
+            try:
+                for text in generator.generate(session_id, prompt, max_tokens):
+                    tokens.put(text)
+            except Exception as e:
+                tokens.put(e)
+            finally:
+                tokens.put(_END)
+
+        def fail(error: Exception):
+            tokens.put(error)
+            tokens.put(_END)
+
+        # The front-end worker already allows one request in flight per session, the request key only has to be
+        # unique, so the next turn of a session can be queued while the previous job is being cleared.
+        self.scheduler.submit(f"{session_id}#{next(self._request_ids)}", job, on_failure=fail)
+        return self._stream(tokens)
+
+
+    @staticmethod
+    def _stream(tokens: queue.Queue) -> Iterator[str]:
+        while True:
+            item = tokens.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+    def count_tokens(self, text: str) -> int:
+        return models.get(LLM).count_tokens(text)
+
+
+    def discard(self, session_id: str):
+        self.prompt_cache.discard(session_id)
+
+
+    def transcribe(self, audio, word_timestamps: bool = False, timeout: Optional[float] = None) -> dict:
+        return models.get(WHISPER).transcribe(audio, word_timestamps=word_timestamps, timeout=timeout)
+
+
+class InferenceManager(BaseManager):
+    """Serves an `InferenceService` to the front-end workers, the token streams are returned as iterator proxies."""
+
+
+def _register_service(factory: Optional[Callable[[], InferenceService]] = None):
+    InferenceManager.register("inference_service", callable=factory,
+                              exposed=("ready", "generate", "count_tokens", "discard", "transcribe"),
+                              method_to_typeid={"generate": "Iterator"})
+
+InferenceManager.register("Iterator", proxytype=IteratorProxy, create_method=False)
+_register_service()
+
+
+def serve_inference(config: "RuntimeConfig"):
+    """Runs an inference worker until the process is stopped.
+
+    Args:
+        config (RuntimeConfig): The configuration, the worker listens on `server.inference_bind`.
+    """
+    from .config import parse_address
+
+    service = InferenceService(config)
+    service.start()
+    _register_service(lambda: service)
+
+    address = parse_address(config.server.inference_bind)
+    manager = InferenceManager(address=address, authkey=(config.server.inference_authkey or "").encode("utf-8"))
+    server = manager.get_server()
+    logging.info(f"Inference worker listening on {address[0]}:{address[1]}")
+    server.serve_forever()
+
+
+class InferenceClient:
+    """The connection of a front-end worker to an inference worker.
+
+    Exposes the methods of `TextGenerator` and `TranscriptionEngine` used by the front-end, so it stands for
+    both. The connection is opened on first use and opened again after a failure, the call that failed raises
+    its error.
+    """
+
+    def __init__(self, address: Tuple[str, int], authkey: str):
+        self.address = address
+        self._authkey = authkey.encode("utf-8")
+        self._service: Any = None
+
+
+    @property
+    def name(self) -> str:
+        return f"{self.address[0]}:{self.address[1]}"
+
+
+    def _connect(self) -> Any:
+        if self._service is None:
+            manager = InferenceManager(address=self.address, authkey=self._authkey)
+            manager.connect()
+            self._service = manager.inference_service()  # type: ignore
+        return self._service
+
+
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        try:
+            return getattr(self._connect(), method)(*args, **kwargs)
+        except (OSError, EOFError):
+            self._service = None
+            raise
+
+
+    def wait_ready(self) -> "InferenceClient":
+        """Waits until the inference worker is reachable and its models are loaded.
+
+        Raises:
+            ConnectionError: If the application shuts down meanwhile.
+        """
+        while not is_shutting_down():
+            try:
+                if self._call("ready"):
+                    logging.info(f"Inference worker {self.name} ready")
+                    return self
+            except (OSError, EOFError) as e:
+                logging.info(f"Waiting for inference worker {self.name}: {e}")
+            time.sleep(CONNECT_RETRY_INTERVAL)
+        raise ConnectionError(f"Shut down before inference worker {self.name} was ready")
+
+
+    def generate(self, session_id: str, prompt: str, max_tokens: int) -> Iterator[str]:
+        try:
+            yield from self._call("generate", session_id, prompt, max_tokens)
+        except (OSError, EOFError):
+            self._service = None
+            raise
+
+
+    def count_tokens(self, text: str) -> int:
+        return self._call("count_tokens", text)
+
+
+    def discard(self, session_id: str):
+        self._call("discard", session_id)
+
+
+    def transcribe(self, audio, word_timestamps: bool = False, timeout: Optional[float] = None) -> dict:
+        return self._call("transcribe", audio, word_timestamps=word_timestamps, timeout=timeout)
+
+
+def get_inference_clients() -> List[InferenceClient]:
+    """Returns the clients of the inference workers of the configuration, empty when the models run in this process."""
+    global _clients
+    if _clients is None:
+        from .config import get_config
+
+        server = get_config().server
+        _clients = [InferenceClient(address, server.inference_authkey or "") for address in server.inference_addresses()]
+    return _clients
+
+
+def client_for(session_id: str) -> Optional[InferenceClient]:
+    """Returns the client of the inference worker serving a session, None when the models run in this process."""
+    clients = get_inference_clients()
+    if not clients:
+        return None
+    return clients[route(session_id, len(clients))]
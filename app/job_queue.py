@@ -0,0 +1,156 @@
+"""
+job_queue.py
+
+This module provides the CoalescingJobQueue, a small worker pool running background jobs keyed by session.
+Each key has at most one running and one pending job: submitting a job while another one is still pending
+for the same key replaces the stale one, so bursts of events do not pile up work.
+"""
+
+import logging
+import threading
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+
+Job = Tuple[Callable[..., Any], tuple, dict]
+
+
+class CoalescingJobQueue:
+    """Runs jobs on a pool of worker threads, with at most one pending and one running job per key.
+
+    Jobs for a given key never run concurrently: a job submitted while another one runs for the same key
+    waits for it to complete. A job submitted while another one is still pending for the same key replaces it.
+    """
+
+    def __init__(self, num_workers: int = 1, name: str = "jobs"):
+        """Initializes the queue, the worker threads are only started by `start`.
+
+        Args:
+            num_workers (int): The number of worker threads.
+            name (str): The name of the queue, used for the worker threads and in logs.
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+
+        self.num_workers = num_workers
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._pending: Dict[Hashable, Job] = {}
+        self._running: Set[Hashable] = set()
+        self._ready: Deque[Hashable] = deque()
+        self._workers: List[threading.Thread] = []
+        self._stopping = False
+
+        self.replaced_jobs = 0
+
+
+    def start(self):
+        """Starts the worker threads."""
+        self._stopping = False
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self._run, name=f"{self.name}-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stops the worker threads once the running jobs complete, pending jobs are discarded.
+
+        Args:
+            timeout (Optional[float]): The maximum time to wait for each worker thread, in seconds.
+        """
+        with self._condition:
+            self._stopping = True
+            self._pending.clear()
+            self._ready.clear()
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers.clear()
+
+
+    def submit(self, key: Hashable, function: Callable[..., Any], *args, **kwargs) -> bool:
+        """Schedules a job for a key.
+
+        Args:
+            key (Hashable): The key the job belongs to, typically the session ID.
+            function (Callable[..., Any]): The job to run.
+            *args, **kwargs: The arguments of the job.
+
+        Returns:
+            bool: True if the job replaced a pending job of the same key.
+        """
+        with self._condition:
+            replaced = key in self._pending
+            self._pending[key] = (function, args, kwargs)
+
+            if replaced:
+                self.replaced_jobs += 1
+                logging.debug(f"Replaced stale pending job of {key} in queue {self.name}")
+            elif key not in self._running:
+                self._ready.append(key)
+                self._condition.notify()
+
+        return replaced
+
+
+    def cancel(self, key: Hashable) -> bool:
+        """Discards the pending job of a key, a running job is left to complete.
+
+        Args:
+            key (Hashable): The key of the job to discard.
+
+        Returns:
+            bool: True if a pending job was discarded.
+        """
+        with self._condition:
+            if self._pending.pop(key, None) is None:
+                return False
+            try:
+                self._ready.remove(key)
+            except ValueError:
+                pass
+            return True
+
+
+    @property
+    def pending_count(self) -> int:
+        """The number of jobs waiting for a worker."""
+        with self._condition:
+            return len(self._pending)
+
+
+    @property
+    def running_count(self) -> int:
+        """The number of jobs currently running."""
+        with self._condition:
+            return len(self._running)
+
+
+    def _run(self):
+        """Worker loop, runs the jobs of the ready keys one at a time."""
+        while True:
+            with self._condition:
+                while not self._ready and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+
+                key = self._ready.popleft()
+                function, args, kwargs = self._pending.pop(key)
+                self._running.add(key)
+
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Error in job of {key} in queue {self.name}: {e}")
+            finally:
+                with self._condition:
+                    self._running.discard(key)
+                    # A job submitted while this one was running is now ready
+                    if key in self._pending:
+                        self._ready.append(key)
+                        self._condition.notify()
@@ -0,0 +1,84 @@
+"""
+lifecycle.py
+
+Startup and graceful shutdown of the application. The components whose background workers must not run when
+they are only imported, e.g. by the benchmarks or by another role, register a start hook, which `startup` runs
+once the server starts. The components running background workers register a stop hook when they are started,
+and `shutdown` runs the hooks in the reverse order, once the server stops accepting connections: the last
+created components, which depend on the first ones, are stopped first.
+"""
+
+import logging
+import threading
+
+from typing import Callable, List, Tuple
+
+_start_hooks: List[Tuple[str, Callable[[], None]]] = []
+_hooks: List[Tuple[str, Callable[[], None]]] = []
+_last_hooks: List[Tuple[str, Callable[[], None]]] = []
+_lock = threading.Lock()
+_started = threading.Event()
+_shutting_down = threading.Event()
+
+
+def on_startup(name: str, hook: Callable[[], None]):
+    """Registers a hook called when the application starts.
+
+    Args:
+        name (str): The name of the component, used in logs.
+        hook (Callable[[], None]): Starts the component, e.g. its worker threads. It can register a stop hook.
+    """
+    with _lock:
+        _start_hooks.append((name, hook))
+
+
+def startup():
+    """Starts the registered components, in the order of their registration. Only runs once.
+
+    Raises:
+        Exception: Propagates the error of a hook, the application cannot serve without the component.
+    """
+    with _lock:
+        if _started.is_set():
+            return
+        _started.set()
+        hooks = list(_start_hooks)
+
+    for name, hook in hooks:
+        hook()
+        logging.info(f"Started {name}")
+
+
+def on_shutdown(name: str, hook: Callable[[], None], last: bool = False):
+    """Registers a hook called when the application shuts down.
+
+    Args:
+        name (str): The name of the component, used in logs.
+        hook (Callable[[], None]): Stops the component, e.g. waits for its running work to complete.
+        last (bool): Whether the hook runs after every hook registered without this flag, e.g. to release state
+                     the other components use until they are stopped.
+    """
+    with _lock:
+        (_last_hooks if last else _hooks).append((name, hook))
+
+
+def is_shutting_down() -> bool:
+    """Whether the application is shutting down, new connections are then refused."""
+    return _shutting_down.is_set()
+
+
+def shutdown():
+    """Stops the registered components, in the reverse order of their registration. Only runs once."""
+    with _lock:
+        if _shutting_down.is_set():
+            return
+        _shutting_down.set()
+        hooks = list(reversed(_hooks)) + list(reversed(_last_hooks))
+
+    logging.info("Shutting down, waiting for the running requests to complete")
+    for name, hook in hooks:
+        try:
+            hook()
+            logging.info(f"Stopped {name}")
+        except Exception as e:
+            logging.error(f"Error while stopping {name}: {e}")
@@ -0,0 +1,252 @@
+"""
+llm_scheduler.py
+
+This module provides the LLMScheduler, which owns the shared Llama model and serves the generation
+requests of every session on a single worker thread. llama.cpp keeps one evaluation context per model,
+so generations are serialized rather than run concurrently on the same context.
+"""
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from .utils.custom_exceptions import ServerBusyError, RequestInFlightError, ModelUnavailableError
+from .utils.metrics import Counter, Histogram
+
+# Default number of requests waiting for the model before new ones are rejected
+DEFAULT_MAX_QUEUE_SIZE = 16
+
+QUEUE_WAIT_SECONDS = Histogram("chronos_llm_queue_wait_seconds", "Time a generation request waits for the model")
+REJECTED_REQUESTS = Counter("chronos_llm_rejected_requests_total", "Generation requests rejected as the queue was full")
+
+
+class LLMRequest:
+    """A generation request waiting for, or being served by, the scheduler.
+
+    Attributes:
+        session_id (str): The session the request belongs to.
+        job (Callable[[Any], Any]): The work to run, called with the model.
+        on_failure (Optional[Callable[[Exception], None]]): Called instead of the job when the request is
+            discarded because the model failed to load or the scheduler stopped.
+        enqueued_at (float): The monotonic time the request was queued at.
+        started_at (Optional[float]): The monotonic time the request started at, None while waiting.
+    """
+
+    def __init__(self, session_id: str, job: Callable[[Any], Any], on_failure: Optional[Callable[[Exception], None]] = None):
+        self.session_id = session_id
+        self.job = job
+        self.on_failure = on_failure
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+
+class LLMScheduler:
+    """Serializes the access of all sessions to the shared Llama model.
+
+    Each session has at most one request in flight (queued or running), and the queue serves sessions in
+    the order they became ready, which with one request per session is a round-robin over the sessions.
+    The queue is bounded: once `max_queue_size` requests are waiting, new ones are rejected so the client
+    can be told that the server is busy.
+
+    The worker thread obtains the model when the scheduler starts, by waiting for the model manager to load it,
+    requests queued meanwhile are served once it is ready. If the model fails to load, the waiting requests fail
+    and new ones are refused.
+    """
+
+    def __init__(self, load_model: Callable[[], Any], max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE):
+        """Initializes the scheduler, the worker thread is only started by `start`.
+
+        Args:
+            load_model (Callable[[], Any]): Returns the model the jobs are called with, waiting until it is loaded.
+                                            Called on the worker thread, it must not block the event loop.
+            max_queue_size (int): The maximum number of waiting requests.
+        """
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be at least 1")
+
+        self._load_model = load_model
+        self.max_queue_size = max_queue_size
+        self.model: Any = None
+        self.error: Optional[str] = None
+
+        self._condition = threading.Condition()
+        self._queue: "OrderedDict[str, LLMRequest]" = OrderedDict()
+        self._running: Optional[LLMRequest] = None
+        self._worker: Optional[threading.Thread] = None
+        self._stopping = False
+
+        self.served_requests = 0
+        self.rejected_requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+
+    @property
+    def model_ready(self) -> bool:
+        """Whether the model is loaded."""
+        return self.model is not None
+
+
+    def start(self):
+        """Starts the worker thread, which loads the model then serves the queue."""
+        self._stopping = False
+        self._worker = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+        self._worker.start()
+
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stops the worker thread once the running request completes, waiting requests fail.
+
+        Args:
+            timeout (Optional[float]): The maximum time to wait for the running request, in seconds.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._fail_waiting(ModelUnavailableError("The LLM scheduler is stopped"))
+
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+
+    def submit(self, session_id: str, job: Callable[[Any], Any], on_failure: Optional[Callable[[Exception], None]] = None) -> int:
+        """Queues a generation request for a session.
+
+        Args:
+            session_id (str): The session submitting the request.
+            job (Callable[[Any], Any]): The work to run, called with the model on the worker thread.
+            on_failure (Optional[Callable[[Exception], None]]): Called with the error if the request is discarded
+                                                                 before it runs, e.g. when the model fails to load.
+
+        Returns:
+            int: The number of requests that will be served before this one.
+
+        Raises:
+            ModelUnavailableError: If the model failed to load or the scheduler is stopped.
+            RequestInFlightError: If the session already has a request queued or running.
+            ServerBusyError: If the queue is full.
+        """
+        with self._condition:
+            if self.error is not None:
+                raise ModelUnavailableError(f"LLM model failed to load: {self.error}")
+            if self._stopping:
+                raise ModelUnavailableError("The LLM scheduler is stopped")
+
+            if session_id in self._queue or (self._running is not None and self._running.session_id == session_id):
+                raise RequestInFlightError(f"Session {session_id} already has a request in flight")
+
+            if len(self._queue) >= self.max_queue_size:
+                self.rejected_requests += 1
+                REJECTED_REQUESTS.inc()
+                logging.warning(f"LLM queue full ({len(self._queue)} requests), rejecting request of session {session_id}")
+                raise ServerBusyError("LLM request queue is full")
+
+            self._queue[session_id] = LLMRequest(session_id, job, on_failure)
+            self._condition.notify()
+
+            position = len(self._queue) - 1 + (self._running is not None)
+
+        logging.debug(f"LLM request of session {session_id} queued, {position} request(s) ahead")
+        return position
+
+
+    def cancel(self, session_id: str) -> bool:
+        """Discards the waiting request of a session, a running request is left to complete.
+
+        Returns:
+            bool: True if a waiting request was discarded.
+        """
+        with self._condition:
+            return self._queue.pop(session_id, None) is not None
+
+
+    def queue_position(self, session_id: str) -> Optional[int]:
+        """The number of requests that will be served before the request of a session, None if it is not waiting."""
+        with self._condition:
+            for position, queued_session in enumerate(self._queue):
+                if queued_session == session_id:
+                    return position + (self._running is not None)
+        return None
+
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the queue depth and wait time statistics of the scheduler."""
+        with self._condition:
+            return {
+                "queue_depth": len(self._queue),
+                "running": self._running is not None,
+                "served_requests": self.served_requests,
+                "rejected_requests": self.rejected_requests,
+                "average_wait": self.total_wait / self.served_requests if self.served_requests else 0.0,
+                "max_wait": self.max_wait,
+                "last_wait": self.last_wait,
+            }
+
+
+    def _run(self):
+        """Worker loop, waits for the model then runs the queued requests one at a time."""
+        try:
+            self.model = self._load_model()
+            logging.info("LLM model ready, serving requests")
+        except Exception as e:
+            logging.error(f"LLM model unavailable, the scheduler stops: {e}")
+            with self._condition:
+                self.error = str(e)
+            self._fail_waiting(ModelUnavailableError(f"LLM model failed to load: {e}"))
+            return
+
+        try:
+            self._serve()
+        finally:
+            self._fail_waiting(ModelUnavailableError("The LLM scheduler is stopped"))
+
+
+    def _serve(self):
+        """Runs the queued requests one at a time, until the scheduler stops."""
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+
+                _, request = self._queue.popitem(last=False)
+                request.started_at = time.monotonic()
+                self._running = request
+
+                wait = request.started_at - request.enqueued_at
+                self.served_requests += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.last_wait = wait
+            QUEUE_WAIT_SECONDS.observe(wait)
+
+            logging.debug(f"Serving LLM request of session {request.session_id} after {wait:.2f}s in queue")
+
+            try:
+                request.job(self.model)
+            except Exception as e:
+                logging.error(f"Error in LLM request of session {request.session_id}: {e}")
+            finally:
+                with self._condition:
+                    self._running = None
+
+
+    def _fail_waiting(self, error: Exception):
+        """Discards the waiting requests, whose clients are told the request failed."""
+        with self._condition:
+            requests = list(self._queue.values())
+            self._queue.clear()
+
+        for request in requests:
+            if request.on_failure is None:
+                continue
+            try:
+                request.on_failure(error)
+            except Exception as e:
+                logging.error(f"Error while failing the LLM request of session {request.session_id}: {e}")
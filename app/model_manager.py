@@ -0,0 +1,213 @@
+"""
+model_manager.py
+
+Loads the models of the process, which importing the application never does. The components declare their
+models when they are imported or started, with the function loading each one, and `ModelManager.start` loads them
+all in parallel at startup, or leaves each one to load on its first use. A model can run a short inference once loaded,
+so the first request does not pay for the lazy initializations of the inference libraries.
+
+The state of each model is reported on /healthz and /readyz, and a model disabled by the configuration, e.g. the
+speech model of a text-only server, is never loaded.
+"""
+
+import logging
+import threading
+import time
+
+from typing import Any, Callable, Dict, Optional
+
+from .utils.custom_exceptions import ModelUnavailableError
+
+DISABLED = "disabled"
+IDLE = "idle"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+# The models of the application
+LLM = "llm"
+WHISPER = "whisper"
+TTS = "tts"
+
+
+class ManagedModel:
+    """A model of the process and its loading state.
+
+    Attributes:
+        name (str): The name of the model, used in logs and in the readiness report.
+        state (str): One of DISABLED, IDLE (not loaded yet), LOADING, READY and FAILED.
+        instance (Any): The loaded model, None until it is ready.
+        error (Optional[str]): Why the model failed to load.
+        load_seconds (Optional[float]): The time taken to load the model, warm-up included.
+    """
+
+    def __init__(self, name: str, load: Callable[[], Any], warmup: Optional[Callable[[Any], None]] = None,
+                 stop: Optional[Callable[[Any], None]] = None, enabled: bool = True):
+        self.name = name
+        self.load = load
+        self.warmup = warmup
+        self.stop = stop
+        self.state = IDLE if enabled else DISABLED
+        self.instance: Any = None
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.done = threading.Event()
+        if not enabled:
+            self.done.set()
+
+
+class ModelManager:
+    """Loads the declared models, in parallel or on demand, and reports their state."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, ManagedModel] = {}
+        self.lazy = False
+        self.warmup = False
+
+
+    def register(self, name: str, load: Callable[[], Any], warmup: Optional[Callable[[Any], None]] = None,
+                 stop: Optional[Callable[[Any], None]] = None, enabled: bool = True) -> ManagedModel:
+        """Declares a model, without loading it.
+
+        Args:
+            name (str): The name of the model.
+            load (Callable[[], Any]): Loads and returns the model, called on a loader thread. It runs its native work
+                                      with `run_blocking`, so the event loop of a green server is not stalled.
+            warmup (Optional[Callable[[Any], None]]): Runs a short inference with the loaded model.
+            stop (Optional[Callable[[Any], None]]): Releases the loaded model on shutdown.
+            enabled (bool): Whether the model is used by this process, a disabled model is never loaded.
+        """
+        model = ManagedModel(name, load, warmup, stop, enabled)
+        with self._lock:
+            if name in self._models:
+                raise ValueError(f"Model {name} is already registered")
+            self._models[name] = model
+        return model
+
+
+    def start(self, lazy: bool = False, warmup: bool = False):
+        """Starts loading the models.
+
+        Args:
+            lazy (bool): Whether each model is left to load on its first use, instead of all of them now.
+            warmup (bool): Whether each model runs a short inference once loaded.
+        """
+        self.lazy = lazy
+        self.warmup = warmup
+        if lazy:
+            logging.info("Models are loaded on first use")
+            return
+        for name in list(self._models):
+            self.load(name)
+
+
+    def load(self, name: str) -> ManagedModel:
+        """Starts loading a model in the background if it is not loaded or loading yet."""
+        model = self._model(name)
+        with self._lock:
+            if model.state != IDLE:
+                return model
+            model.state = LOADING
+        threading.Thread(target=self._load, args=(model,), name=f"load-{name}", daemon=True).start()
+        return model
+
+
+    def wait(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Waits until a model is loaded, without starting to load it.
+
+        Returns:
+            Any: The loaded model.
+
+        Raises:
+            ModelUnavailableError: If the model is disabled, failed to load, or is not loaded within `timeout` seconds.
+        """
+        model = self._model(name)
+        if not model.done.wait(timeout):
+            raise ModelUnavailableError(f"Model {name} is not loaded yet")
+        if model.state == FAILED:
+            raise ModelUnavailableError(f"Model {name} failed to load: {model.error}")
+        if model.state != READY:
+            raise ModelUnavailableError(f"Model {name} is {model.state}")
+        return model.instance
+
+
+    def get(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Returns a model, loading it first if needed.
+
+        Raises:
+            ModelUnavailableError: If the model is disabled, failed to load, or is not loaded within `timeout` seconds.
+        """
+        self.load(name)
+        return self.wait(name, timeout)
+
+
+    def state(self, name: str) -> str:
+        return self._model(name).state
+
+
+    def enabled(self, name: str) -> bool:
+        return self._model(name).state != DISABLED
+
+
+    def ready(self) -> bool:
+        """Whether every enabled model is loaded, or will load on its first use in lazy mode."""
+        accepted = (READY, IDLE) if self.lazy else (READY,)
+        return all(model.state in accepted for model in self._models.values() if model.state != DISABLED)
+
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the state of each model, with its load time or its error."""
+        report = {}
+        for name, model in list(self._models.items()):
+            entry: Dict[str, Any] = {"state": model.state}
+            if model.load_seconds is not None:
+                entry["load_seconds"] = round(model.load_seconds, 3)
+            if model.error is not None:
+                entry["error"] = model.error
+            report[name] = entry
+        return report
+
+
+    def stop(self, name: str):
+        """Releases a loaded model, e.g. stops its worker threads."""
+        model = self._model(name)
+        if model.state == READY and model.stop is not None:
+            model.stop(model.instance)
+
+
+    def _model(self, name: str) -> ManagedModel:
+        try:
+            return self._models[name]
+        except KeyError:
+            raise ModelUnavailableError(f"Unknown model {name}") from None
+
+
+    def _load(self, model: ManagedModel):
+        """Loader thread, loads the model then warms it up if enabled."""
+        start = time.monotonic()
+        logging.info(f"Loading model {model.name}")
+        try:
+            instance = model.load()
+        except Exception as e:
+            logging.error(f"Failed to load model {model.name}: {e}")
+            model.error = str(e)
+            model.state = FAILED
+        else:
+            if self.warmup and model.warmup is not None:
+                # A failed warm-up only means the first request is slower
+                try:
+                    warmup_start = time.monotonic()
+                    model.warmup(instance)
+                    logging.info(f"Model {model.name} warmed up in {time.monotonic() - warmup_start:.1f}s")
+                except Exception as e:
+                    logging.warning(f"Warm-up of model {model.name} failed: {e}")
+            model.instance = instance
+            model.load_seconds = time.monotonic() - start
+            model.state = READY
+            logging.info(f"Model {model.name} ready in {model.load_seconds:.1f}s")
+        finally:
+            model.done.set()
+
+# The models of the process
+models = ModelManager()
@@ -1,7 +1,42 @@
-from flask import render_template
+from flask import Response, jsonify, render_template
+
+from .lifecycle import is_shutting_down
+from .model_manager import models
+from .utils.metrics import REGISTRY, CONTENT_TYPE
 
 def setup_routes(app):
 
     @app.route('/')
     def index():
         return render_template('index.html')
+
+
+def setup_metrics_route(app):
+    """Serves the metrics of the pipeline stages in the Prometheus text format, also in headless mode."""
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def setup_health_routes(app):
+    """Serves the liveness and readiness probes, also in headless mode.
+
+    /healthz answers as long as the process serves requests. /readyz answers 200 once every model of the process
+    is loaded, or will load on first use in lazy mode, and 503 while they load, if one failed, or on shutdown.
+    Both report the state of each model.
+    """
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify(status="ok", models=models.status())
+
+    @app.route('/readyz')
+    def readyz():
+        if is_shutting_down():
+            status = "shutting down"
+        elif models.ready():
+            status = "ready"
+        else:
+            status = "not ready"
+        return jsonify(status=status, models=models.status()), 200 if status == "ready" else 503
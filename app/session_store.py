@@ -0,0 +1,249 @@
+"""
+session_store.py
+
+Keeps the state of the connected sessions: their transcription manager, their conversation and the temporary
+folder they share. The store bounds the number of sessions and the memory of their histories and audio buffers,
+closes the sessions left idle, and closes the least recently active sessions when the memory budget is exceeded.
+A closed session always has its resources released and its temporary folder removed.
+"""
+
+import logging
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .audio_processing import AudioTranscriptionManager
+    from .text_processing import Conversation
+
+# Default time between two sweeps of the idle sessions, in seconds
+DEFAULT_SWEEP_INTERVAL = 30.0
+
+EVICTED_IDLE = "idle"
+EVICTED_MEMORY = "memory"
+
+
+class Session:
+    """The state of a connected client.
+
+    Attributes:
+        session_id (str): The Socket.IO session ID.
+        transcription_manager (AudioTranscriptionManager): The audio transcription of the session.
+        conversation (Conversation): The conversation of the session.
+        temp_folder (tempfile.TemporaryDirectory): The temporary folder of the session, removed when it closes.
+        created_at (float): The monotonic time the session was created at.
+        last_active (float): The monotonic time of the last event of the session.
+    """
+
+    def __init__(self, session_id: str, transcription_manager: "AudioTranscriptionManager", conversation: "Conversation",
+                 temp_folder: tempfile.TemporaryDirectory, now: float):
+        self.session_id = session_id
+        self.transcription_manager = transcription_manager
+        self.conversation = conversation
+        self.temp_folder = temp_folder
+        self.created_at = now
+        self.last_active = now
+
+
+    def memory_bytes(self) -> int:
+        """The memory held by the history and the audio buffer of the session, in bytes."""
+        return self.conversation.history_bytes + self.transcription_manager.buffered_bytes
+
+
+    def close(self):
+        """Stops the audio decoder of the session and removes its temporary folder."""
+        try:
+            self.transcription_manager.renew()
+        finally:
+            self.temp_folder.cleanup()
+
+
+class SessionStore:
+    """The sessions of the connected clients, ordered from the least to the most recently active.
+
+    Attributes:
+        idle_timeout (Optional[float]): The inactivity after which a session is closed, in seconds, None to keep it.
+        max_sessions (Optional[int]): The maximum number of sessions, None for no limit.
+        memory_capacity_bytes (Optional[int]): The memory budget of the sessions, None for no limit.
+        evicted_idle (int): The number of sessions closed for inactivity.
+        evicted_memory (int): The number of sessions closed to stay within the memory budget.
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = None, max_sessions: Optional[int] = None,
+                 memory_capacity_bytes: Optional[int] = None,
+                 on_close: Optional[Callable[[Session], None]] = None,
+                 on_evict: Optional[Callable[[Session, str], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """Initializes the store, the sweeps are only started by `start`.
+
+        Args:
+            idle_timeout (Optional[float]): The inactivity after which a session is closed, in seconds.
+            max_sessions (Optional[int]): The maximum number of sessions.
+            memory_capacity_bytes (Optional[int]): The memory budget of the sessions, in bytes.
+            on_close (Optional[Callable[[Session], None]]): Releases the resources other components hold for a
+                                                           session, called before the session is closed.
+            on_evict (Optional[Callable[[Session, str], None]]): Notifies the client of a session closed by the
+                                                                store, with the reason, e.g. to disconnect it.
+            clock (Callable[[], float]): The time source.
+        """
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.memory_capacity_bytes = memory_capacity_bytes
+        self._on_close = on_close
+        self._on_evict = on_evict
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+        self.evicted_idle = 0
+        self.evicted_memory = 0
+
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+    @property
+    def full(self) -> bool:
+        """Whether the maximum number of sessions is reached, new clients are then refused."""
+        return self.max_sessions is not None and len(self._sessions) >= self.max_sessions
+
+
+    def open(self, session_id: str, transcription_manager: "AudioTranscriptionManager", conversation: "Conversation",
+             temp_folder: tempfile.TemporaryDirectory) -> Session:
+        """Adds the session of a new client, replacing a session with the same ID."""
+        session = Session(session_id, transcription_manager, conversation, temp_folder, self._clock())
+        with self._lock:
+            replaced = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = session
+        if replaced is not None:
+            self._close(replaced)
+        return session
+
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Returns a session and marks it as active, None if it is closed."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_active = self._clock()
+                self._sessions.move_to_end(session_id)
+        return session
+
+
+    def close(self, session_id: str) -> bool:
+        """Closes a session, e.g. when its client disconnects.
+
+        Returns:
+            bool: True if the session was open.
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._close(session)
+        return True
+
+
+    def close_all(self):
+        """Closes every session, e.g. on shutdown."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            self._close(session)
+
+
+    def sweep(self) -> List[Session]:
+        """Closes the idle sessions, then the least recently active ones while the memory budget is exceeded.
+
+        Returns:
+            List[Session]: The closed sessions.
+        """
+        now = self._clock()
+        evicted: List[Tuple[Session, str]] = []
+
+        with self._lock:
+            if self.idle_timeout is not None:
+                for session in list(self._sessions.values()):
+                    # The sessions are ordered by activity, the first active one ends the idle sessions
+                    if now - session.last_active < self.idle_timeout:
+                        break
+                    del self._sessions[session.session_id]
+                    evicted.append((session, EVICTED_IDLE))
+                    self.evicted_idle += 1
+
+            if self.memory_capacity_bytes is not None:
+                sizes = {session_id: session.memory_bytes() for session_id, session in self._sessions.items()}
+                total = sum(sizes.values())
+                # The most recently active session is always kept
+                while total > self.memory_capacity_bytes and len(self._sessions) > 1:
+                    session_id, session = self._sessions.popitem(last=False)
+                    total -= sizes[session_id]
+                    evicted.append((session, EVICTED_MEMORY))
+                    self.evicted_memory += 1
+
+        for session, reason in evicted:
+            logging.info(f"Closing session {session.session_id}, evicted ({reason})")
+            if self._on_evict is not None:
+                try:
+                    self._on_evict(session, reason)
+                except Exception as e:
+                    logging.error(f"Error while notifying the eviction of session {session.session_id}: {e}")
+            self._close(session)
+
+        return [session for session, _ in evicted]
+
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number of live sessions, their memory and the eviction counters."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "memory_bytes": sum(session.memory_bytes() for session in sessions),
+            "evicted_idle": self.evicted_idle,
+            "evicted_memory": self.evicted_memory,
+        }
+
+
+    def start(self, sweep_interval: float = DEFAULT_SWEEP_INTERVAL):
+        """Starts the background sweeps."""
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._run, args=(sweep_interval,), name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+
+    def stop(self):
+        """Stops the background sweeps and closes every session."""
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+        self.close_all()
+
+
+    def _run(self, sweep_interval: float):
+        while not self._stop.wait(sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error while sweeping the sessions: {e}")
+
+
+    def _close(self, session: Session):
+        try:
+            if self._on_close is not None:
+                self._on_close(session)
+        except Exception as e:
+            logging.error(f"Error while releasing session {session.session_id}: {e}")
+        try:
+            session.close()
+        except Exception as e:
+            logging.error(f"Error while closing session {session.session_id}: {e}")
@@ -7,33 +7,104 @@ audio processing and text conversation handling.
 
 import logging
 import tempfile
-from typing import Dict, Tuple, Any
+from typing import Any
 
 from flask import request
 from . import socketio
-from .audio_processing import AudioTranscriptionManager, process_transcription
-from .text_processing import Conversation
-from .utils import generate_filename, save_data_to_file, convert_audio_data
-from .utils.custom_exceptions import MissingPackageError
+from .audio_processing import AudioTranscriptionManager, process_transcription, process_audio_end, cancel_transcription
+from .audio_processing import process_upload_start, process_upload_commit
+from .text_processing import Conversation, discard_session, tts_worker
+from .utils.custom_exceptions import MissingPackageError, ModelUnavailableError, UploadError
+from .utils.metrics import Counter, Gauge
+from .session_store import Session, SessionStore
+from .upload_store import Upload, UploadStore
+from .config import get_config
+from .lifecycle import is_shutting_down, on_shutdown, on_startup
 
 from .datatypes import Message
 
-# Dictionary to manage session states and associated objects for each client.
-session_managers: Dict[str, Tuple[AudioTranscriptionManager, Conversation]] = {}
+# Time a client waits before sending a chunk again when the transcription of its upload is behind, in seconds
+UPLOAD_RETRY_SECONDS = 1.0
+
+EVICTION_MESSAGES = {
+    "idle": "Your session was closed after a long inactivity, reload the page to start a new conversation.",
+    "memory": "Your session was closed as the server is short of memory, reload the page to start a new conversation.",
+}
+
+
+def release_session(session: Session):
+    """Releases the work and the cached state other components hold for a closing session."""
+    cancel_transcription(session.session_id)
+    discard_session(session.session_id)
+    tts_worker.cancel(session.session_id)
+
+
+def disconnect_evicted_session(session: Session, reason: str):
+    """Tells the client of a session closed by the store why, then disconnects it."""
+    message = Message("error", EVICTION_MESSAGES.get(reason, "Your session was closed."))
+    socketio.emit('message', {"message_id": str(message.id), "sender": message.emitter, "content": message.content},
+                  to=session.session_id)
+    socketio.server.disconnect(session.session_id, namespace='/')
+
+
+# The state of each client, its transcription manager and conversation, with their temporary folder.
+server_config = get_config().server
+session_store = SessionStore(idle_timeout=server_config.session_idle_timeout,
+                             max_sessions=server_config.max_connections,
+                             memory_capacity_bytes=server_config.session_memory_bytes,
+                             on_close=release_session,
+                             on_evict=disconnect_evicted_session)
+
+Gauge("chronos_active_sessions", "Connected sessions", function=lambda: len(session_store))
+Gauge("chronos_session_memory_bytes", "Memory held by the histories and audio buffers of the sessions",
+      function=lambda: session_store.stats()["memory_bytes"])
+Counter("chronos_evicted_sessions_idle_total", "Sessions closed for inactivity", function=lambda: session_store.evicted_idle)
+Counter("chronos_evicted_sessions_memory_total", "Sessions closed to stay within the memory budget",
+        function=lambda: session_store.evicted_memory)
+
+# The chunked uploads outlive the connection which started them, so the client can resume them after a reconnect
+upload_store = UploadStore(directory=server_config.upload_dir,
+                           chunk_bytes=server_config.upload_chunk_bytes,
+                           max_bytes=server_config.upload_max_bytes,
+                           resume_timeout=server_config.upload_resume_timeout)
+
+Gauge("chronos_active_uploads", "Uploads in progress or being transcribed", function=lambda: len(upload_store))
+Gauge("chronos_upload_disk_bytes", "Disk space held by the uploaded files", function=lambda: upload_store.stats()["disk_bytes"])
+Counter("chronos_uploaded_bytes_total", "Bytes received in upload chunks", function=lambda: upload_store.received_bytes)
+Counter("chronos_expired_uploads_total", "Uploads dropped as they were not resumed in time", function=lambda: upload_store.expired)
+
+
+def start_stores():
+    """Starts the sweeps of the sessions and of the uploads, when the server starts."""
+    session_store.start(server_config.session_sweep_interval)
+    upload_store.start(server_config.session_sweep_interval)
+    # The sessions are closed once the running answers and transcriptions are complete
+    on_shutdown("session store", session_store.stop, last=True)
+    on_shutdown("upload store", upload_store.stop, last=True)
+
+on_startup("session and upload stores", start_stores)
+
 
 @socketio.on('connect')
 def handle_connect():
     """Handle a new client connection by initializing session managers."""
 
     session_id = request.sid  # type:ignore
+
+    # Refusing the connection here is cheaper than serving a client the server cannot keep up with
+    if is_shutting_down() or session_store.full:
+        logging.warning(f"Refusing connection {session_id}, {len(session_store)} clients connected")
+        return False
+
+    # Both managers share the temporary folder, which is removed when the session closes
     temp_folder = tempfile.TemporaryDirectory()
 
-    session_managers[session_id] = (AudioTranscriptionManager(temp_folder, session_id=session_id), Conversation(session_id=session_id))
+    session_store.open(session_id, AudioTranscriptionManager(temp_folder, session_id=session_id),
+                       Conversation(temp_folder, session_id=session_id), temp_folder)
 
     starting_message = Message("info", """Welcome to Chronos Chat, don't hesitate to ask us any question,
-                  we inform you that the real time transcription functionality is only available for 
-                  30s speech, if you need to talk for more than 30s, please toggle the "disable real time transcription"
-                  button at the bottom of the window. Click this message to dismiss it.""")
+                  you can type your message or record it with the microphone button, the transcription
+                  will appear in real time in the input field. Click this message to dismiss it.""")
 
     starting_message_dict = {
                 "message_id": str(starting_message.id),
@@ -48,9 +119,8 @@ def handle_connect():
 def handle_disconnect():
     """Handle client disconnection by cleaning up resources."""
     session_id = request.sid  # type: ignore
-    if session_id in session_managers:
-        audio_transcription_manager, _ = session_managers.pop(session_id)
-        audio_transcription_manager.renew()  # Cleanup
+    # Releases the session and removes its temporary folder. Nothing to do for a connection that was refused, or for a session already closed by the store
+    session_store.close(session_id)
 
 
 @socketio.on('audio_chunk')
@@ -61,17 +131,15 @@ def handle_audio_chunk(received_data: Any):
         received_data (bytes): The received audio data.
     """
     session_id = request.sid  # type: ignore
-    transcription_manager, _ = session_managers.get(session_id, (None, None))
+    session = session_store.get(session_id)
+    transcription_manager = session.transcription_manager if session else None
 
     if not isinstance(transcription_manager, AudioTranscriptionManager):
         logging.error(f"Session manager not found for session ID: {session_id}")
         return
 
-    filename = generate_filename(transcription_manager.temp_folder_name)
-    save_data_to_file(received_data, filename)
-
     try:
-        process_transcription(filename, transcription_manager, session_id)
+        process_transcription(received_data, transcription_manager, session_id)
     except MissingPackageError:
         forwarded_message = Message("error", "Missing package, audio transcription not available")
 
@@ -82,6 +150,30 @@ def handle_audio_chunk(received_data: Any):
         }
 
         socketio.emit('message', forwarded_message_dict, to=session_id)
+    except ModelUnavailableError:
+        forwarded_message = Message("error", "Audio transcription is not available on this server")
+
+        forwarded_message_dict = {
+            "message_id": str(forwarded_message.id),
+            "sender" : forwarded_message.emitter,
+            "content": forwarded_message.content
+        }
+
+        socketio.emit('message', forwarded_message_dict, to=session_id)
+
+
+@socketio.on('audio_stop')
+def handle_audio_stop():
+    """Handle the end of a live recording, sent by a client once its last audio chunk is sent."""
+    session_id = request.sid  # type: ignore
+    session = session_store.get(session_id)
+    transcription_manager = session.transcription_manager if session else None
+
+    if not isinstance(transcription_manager, AudioTranscriptionManager):
+        logging.error(f"Session manager not found for session ID: {session_id}")
+        return
+
+    process_audio_end(transcription_manager, session_id)
 
 
 @socketio.on('audio_file')
@@ -92,19 +184,15 @@ def handle_audio_file(received_data: Any):
         received_data (bytes): The received audio file
     """
     session_id = request.sid  # type: ignore
-    transcription_manager, _ = session_managers.get(session_id, (None, None))
+    session = session_store.get(session_id)
+    transcription_manager = session.transcription_manager if session else None
 
     if not isinstance(transcription_manager, AudioTranscriptionManager):
         logging.error(f"Session manager not found for session ID: {session_id}")
         return
 
-    origin = generate_filename(transcription_manager.temp_folder_name, extension="wav")
-    filename = generate_filename(transcription_manager.temp_folder_name)
-    save_data_to_file(received_data, origin)
-    convert_audio_data(origin = origin, destination = filename)
-
     try:
-        process_transcription(filename, transcription_manager, session_id, timeout=120)
+        process_transcription(received_data, transcription_manager, session_id, streaming=False)
     except MissingPackageError:
         forwarded_message = Message("error", "Missing package, audio transcription not available")
 
@@ -115,6 +203,139 @@ def handle_audio_file(received_data: Any):
         }
 
         socketio.emit('message', forwarded_message_dict, to=session_id)
+    except ModelUnavailableError:
+        forwarded_message = Message("error", "Audio transcription is not available on this server")
+
+        forwarded_message_dict = {
+            "message_id": str(forwarded_message.id),
+            "sender" : forwarded_message.emitter,
+            "content": forwarded_message.content
+        }
+
+        socketio.emit('message', forwarded_message_dict, to=session_id)
+
+
+def upload_acknowledgment(upload: Upload) -> dict:
+    """The state of an upload sent back to the client, which continues from `next_index`."""
+    return {"upload_id": upload.upload_id, "chunk_size": upload_store.chunk_bytes,
+            "next_index": upload.next_index, "received": upload.received}
+
+
+@socketio.on('upload_start')
+def handle_upload_start(received_data: Any):
+    """Start, or resume after a reconnect, the chunked upload of an audio file.
+
+    A new upload is described by the 'name' and 'size' of the file, an interrupted one by its 'upload_id'.
+    The chunks are then sent in order with 'upload_chunk', from 'next_index', and the transcription of the file
+    starts with the first chunks.
+
+    Args:
+        received_data (dict): The description of the file, or the ID of the upload to resume.
+
+    Returns:
+        dict: The acknowledgment, with the 'upload_id', the 'chunk_size' and the 'next_index' to send, or an 'error'.
+    """
+    session_id = request.sid  # type: ignore
+    if session_store.get(session_id) is None or not isinstance(received_data, dict):
+        return {"error": "Invalid upload request"}
+
+    try:
+        if received_data.get("upload_id"):
+            upload = upload_store.resume(str(received_data["upload_id"]), session_id)
+        else:
+            upload = process_upload_start(upload_store, session_id, str(received_data.get("name", "")),
+                                          int(received_data.get("size", 0)))
+    except (UploadError, TypeError, ValueError) as e:
+        return {"error": str(e)}
+    except MissingPackageError:
+        return {"error": "Missing package, audio transcription not available"}
+    except ModelUnavailableError:
+        return {"error": "Audio transcription is not available on this server"}
+
+    return upload_acknowledgment(upload)
+
+
+@socketio.on('upload_chunk')
+def handle_upload_chunk(received_data: Any):
+    """Write the next chunk of an upload.
+
+    When the transcription of the file is behind, the chunk is not written and the client sends it again after
+    'retry_after' seconds, so the audio waiting for transcription stays bounded.
+
+    Args:
+        received_data (dict): The 'upload_id', the 'index' of the chunk, its binary 'data' and its 'sha256' digest.
+
+    Returns:
+        dict: The acknowledgment, with the 'next_index' to send, or an 'error'.
+    """
+    session_id = request.sid  # type: ignore
+    if session_store.get(session_id) is None or not isinstance(received_data, dict):
+        return {"error": "Invalid upload chunk"}
+
+    try:
+        upload_id, data = str(received_data.get("upload_id")), received_data.get("data")
+        if not isinstance(data, (bytes, bytearray)):
+            raise UploadError("The data of a chunk must be binary")
+
+        upload = upload_store.get(upload_id, session_id)
+        if upload.transcription is not None and upload.transcription.backlogged:
+            return dict(upload_acknowledgment(upload), retry_after=UPLOAD_RETRY_SECONDS)
+
+        upload = upload_store.write(upload_id, session_id, int(received_data.get("index", -1)), bytes(data),
+                                    str(received_data.get("sha256", "")))
+    except (UploadError, TypeError, ValueError) as e:
+        return {"error": str(e)}
+
+    return upload_acknowledgment(upload)
+
+
+@socketio.on('upload_commit')
+def handle_upload_commit(received_data: Any):
+    """Complete an upload once its last chunk is acknowledged, its checksum is verified before it is transcribed.
+
+    Args:
+        received_data (dict): The 'upload_id' of the upload and the 'sha256' digest of the file, the digest of the
+                              digests of its chunks.
+
+    Returns:
+        dict: The acknowledgment, {'committed': True} or an 'error'. The transcription follows on the
+              'transcription' channel.
+    """
+    session_id = request.sid  # type: ignore
+    if session_store.get(session_id) is None or not isinstance(received_data, dict):
+        return {"error": "Invalid upload commit"}
+
+    upload_id = str(received_data.get("upload_id"))
+    try:
+        if upload_store.commit(upload_id, session_id, str(received_data.get("sha256", ""))):
+            process_upload_commit(upload_store, upload_store.get(upload_id, session_id))
+    except UploadError as e:
+        return {"error": str(e)}
+
+    return {"committed": True}
+
+
+@socketio.on('upload_abort')
+def handle_upload_abort(received_data: Any):
+    """Abandon an upload, its file is removed and its transcription stopped.
+
+    Args:
+        received_data (dict): The 'upload_id' of the upload.
+
+    Returns:
+        dict: The acknowledgment, {'aborted': True} or an 'error'.
+    """
+    session_id = request.sid  # type: ignore
+    if session_store.get(session_id) is None or not isinstance(received_data, dict):
+        return {"error": "Invalid upload abort"}
+
+    try:
+        upload = upload_store.get(str(received_data.get("upload_id")), session_id)
+    except UploadError as e:
+        return {"error": str(e)}
+    upload_store.discard(upload.upload_id)
+
+    return {"aborted": True}
 
 
 @socketio.on('user_message')
@@ -125,13 +346,13 @@ def handle_text_message(received_data: Any):
         received_data: The text data received from the user.
     """
     session_id = request.sid # type:ignore
-    managers = session_managers.get(session_id)
+    session = session_store.get(session_id)
 
-    if not managers:
+    if not session:
         logging.error(f"No session managers found for session ID: {session_id}")
         return
 
-    transcription_manager, conversation_manager = managers
+    transcription_manager, conversation_manager = session.transcription_manager, session.conversation
 
     if not isinstance(transcription_manager, AudioTranscriptionManager):
         logging.error(f"Invalid audio transcription manager for session ID: {session_id}")
@@ -144,9 +365,13 @@ def handle_text_message(received_data: Any):
 
     logging.debug(f"Received message data: {received_data}")
 
-    # Send message to conversation manager, receive response
+    # Send message to conversation manager, the response is streamed once the request is served
     code, message = conversation_manager.reception(received_data)
 
+    if message is None:
+        logging.debug(f"LLM request queued for session {session_id}")
+        return
+
     response = {
                 "message_id": str(message.id),
                 "sender" : message.emitter,
@@ -155,7 +380,7 @@ def handle_text_message(received_data: Any):
 
     socketio.emit('message', response, to=session_id)
 
-    if code != 200:
+    if code != 202:
         logging.debug(f"Error {code}: {response}")
     else:
-        logging.debug(f"LLM response built: {response}")
+        logging.debug(f"LLM request queued: {response}")
@@ -2,7 +2,6 @@ document.addEventListener('DOMContentLoaded', () => {
     const recordButton = document.getElementById('recordButton');
     const sendButton = document.getElementById('sendButton')
     let mediaRecorder;
-    let chunkInterval
     let audioChunks = [];
     let audioQueue = [];
     let isRecording = false;
@@ -14,6 +13,7 @@ document.addEventListener('DOMContentLoaded', () => {
     changeAudioModeButton.addEventListener('click', toggleAudioMode);
 
     const chatInput = document.getElementById('chatInput');
+    const tentativeTranscription = document.getElementById('tentativeTranscription');
 
     // Send button click event
     sendButton.addEventListener('click', sendMessage);
@@ -65,8 +65,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // Handle Accept
             $('.acceptButton').click(function() {
-                socket.emit('audio_file', file);
-                console.log('File sent:', fileName);
+                uploadFile(file)
+                    .then(() => console.log('File sent:', fileName))
+                    .catch(err => displayMessage('error', `The upload of ${fileName} failed: ${err.message}`));
 
                 // Hide the selection details and reset the file input
                 $('#fileSelectionDetails').addClass('hidden');
@@ -84,6 +85,111 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Files are sent in numbered chunks, each one acknowledged by the server, so a large recording never has to fit
+    // in a single message, and an upload interrupted by a reconnect resumes from the last chunk the server received
+    const UPLOAD_ACK_TIMEOUT = 30000;
+    const UPLOAD_MAX_RETRIES = 5;
+
+    function toHex(digest) {
+        return Array.from(digest, byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    // Each chunk is sent with its SHA-256 digest, and the file is verified on commit against the digest of the
+    // digests of its chunks, so the file is hashed a chunk at a time, as it is read, instead of all at once
+    async function readChunk(upload, index) {
+        const start = index * upload.chunkSize;
+        const data = await upload.file.slice(start, start + upload.chunkSize).arrayBuffer();
+        upload.digests[index] = new Uint8Array(await crypto.subtle.digest('SHA-256', data));
+        return data;
+    }
+
+    async function fileDigest(upload) {
+        const count = Math.ceil(upload.file.size / upload.chunkSize);
+        const digests = new Uint8Array(count * 32);
+        for (let index = 0; index < count; index++) {
+            // A chunk whose acknowledgment was lost in a reconnect was skipped on resume, its digest is still missing
+            if (!upload.digests[index]) {
+                await readChunk(upload, index);
+            }
+            digests.set(upload.digests[index], index * 32);
+        }
+        return toHex(new Uint8Array(await crypto.subtle.digest('SHA-256', digests)));
+    }
+
+    async function uploadFile(file) {
+        const ack = await socket.timeout(UPLOAD_ACK_TIMEOUT).emitWithAck('upload_start', { name: file.name, size: file.size });
+        if (ack.error) {
+            throw new Error(ack.error);
+        }
+        const upload = { file: file, id: ack.upload_id, chunkSize: ack.chunk_size, nextIndex: ack.next_index, retries: 0, digests: [] };
+
+        while (upload.nextIndex * upload.chunkSize < file.size) {
+            const data = await readChunk(upload, upload.nextIndex);
+            let chunkAck;
+            try {
+                chunkAck = await socket.timeout(UPLOAD_ACK_TIMEOUT).emitWithAck('upload_chunk', {
+                    upload_id: upload.id, index: upload.nextIndex, data: data, sha256: toHex(upload.digests[upload.nextIndex])
+                });
+            } catch (err) {
+                // No acknowledgment, the connection was probably lost
+                await resumeUpload(upload);
+                continue;
+            }
+            if (chunkAck.error) {
+                throw new Error(chunkAck.error);
+            }
+            if (chunkAck.retry_after) {
+                // The transcription of the file is behind, the same chunk is sent again later
+                await new Promise(resolve => setTimeout(resolve, chunkAck.retry_after * 1000));
+                continue;
+            }
+            upload.nextIndex = chunkAck.next_index;
+            upload.retries = 0;
+            console.log(`Uploaded ${Math.round(100 * chunkAck.received / file.size)}% of ${file.name}`);
+        }
+
+        const sha256 = await fileDigest(upload);
+        while (true) {
+            try {
+                const commitAck = await socket.timeout(UPLOAD_ACK_TIMEOUT).emitWithAck('upload_commit', { upload_id: upload.id, sha256: sha256 });
+                if (commitAck.error) {
+                    throw new Error(commitAck.error);
+                }
+                return;
+            } catch (err) {
+                if (!(err instanceof Error) || err.message !== 'operation has timed out') {
+                    throw err;
+                }
+                // Committing twice is harmless, the server only transcribes the file once
+                await resumeUpload(upload);
+            }
+        }
+    }
+
+    async function resumeUpload(upload) {
+        while (true) {
+            if (++upload.retries > UPLOAD_MAX_RETRIES) {
+                throw new Error('the server does not answer');
+            }
+            if (!socket.connected) {
+                await new Promise(resolve => socket.once('connect', resolve));
+            }
+            try {
+                const ack = await socket.timeout(UPLOAD_ACK_TIMEOUT).emitWithAck('upload_start', { upload_id: upload.id });
+                if (ack.error) {
+                    throw new Error(ack.error);
+                }
+                upload.nextIndex = ack.next_index;
+                console.log(`Resuming the upload of ${upload.file.name} from chunk ${upload.nextIndex}`);
+                return;
+            } catch (err) {
+                if (!(err instanceof Error) || err.message !== 'operation has timed out') {
+                    throw err;
+                }
+            }
+        }
+    }
+
     function toggleAudioMode() { // Switch the mode
         if (!isRecording) {
             if (currentMode === 'real-time') {
@@ -106,23 +212,22 @@ document.addEventListener('DOMContentLoaded', () => {
 
             console.log("Recording started");
 
-            mediaRecorder.ondataavailable = event => {
-                console.log(`Chunk received: size = ${event.data.size}, type = ${event.data.type}`);
-                audioChunks.push(event.data);
-            };
-            mediaRecorder.start();
-
             if (currentMode == 'real-time') {
-                chunkInterval = setInterval(() => {
-                    if (audioChunks.length > 0) {
-                        const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-                        socket.emit('audio_chunk', audioBlob);
-                        console.log(`Emitting audio blob: size = ${audioBlob.size}, type = ${audioBlob.type}`);
+                // A single continuous recording, each timeslice is sent as soon as it is available
+                // and decoded server side as the continuation of the same stream
+                mediaRecorder.ondataavailable = event => {
+                    console.log(`Chunk received: size = ${event.data.size}, type = ${event.data.type}`);
+                    if (event.data.size > 0) {
+                        socket.emit('audio_chunk', event.data);
                     }
-                    audioChunks = [];
-                    mediaRecorder.stop();
-                    mediaRecorder.start();
-                }, 3000);
+                };
+                mediaRecorder.start(3000);
+            } else {
+                mediaRecorder.ondataavailable = event => {
+                    console.log(`Chunk received: size = ${event.data.size}, type = ${event.data.type}`);
+                    audioChunks.push(event.data);
+                };
+                mediaRecorder.start();
             }
 
             isRecording = true;
@@ -140,24 +245,23 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function stopRecording() {
 
-        if (typeof chunkInterval !== 'undefined') {
-            clearInterval(chunkInterval);
-        }
-
         if (mediaRecorder) {
             // Attach an event listener for the final ondataavailable event
             mediaRecorder.ondataavailable = event => {
                 if (event.data.size > 0) {
                     audioChunks.push(event.data);
-                    const finalAudioBlob = new Blob(audioChunks, { type: 'audio/webm' });
+                    const finalAudioBlob = new Blob(audioChunks, { type: event.data.type });
                     socket.emit('audio_chunk', finalAudioBlob);
                     console.log(`Final audio blob emitted: size = ${finalAudioBlob.size}, type = ${finalAudioBlob.type}`);
                     // Clear the audioChunks array after processing the final blob
                     audioChunks = [];
                 }
+                // Let the server flush the decoder and finalize the transcription
+                socket.emit('audio_stop');
             };
             // Stop the media recorder to trigger the final ondataavailable event
             mediaRecorder.stop();
+            mediaRecorder.stream.getTracks().forEach(track => track.stop());
         }
 
         console.log("Recording stopped");
@@ -227,11 +331,17 @@ document.addEventListener('DOMContentLoaded', () => {
     function sendMessage() {
         var message = chatInput.value.trim();
         if (message) {
+            // Sending the message ends the recording, the server resets the transcription
+            if (isRecording) {
+                stopRecording();
+            }
+
             // Append the message to chatMessages div
             displayMessage("user", message)
 
             // Reset the input field
             chatInput.value = '';
+            showTentativeTranscription('');
 
             // Scroll to the bottom of the chat
 
@@ -245,10 +355,12 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!isPlaying && audioQueue.length > 0) {
             isPlaying = true;
 
-            var audio = new Audio(audioQueue.shift()); // Removes the first element from the queue and plays it
+            var audioUrl = audioQueue.shift(); // Removes the first element from the queue and plays it
+            var audio = new Audio(audioUrl);
             audio.play();
 
-            audio.onended = function() {
+            audio.onended = audio.onerror = function() {
+                URL.revokeObjectURL(audioUrl);
                 isPlaying = false;
                 playNextInQueue(); // Play next audio after the current one ends
             };
@@ -265,6 +377,11 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function showTentativeTranscription(text) {
+        tentativeTranscription.textContent = text;
+        tentativeTranscription.classList.toggle('hidden', !text);
+    }
+
     function adjustTextareaHeight(textarea) {
         textarea.style.height = 'auto';
         textarea.style.height = textarea.scrollHeight + 'px';
@@ -275,8 +392,15 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('transcription', data => {
-        // Update the transcription result on the page
-        chatInput.value = data.text;
+        if (data.final) {
+            // The utterance ended, its whole transcription will not change anymore
+            chatInput.value = data.text;
+            showTentativeTranscription('');
+        } else {
+            // Only the committed words go to the input, the tentative ones are greyed out under it
+            chatInput.value = data.stable;
+            showTentativeTranscription(data.tentative);
+        }
         adjustTextareaHeight(chatInput)
         console.log(data.text)
     });
@@ -295,8 +419,10 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('speech_file', function(data) {
-        console.log('Received audio stream', data);
-        audioQueue.push('data:audio/mp3;base64,' + data.audio);
+        // The audio of each sentence arrives as a binary attachment, in the order of the answer
+        console.log(`Received speech of message ${data.message_id}, sentence ${data.sequence}`);
+        const audioBlob = new Blob([data.audio], { type: data.mime });
+        audioQueue.push(URL.createObjectURL(audioBlob));
         playNextInQueue();
     });
 });
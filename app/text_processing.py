@@ -5,62 +5,156 @@ This module handles the processing of text using the Llama model. It includes fu
 refactoring, conversation management, and interaction with the Llama language model.
 """
 
+import os
 import logging
-import threading
 import tempfile
+import time
 import re
 
-from .utils import load_text_model, TextToSpeechConverter
-from typing import Tuple, Optional
+from .utils import SPEECH_MIME_TYPES
+from .utils.custom_exceptions import ServerBusyError, RequestInFlightError, ModelUnavailableError
+from typing import List, Tuple, Optional
 from .socket_routes import socketio
+from .llm_scheduler import LLMScheduler
+from .inference import TextGenerator, load_text_generator, warm_up_text_generator, wait_for_inference_workers
+from .inference import get_inference_clients, route
+from .model_manager import models, LLM, TTS, DISABLED, FAILED, READY
+from .prompts import DEFAULT_TEMPLATE, USER_PROMPT, SUMMARY_PROMPT
+from .utils.prompt_cache import PromptStateCache
+from .utils.speech_cache import SpeechCache
+from .utils.sentence_segmenter import SentenceSegmenter
+from .utils.stream_coalescer import StreamCoalescer
+from .utils.metrics import Counter, Gauge, Histogram, RATE_BUCKETS
+from .tts_worker import TTSWorker, SpeechResult
+from .config import get_config
+from .lifecycle import on_shutdown, on_startup
 
 from .datatypes import Message
 
-# We're loading the model at the beginning,
-# it would probably be better to work another way
-
-
-# Initialize a condition variable
-model_ready_condition = threading.Condition()
-llm = None
-
-def load_model_in_background():
-    global llm
-    logging.info("Loading model in background, this might take a while")
-    with model_ready_condition:
-        llm = load_text_model()
-        model_ready_condition.notify_all()  # Notify all waiting threads that model is ready
-
-# Load model in a separate thread
-model_loading_thread = threading.Thread(target=load_model_in_background)
-model_loading_thread.start()
+llama_config = get_config().llama
+
+# Maximum number of tokens of the conversation history sent to the model, the system template excluded
+HISTORY_TOKEN_BUDGET = llama_config.history_token_budget
+# When the budget is exceeded, the history is cut down to this share of it. Dropping several turns at once
+# keeps the prompt prefix stable for the next turns, so their cached context state can be reused.
+HISTORY_TRIM_RATIO = 0.75
+# The summary of the dropped turns keeps the beginning of their last few questions
+SUMMARY_MAX_QUESTIONS = 5
+SUMMARY_QUESTION_LENGTH = 100
+
+MAX_ANSWER_TOKENS = llama_config.max_answer_tokens
+
+# The streamed tokens of an answer are grouped in frames, sent at most every interval or once large enough
+STREAM_FLUSH_INTERVAL = llama_config.stream_flush_interval
+STREAM_FLUSH_CHARS = llama_config.stream_flush_chars
+
+FIRST_TOKEN_SECONDS = Histogram("chronos_llm_first_token_seconds", "Time from the start of a generation to its first token")
+GENERATION_SECONDS = Histogram("chronos_llm_generation_seconds", "Time to generate a whole answer")
+GENERATED_TOKENS = Counter("chronos_llm_generated_tokens_total", "Tokens generated by the text model")
+TOKENS_PER_SECOND = Histogram("chronos_llm_tokens_per_second", "Generation speed of an answer, after its first token",
+                              buckets=RATE_BUCKETS)
+EMIT_SECONDS = Histogram("chronos_emit_seconds", "Time to emit an answer frame or a speech frame to a client")
+
+# Context states of the sessions, so each turn only evaluates the new tokens
+prompt_cache = PromptStateCache(capacity_bytes=llama_config.prompt_cache_bytes,
+                                spill_dir=llama_config.prompt_cache_dir,
+                                disk_capacity_bytes=llama_config.prompt_cache_disk_bytes)
+
+server_config = get_config().server
+inference_clients = get_inference_clients()
+if inference_clients:
+    # The model runs in the inference workers, each worker serves the sessions routed to it through its own
+    # scheduler, whose "model" is the connection to the worker, ready once the worker has loaded the model.
+    llm_schedulers = [LLMScheduler(lambda index=index: models.wait(LLM)[index], max_queue_size=llama_config.max_queue_size)
+                      for index in range(len(inference_clients))]
+else:
+    # The model is loaded by the model manager, at startup or on the first message, and every session's
+    # generation requests go through the queue of the scheduler.
+    llm_schedulers = [LLMScheduler(lambda: models.wait(LLM), max_queue_size=llama_config.max_queue_size)]
+
+Gauge("chronos_llm_queue_depth", "Generation requests waiting for the model",
+      function=lambda: sum(scheduler.stats()["queue_depth"] for scheduler in llm_schedulers))
+Gauge("chronos_llm_running_requests", "Generation requests being served",
+      function=lambda: sum(scheduler.stats()["running"] for scheduler in llm_schedulers))
+
+
+def scheduler_for(session_id: str) -> LLMScheduler:
+    """Returns the scheduler serving the generation requests of a session."""
+    return llm_schedulers[route(session_id, len(llm_schedulers))]
+
+
+def discard_session(session_id: str):
+    """Discards the waiting request of a closed session and its cached context state."""
+    scheduler = scheduler_for(session_id)
+    scheduler.cancel(session_id)
+    if not scheduler.model_ready:
+        return
+    try:
+        scheduler.model.discard(session_id)
+    except (OSError, EOFError) as e:
+        logging.warning(f"Could not discard the context state of session {session_id}: {e}")
+
+
+def emit_speech(result: SpeechResult):
+    """Sends the synthesized speech of a sentence to its session, tagged with its answer and position."""
+    if result.audio is None:
+        return
+    # The audio is sent as a binary attachment, one frame per sentence in the order of the answer
+    with EMIT_SECONDS.time():
+        socketio.emit('speech_file', {'audio': result.audio, 'mime': SPEECH_MIME_TYPES[result.audio_format],
+                                      'message_id': result.message_id, 'sequence': result.sequence},
+                      to=result.session_id)
+
+# The speech of the answers is synthesized in a separate process, while the tokens keep streaming
+tts_config = get_config().tts
+speech_cache = SpeechCache(capacity_bytes=tts_config.cache_bytes, cache_dir=tts_config.cache_dir,
+                           disk_capacity_bytes=tts_config.cache_disk_bytes)
+tts_worker = TTSWorker(emit_speech, tts_timeout=tts_config.timeout, voice=tts_config.voice, rate=tts_config.rate,
+                       audio_format=tts_config.audio_format, cache=speech_cache if tts_config.cache_bytes else None)
+
+
+def start_tts_worker() -> TTSWorker:
+    tts_worker.start()
+    return tts_worker
+
+
+Counter("chronos_tts_sentences_total", "Sentences queued for speech synthesis", function=lambda: tts_worker.submitted_requests)
+Counter("chronos_tts_failures_total", "Sentences whose speech synthesis failed", function=lambda: tts_worker.failed_requests)
+Counter("chronos_tts_cache_hits_total", "Sentences whose speech was found in the cache", function=lambda: speech_cache.hits)
+Counter("chronos_tts_cache_misses_total", "Sentences whose speech was not in the cache", function=lambda: speech_cache.misses)
+
+
+def start_text_generation():
+    """Declares the text and speech models and starts the workers of the schedulers, when the server starts.
+
+    Importing the module neither declares the models nor starts a worker, see `start_transcription`.
+    """
+    if inference_clients:
+        models.register(LLM, wait_for_inference_workers, enabled=server_config.uses_text_model())
+    else:
+        models.register(LLM, lambda: load_text_generator(llama_config, prompt_cache), warmup=warm_up_text_generator,
+                        enabled=server_config.uses_text_model())
 
+    # The worker process is spawned with the other models, the answers are not spoken without the text model
+    models.register(TTS, start_tts_worker, stop=lambda worker: worker.stop(get_config().server.shutdown_timeout),
+                    enabled=tts_config.enabled and server_config.uses_text_model())
+    on_shutdown("TTS worker", lambda: models.stop(TTS))
 
-DEFAULT_TEMPLATE="""
-[INST] <|system|>
-You are CHRONOS Chat, a helpful, respectful and honest chatbot interface.
+    if models.enabled(LLM):
+        # The workers wait for the model, they do not load it
+        for scheduler in llm_schedulers:
+            scheduler.start()
+    # Registered last, so the running answers complete before the components they use are stopped
+    for scheduler in llm_schedulers:
+        on_shutdown("LLM scheduler", lambda scheduler=scheduler: scheduler.stop(get_config().server.shutdown_timeout))
 
-You are running on CPU-only devicess from the company Humanitas,
-a startup based in Montreal and lead by Abdo Shabah, for demonstration purpose.
+on_startup("text generation", start_text_generation)
 
-This chat interface aims to assist managers and employees
-so that they save time working on repetitive tasks,
-such as filling up forms, generating workflows, or gathering
-information from multiple sources.
 
-As part of this demo, you will be asked some generic questions.
-Please keep your answer short, under 200 characters if possible.
-Some questions might be asked in a different language than English,
-in that case, please answer in the same language the question was asked.
-</s>
-"""
+def strip_prompt(content: str) -> str:
+    """Removes the template tags from a message content, leaving the text of the message."""
+    return re.sub(r"\[INST\]|<\|\w+\|>|</s>", "", content).strip()
 
-USER_PROMPT ="""
-<|user|>
-{INSERT_PROMPT_HERE} </s>
-
-<|assistant|>
-"""
 
 class Conversation:
     """Manages and processes a conversation using the Llama language model.
@@ -70,11 +164,18 @@ class Conversation:
     Llama model. The conversation begins with a predefined system message template, which
     sets the initial context or instructions for the interaction.
 
+    The history sent to the model is bounded by a token budget: each message caches its token
+    count, and when the history exceeds the budget the oldest turns are dropped and replaced
+    by a short summary turn. The system template is always kept.
+
     Attributes:
-        messages (list of Message): A list of messages in the conversation, where each message
-                                 is a dictionary containing either a 'user' or 'system' key.
-        conversation (str): A string representation of the entire conversation, including
-                            both system and user messages.
+        messages (list of Message): A list of messages in the conversation, the system template
+                                 first, then the turns that fit in the budget.
+        summary (Optional[Message]): The summary of the dropped turns, if any.
+        total_tokens (int): The number of tokens of the messages and summary.
+        history_token_budget (int): The maximum number of tokens of the history.
+        conversation (str): A string representation of the conversation sent to the model,
+                            including both system and user messages.
 
     Methods:
         reception(message: str): Processes a received user message and updates the conversation.
@@ -82,7 +183,8 @@ class Conversation:
         generate_conversation(): Updates the conversation string based on accumulated messages.
     """
 
-    def __init__(self, temp_folder: Optional[tempfile.TemporaryDirectory] = None, session_id : Optional[str] = None) -> None:
+    def __init__(self, temp_folder: Optional[tempfile.TemporaryDirectory] = None, session_id : Optional[str] = None,
+                 history_token_budget: int = HISTORY_TOKEN_BUDGET) -> None:
         """Initialize the conversation with the system template.
 
         The conversation is started with a predefined system message template,
@@ -92,6 +194,10 @@ class Conversation:
         init_message = Message("system", DEFAULT_TEMPLATE)
 
         self.messages = [init_message]
+        self.summary: Optional[Message] = None
+        self._dropped_questions: List[str] = []
+        self.total_tokens = 0
+        self.history_token_budget = history_token_budget
         self.conversation = self.messages[0].content
 
         self.session_id = session_id
@@ -100,79 +206,235 @@ class Conversation:
 
         self.tts_interface = None
 
-    def reception(self, message: str):
-        """Processes a received message and generates a response.
 
-        This method appends the user's message to the conversation and then generates a response using the Llama model.
+    @property
+    def history_bytes(self) -> int:
+        """The size of the kept messages and summary, in bytes."""
+        messages = self.messages + ([self.summary] if self.summary else [])
+        return sum(len(message.content.encode("utf-8")) for message in messages)
+
+    def reception(self, message: str) -> Tuple[int, Optional[Message]]:
+        """Processes a received message by queueing the generation of its response.
+
+        The user's message is answered by a job queued on the LLM scheduler, this method returns as soon as the
+        request is queued. The streamed answer and the final status message are sent to the client by the job.
 
         Args:
             message (str): The message received from the user.
 
         Returns:
-            int: The response code
-            Message: The generated response from the chatbot.
+            int: The response code, 202 when the request is queued, 503 when the text model is not available
+            Optional[Message]: A message for the client, the queue position if the request has to wait or the model
+                               is loading, None if it is served right away.
         """
-        if llm is None:
-            error = Message("error", "Model is not loaded yet, please retry in 2 minutes")
-            return 400, error
+        scheduler = scheduler_for(self.session_id or "")
+        # In lazy mode, the first message loads the model, the queued requests are served once it is loaded
+        state = models.load(LLM).state
+        if state in (DISABLED, FAILED):
+            error = Message("error", "The chatbot is not available on this server.")
+            return 503, error
 
+        def fail(error: Exception):
+            # The model failed to load or the server stops before the request was served
+            self.send_message(Message("error", "The chatbot is not available on this server."))
+
+        try:
+            position = scheduler.submit(self.session_id or "", lambda generator: self.answer(message, generator), on_failure=fail)
+        except ModelUnavailableError:
+            error = Message("error", "The chatbot is not available on this server.")
+            return 503, error
+        except RequestInFlightError:
+            error = Message("error", "Please wait for the answer to your previous message before sending a new one.")
+            return 429, error
+        except ServerBusyError:
+            error = Message("error", "The server is busy, please retry in a moment.")
+            return 503, error
+
+        if state != READY:
+            return 202, Message("info", "The model is loading, your message will be answered once it is ready.")
+        if position > 0:
+            return 202, Message("info", f"Your message is queued, {position} request(s) ahead of yours.")
+
+        return 202, None
+
+
+    def answer(self, message: str, generator: TextGenerator) -> Tuple[int, Message]:
+        """Appends the user's message to the conversation, generates the response and sends the final status.
+
+        Runs on the LLM scheduler worker.
+
+        Args:
+            message (str): The message received from the user.
+            generator (TextGenerator): The model used to generate the response, or the inference worker running it.
+
+        Returns:
+            int: The response code
+            Message: The status message sent to the client.
+        """
         prompt = USER_PROMPT.replace('{INSERT_PROMPT_HERE}', message)
         new_message = Message("user", prompt)
-        self.messages.append(new_message)
+        self.add_message(new_message, generator)
 
+        self.trim_history(generator)
         self.generate_conversation()
 
-        return self.respond()
+        code, response = self.respond(generator)
+        self.send_message(response)
+
+        if code != 200:
+            logging.debug(f"Error {code}: {response.content}")
+
+        return code, response
 
 
     def generate_conversation(self):
-        """Generates the full conversation string from the accumulated messages."""
-        self.conversation = "".join(message.content for message in self.messages)
+        """Generates the conversation string from the system template, the summary and the kept turns."""
+        messages = self.messages[:1] + ([self.summary] if self.summary else []) + self.messages[1:]
+        self.conversation = "".join(message.content for message in messages)
+
+
+    def add_message(self, message: Message, generator: TextGenerator):
+        """Appends a message to the history, counting its tokens if they are not known yet.
+
+        Args:
+            message (Message): The message to append.
+            generator (TextGenerator): The model whose tokenizer is used for counting.
+        """
+        if self.messages[0].token_count is None:
+            self.total_tokens += self.count_tokens(self.messages[0], generator)
+
+        self.count_tokens(message, generator)
+        self.messages.append(message)
+        self.total_tokens += message.token_count or 0
+
+
+    def count_tokens(self, message: Message, generator: TextGenerator) -> int:
+        """Returns the token count of a message, tokenizing its content on first use only."""
+        if message.token_count is None:
+            message.token_count = generator.count_tokens(message.content)
+        return message.token_count
+
 
+    def trim_history(self, generator: TextGenerator):
+        """Drops the oldest turns when the history exceeds the token budget.
 
-    def respond(self) -> Tuple[int, Message]:
+        The history is cut down to `HISTORY_TRIM_RATIO` of the budget, whole turns at a time, and the
+        questions of the dropped turns are summarized in a single system turn. The last message is always kept.
+
+        Args:
+            generator (TextGenerator): The model whose tokenizer is used for counting.
+        """
+        template_tokens = self.count_tokens(self.messages[0], generator)
+        if self.total_tokens - template_tokens <= self.history_token_budget:
+            return
+
+        target = self.history_token_budget * HISTORY_TRIM_RATIO
+        dropped = 0
+
+        while len(self.messages) > 2 and self.total_tokens - template_tokens > target:
+            # Drop a whole turn, the user message and the answers that follow it
+            while True:
+                message = self.messages.pop(1)
+                self.total_tokens -= message.token_count or 0
+                dropped += 1
+                if message.emitter == "user":
+                    self._dropped_questions.append(strip_prompt(message.content)[:SUMMARY_QUESTION_LENGTH])
+                if len(self.messages) <= 2 or self.messages[1].emitter == "user":
+                    break
+
+            # The summary replaces the dropped turns, its size counts in the budget too
+            if self.summary is not None:
+                self.total_tokens -= self.summary.token_count or 0
+            questions = " ; ".join(self._dropped_questions[-SUMMARY_MAX_QUESTIONS:])
+            self.summary = Message("system", SUMMARY_PROMPT.replace('{INSERT_SUMMARY_HERE}', questions))
+            self.total_tokens += self.count_tokens(self.summary, generator)
+
+        logging.debug(f"Dropped {dropped} messages from the history of session {self.session_id}, {self.total_tokens} tokens left")
+
+
+    def respond(self, generator: TextGenerator) -> Tuple[int, Message]:
         """Generates and handles the response from the chatbot.
 
         This function calls the Llama model with the current conversation and appends the model's response to the conversation.
+        The generator restores the session context state from the prompt cache beforehand and saves it afterwards, so only the
+        tokens added since the previous turn are evaluated.
+
+        Args:
+            generator (TextGenerator): The model used to generate the response, or the inference worker running it.
 
         Returns:
             int: The response code
             Message: The response generated by the chatbot.
         """
-        with model_ready_condition:
-            while llm is None:
-                model_ready_condition.wait()
-
-        speech_message = ""
         try:
-            output = llm(self.conversation, max_tokens=2048, echo=False, stream=True)
+            start = time.perf_counter()
+            first_token_at = None
+            output = generator.generate(self.session_id or "", self.conversation, MAX_ANSWER_TOKENS)
             new_message = Message("system")
-            for item in output:
-                chunck = item['choices'][0]['text'] # type:ignore
-                logging.debug(f"\nCHATBOT CHUNK \n {chunck}")
-                self.stream_answer(new_message.id, chunck)
+            generated_tokens = 0
+            segmenter = SentenceSegmenter(min_chars=tts_config.segment_min_chars,
+                                          first_min_chars=tts_config.segment_first_min_chars,
+                                          max_chars=tts_config.segment_max_chars,
+                                          max_delay=tts_config.segment_max_delay)
+            segment_count = 0
+            # Tokens are sent to the client in frames rather than one event each
+            streamer = StreamCoalescer(lambda text: self.stream_answer(new_message.id, text),
+                                       flush_interval=STREAM_FLUSH_INTERVAL, flush_chars=STREAM_FLUSH_CHARS)
+            debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+            for chunck in output:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    FIRST_TOKEN_SECONDS.observe(first_token_at - start)
+                generated_tokens += 1
+                if debug_enabled:
+                    logging.debug(f"\nCHATBOT CHUNK \n {chunck}")
+                streamer.push(chunck)
                 new_message.content += chunck
-                speech_message += chunck
-                if bool(re.search(r"[!.:;?]", chunck)):
-                    self.talk_answer(speech_message)
-                    logging.info(f"\nTTS CHUNK \n {speech_message}")
-                    speech_message = ""
-
-
-            self.messages.append(new_message)
+                for segment in segmenter.feed(chunck):
+                    self.talk_answer(new_message.id, segment_count, segment)
+                    segment_count += 1
+
+            streamer.flush()
+            end = time.perf_counter()
+            GENERATION_SECONDS.observe(end - start)
+            GENERATED_TOKENS.inc(generated_tokens)
+            if first_token_at is not None and generated_tokens > 1 and end > first_token_at:
+                TOKENS_PER_SECOND.observe((generated_tokens - 1) / (end - first_token_at))
+
+            for segment in segmenter.flush():
+                self.talk_answer(new_message.id, segment_count, segment)
+            if tts_config.enabled:
+                tts_worker.finish(self.session_id or "", str(new_message.id))
+
+            new_message.token_count = generated_tokens
+            self.add_message(new_message, generator)
             self.generate_conversation()
 
             logging.info(f"\nCHATBOT ANSWER \n {new_message.content}")
+            logging.debug(f"Answer of session {self.session_id} streamed in {streamer.frame_count} frames for {streamer.chunk_count} tokens")
 
             response = Message("debug", "Message processing success")
 
             return 200, response
 
+        except ServerBusyError:
+            # The queue of the inference worker is full
+            error = Message("error", "The server is busy, please retry in a moment.")
+            return 503, error
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
             error = Message("error", "Unexpected error, please retry.")
             return 400, error
 
+    def send_message(self, message: Message):
+        """Sends a complete message to the client on the 'message' channel."""
+        response = {
+            "message_id": str(message.id),
+            "sender" : message.emitter,
+            "content": message.content
+        }
+        socketio.emit('message', response, to=self.session_id)
+
     def stream_answer(self, message_id, chunk):
         try:
             # Constructing a response object, could be JSON or other format
@@ -181,17 +443,27 @@ class Conversation:
                 "sender" : "system",
                 "content": chunk
             }
-            logging.debug(f"Sending data on channel 'stream_message' to {self.session_id} with response: {response}")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"Sending data on channel 'stream_message' to {self.session_id} with response: {response}")
             # Emit the response chunk to the client
-            socketio.emit('stream_message', response, to=self.session_id)  # 'chat_response' is the event name
+            with EMIT_SECONDS.time():
+                socketio.emit('stream_message', response, to=self.session_id)  # 'chat_response' is the event name
         except Exception as e:
             logging.error(f"Error while streaming response: {e}")
 
-    def talk_answer(self, sentence):
+    def talk_answer(self, message_id, sequence: int, sentence: str):
+        """Queues a sentence of an answer for speech synthesis, its audio is sent to the client once ready.
+
+        Args:
+            message_id: The ID of the answer the sentence belongs to.
+            sequence (int): The position of the sentence in the answer.
+            sentence (str): The sentence to synthesize.
+        """
+        if not tts_config.enabled:
+            return
         try:
-            self.tts_interface = TextToSpeechConverter()
-            base64_audio = self.tts_interface.convert_text_to_speech(sentence, self.temp_folder_name)
-            socketio.emit('speech_file', {'audio': base64_audio}, to=self.session_id)
-            del self.tts_interface
+            # In lazy mode, the first sentence spawns the worker process
+            models.get(TTS).submit(self.session_id or "", str(message_id), sequence, sentence)
+            logging.info(f"\nTTS CHUNK \n {sentence}")
         except Exception as e:
             logging.error(f"Audio error : {e}")
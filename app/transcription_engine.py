@@ -0,0 +1,270 @@
+"""
+transcription_engine.py
+
+This module provides the TranscriptionEngine, a dedicated worker that owns the Whisper model and serves
+the transcription requests of every session. Requests arriving within a short window are padded into a
+single mel batch and go through the encoder and decoder together, instead of each session running its
+own competing `model.transcribe` call.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import List, Optional
+
+import numpy as np
+import torch
+import whisper
+
+from whisper.audio import N_FRAMES, N_SAMPLES, HOP_LENGTH, SAMPLE_RATE
+from whisper.timing import add_word_timestamps
+from whisper.tokenizer import get_tokenizer
+
+from .utils.concurrency import run_blocking
+
+# Default batching parameters
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT = 0.05 # in seconds
+
+# Same quality thresholds as whisper.transcribe, a batched result failing them is decoded again with fallback
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+# Duration of a timestamp token, in seconds
+TIME_PRECISION = 2 * HOP_LENGTH / SAMPLE_RATE
+
+
+class TranscriptionRequest:
+    """A transcription request waiting in the engine queue.
+
+    Attributes:
+        audio (np.ndarray): The float32 16 kHz mono audio to transcribe.
+        word_timestamps (bool): Whether the result segments should carry word timestamps.
+        future (Future): The future resolved with the transcription result.
+    """
+
+    def __init__(self, audio: np.ndarray, word_timestamps: bool = False):
+        self.audio = audio
+        self.word_timestamps = word_timestamps
+        self.future: Future = Future()
+
+
+class TranscriptionEngine:
+    """Serves transcription requests from all sessions with batched Whisper inference.
+
+    Requests are queued and picked up by the worker, which waits at most `max_wait` seconds for
+    other requests to fill a batch of up to `max_batch_size` items. Requests of at most 30s (one
+    Whisper window, which covers the streaming buffers) are decoded together; longer recordings
+    fall back to a regular `model.transcribe` call on the worker.
+
+    Results have the same shape as the output of `whisper.transcribe`: a dict with 'text',
+    'segments' and 'language' keys.
+    """
+
+    def __init__(self, model: whisper.Whisper, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait: float = DEFAULT_MAX_WAIT, num_workers: int = 1):
+        """Initializes the engine, the worker threads are only started by `start`.
+
+        Args:
+            model (whisper.Whisper): The Whisper model used for transcription.
+            max_batch_size (int): The maximum number of requests decoded together.
+            max_wait (float): The maximum time, in seconds, a request waits for a batch to fill up.
+            num_workers (int): The number of worker threads pulling batches from the queue.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_wait < 0:
+            raise ValueError("max_wait cannot be negative")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_workers = num_workers
+
+        self._queue: "queue.Queue[Optional[TranscriptionRequest]]" = queue.Queue()
+        self._workers: List[threading.Thread] = []
+
+
+    def start(self):
+        """Starts the worker threads."""
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self._run, name=f"transcription-engine-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        logging.info(f"Transcription engine started, {self.num_workers} worker(s), batches of up to {self.max_batch_size} requests")
+
+
+    def stop(self):
+        """Stops the worker threads once the queued requests are processed."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers.clear()
+
+
+    def submit(self, audio: np.ndarray, word_timestamps: bool = False) -> Future:
+        """Queues audio for transcription.
+
+        Args:
+            audio (np.ndarray): The float32 16 kHz mono audio to transcribe.
+            word_timestamps (bool): Whether the result segments should carry word timestamps.
+
+        Returns:
+            Future: A future resolved with the transcription result.
+        """
+        request = TranscriptionRequest(audio, word_timestamps)
+        self._queue.put(request)
+        return request.future
+
+
+    def transcribe(self, audio: np.ndarray, word_timestamps: bool = False, timeout: Optional[float] = None) -> dict:
+        """Queues audio for transcription and waits for the result.
+
+        Args:
+            audio (np.ndarray): The float32 16 kHz mono audio to transcribe.
+            word_timestamps (bool): Whether the result segments should carry word timestamps.
+            timeout (Optional[float]): The maximum time to wait for the result, in seconds.
+
+        Returns:
+            dict: The transcription result.
+        """
+        return self.submit(audio, word_timestamps).result(timeout=timeout)
+
+
+    def _run(self):
+        """Worker loop, collects batches of requests and processes them."""
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Put the stop marker back for after this batch
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+
+            self._process(batch)
+
+
+    def _process(self, batch: List[TranscriptionRequest]):
+        """Processes a batch, short requests are decoded together and long ones one by one."""
+        short_requests = []
+
+        for request in batch:
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if len(request.audio) <= N_SAMPLES:
+                short_requests.append(request)
+                continue
+            try:
+                request.future.set_result(run_blocking(self.model.transcribe, request.audio,
+                                                       word_timestamps=request.word_timestamps))
+            except Exception as e:
+                logging.error(f"Error during transcription: {e}")
+                request.future.set_exception(e)
+
+        if not short_requests:
+            return
+
+        try:
+            results = run_blocking(self._transcribe_batch, short_requests)
+        except Exception as e:
+            logging.error(f"Error during batched transcription: {e}")
+            for request in short_requests:
+                request.future.set_exception(e)
+            return
+
+        for request, result in zip(short_requests, results):
+            request.future.set_result(result)
+
+
+    def _transcribe_batch(self, requests: List[TranscriptionRequest]) -> List[dict]:
+        """Runs the encoder and decoder passes for up to 30s requests as a single batch.
+
+        Args:
+            requests (List[TranscriptionRequest]): The requests to transcribe.
+
+        Returns:
+            List[dict]: The transcription results, in the order of the requests.
+        """
+        mels = []
+        num_frames = []
+        for request in requests:
+            mel = whisper.log_mel_spectrogram(request.audio, self.model.dims.n_mels, padding=N_SAMPLES)
+            content_frames = mel.shape[-1] - N_FRAMES
+            mels.append(whisper.pad_or_trim(mel[:, :content_frames], N_FRAMES))
+            num_frames.append(content_frames)
+
+        mel_batch = torch.stack(mels).to(self.model.device)
+        options = whisper.DecodingOptions(task="transcribe", fp16=self.model.device.type != "cpu")
+        decoded = self.model.decode(mel_batch, options)
+
+        logging.debug(f"Decoded a batch of {len(requests)} transcription requests")
+
+        results = []
+        for request, result, mel, frames in zip(requests, decoded, mel_batch, num_frames):
+            if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                results.append({"text": "", "segments": [], "language": result.language})
+            elif result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD:
+                # Greedy decoding went wrong, let whisper retry with its temperature fallback
+                results.append(self.model.transcribe(request.audio, word_timestamps=request.word_timestamps))
+            else:
+                results.append(self._build_result(result, mel, frames, request.word_timestamps))
+
+        return results
+
+
+    def _build_result(self, result: whisper.DecodingResult, mel: torch.Tensor, num_frames: int, word_timestamps: bool) -> dict:
+        """Splits a decoded window into segments, the same way whisper.transcribe does, and aligns the words if requested."""
+        tokenizer = get_tokenizer(self.model.is_multilingual, num_languages=self.model.num_languages,
+                                  language=result.language, task="transcribe")
+
+        tokens = result.tokens
+        duration = num_frames * HOP_LENGTH / SAMPLE_RATE
+        segments = []
+
+        def add_segment(segment_tokens: List[int], start: float, end: float):
+            text_tokens = [token for token in segment_tokens if token < tokenizer.eot]
+            if not text_tokens:
+                return
+            segments.append({"id": len(segments), "seek": 0, "start": start, "end": end,
+                             "text": tokenizer.decode(text_tokens), "tokens": segment_tokens})
+
+        is_timestamp = [token >= tokenizer.timestamp_begin for token in tokens]
+        slices = [index + 1 for index in range(len(tokens) - 1) if is_timestamp[index] and is_timestamp[index + 1]]
+
+        last_slice = 0
+        for current_slice in slices + [len(tokens)]:
+            segment_tokens = tokens[last_slice:current_slice]
+            last_slice = current_slice
+            if not segment_tokens:
+                continue
+            first, last = segment_tokens[0], segment_tokens[-1]
+            start = (first - tokenizer.timestamp_begin) * TIME_PRECISION if first >= tokenizer.timestamp_begin else 0.0
+            # Trailing text without a closing timestamp runs until the end of the audio
+            end = (last - tokenizer.timestamp_begin) * TIME_PRECISION if last >= tokenizer.timestamp_begin else duration
+            add_segment(segment_tokens, min(start, duration), min(max(end, start), duration))
+
+        if word_timestamps and segments:
+            add_word_timestamps(segments=segments, model=self.model, tokenizer=tokenizer,
+                                mel=mel, num_frames=num_frames, last_speech_timestamp=0.0)
+
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments, "language": result.language}
@@ -0,0 +1,294 @@
+"""
+tts_worker.py
+
+This module provides the TTSWorker, which synthesizes the speech of the chatbot answers in a separate process.
+pyttsx3 engines are neither thread-safe nor cheap to create, so a single long-lived process keeps a warm engine
+and converts the sentences it receives through a queue, while the answer tokens keep streaming. The speech is
+compressed in the worker process too, and sent to the clients as binary frames, one per sentence.
+Sentences found in the speech cache skip the synthesis altogether.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from typing import Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+from .utils.speech_cache import SpeechCache, speech_key
+from .utils.concurrency import run_blocking
+from .utils.metrics import Histogram
+
+# Default timeout of the conversion of a sentence, in seconds
+DEFAULT_TTS_TIMEOUT = 10
+# Default format of the speech sent to the clients
+DEFAULT_AUDIO_FORMAT = "ogg"
+# Time between two checks that the worker process is alive, in seconds
+WORKER_POLL_INTERVAL = 1.0
+
+# An answer, identified by its session and message IDs
+AnswerKey = Tuple[str, str]
+
+SYNTHESIS_SECONDS = Histogram("chronos_tts_synthesis_seconds", "Time to synthesize the speech of a sentence")
+ENCODING_SECONDS = Histogram("chronos_tts_encoding_seconds", "Time to compress the speech of a sentence")
+
+
+class SpeechRequest(NamedTuple):
+    """A sentence to synthesize, tagged with the answer it belongs to and its position in it."""
+    session_id: str
+    message_id: str
+    sequence: int
+    text: str
+
+
+class SpeechResult(NamedTuple):
+    """The synthesized speech of a sentence, `audio` is None if the conversion failed.
+
+    The durations are measured in the worker process, and are 0 for speech found in the cache.
+    """
+    session_id: str
+    message_id: str
+    sequence: int
+    text: str
+    audio: Optional[bytes]
+    audio_format: str
+    error: Optional[str] = None
+    synthesis_seconds: float = 0.0
+    encoding_seconds: float = 0.0
+
+
+def serve_speech_requests(requests: "multiprocessing.Queue", results: "multiprocessing.Queue", tts_timeout: float,
+                          voice: Optional[str], rate: Optional[int], audio_format: str):
+    """Worker process loop, converts the queued sentences with a single engine until it receives None.
+
+    The speech is sent as WAV if it cannot be encoded to `audio_format`, e.g. if ffmpeg is missing.
+    """
+    from .utils.text_to_speech import TextToSpeechConverter, MEMORY_FOLDER
+    from .utils.audio_utils import encode_audio_bytes
+
+    converter = TextToSpeechConverter(tts_timeout=tts_timeout, voice=voice, rate=rate)
+
+    with tempfile.TemporaryDirectory(dir=MEMORY_FOLDER if os.path.isdir(MEMORY_FOLDER) else None) as temp_folder:
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                audio = converter.synthesize(request.text, temp_folder)
+            except Exception as e:
+                results.put(SpeechResult(request.session_id, request.message_id, request.sequence, request.text,
+                                         None, audio_format, str(e)))
+                continue
+
+            synthesis_seconds = time.perf_counter() - start
+
+            result_format = audio_format
+            start = time.perf_counter()
+            try:
+                audio = encode_audio_bytes(audio, audio_format)
+            except Exception as e:
+                logging.warning(f"Speech encoding to {audio_format} failed, sending WAV from now on: {e}")
+                audio_format = result_format = "wav"
+
+            results.put(SpeechResult(request.session_id, request.message_id, request.sequence, request.text,
+                                     audio, result_format, synthesis_seconds=synthesis_seconds,
+                                     encoding_seconds=time.perf_counter() - start))
+
+
+class TTSWorker:
+    """Runs the speech synthesis of every session in a dedicated process.
+
+    Sentences in the speech cache are answered at once, the others are converted by the worker process in the
+    order they are submitted, and their speech is cached. The results of an answer are handed to `on_result` in
+    sequence order, whichever way they were obtained. The results of a cancelled session are dropped, and the
+    process is restarted if it dies.
+    """
+
+    def __init__(self, on_result: Callable[[SpeechResult], None], tts_timeout: float = DEFAULT_TTS_TIMEOUT,
+                 voice: Optional[str] = None, rate: Optional[int] = None, audio_format: str = DEFAULT_AUDIO_FORMAT,
+                 cache: Optional[SpeechCache] = None):
+        """Initializes the worker, the process is only started by `start`.
+
+        Args:
+            on_result (Callable[[SpeechResult], None]): Called with the result of each sentence.
+            tts_timeout (float): The timeout of the conversion of a sentence, in seconds.
+            voice (Optional[str]): The ID of the engine voice, the engine default if None.
+            rate (Optional[int]): The speech rate in words per minute, the engine default if None.
+            audio_format (str): The format of the speech, see `SPEECH_ENCODERS`.
+            cache (Optional[SpeechCache]): The cache of synthesized speech, None to synthesize every sentence.
+        """
+        self.on_result = on_result
+        self.tts_timeout = tts_timeout
+        self.voice = voice
+        self.rate = rate
+        self.audio_format = audio_format
+        self.cache = cache
+
+        # The parent process runs threads, forking it could deadlock the child
+        self._context = multiprocessing.get_context("spawn")
+        self._requests: Optional["multiprocessing.Queue"] = None
+        self._results: Optional["multiprocessing.Queue"] = None
+        self._process = None
+        self._reader: Optional[threading.Thread] = None
+        self._stopping = False
+
+        # Reorder buffer of each answer with speech in flight: number of sentences submitted, next sequence
+        # to deliver, results waiting for an earlier one, and whether all its sentences were submitted
+        self._lock = threading.Lock()
+        self._submitted: Dict[AnswerKey, int] = {}
+        self._complete: Set[AnswerKey] = set()
+        self._next_sequence: Dict[AnswerKey, int] = {}
+        self._ready: Dict[AnswerKey, Dict[int, SpeechResult]] = {}
+
+        self.submitted_requests = 0
+        self.failed_requests = 0
+
+
+    def start(self):
+        """Starts the worker process and the result reader thread."""
+        self._stopping = False
+        self._start_process()
+        self._reader = threading.Thread(target=self._read_results, name="tts-results", daemon=True)
+        self._reader.start()
+
+
+    def stop(self, timeout: float = 5):
+        """Stops the worker process once the queued sentences are converted, or after `timeout` seconds."""
+        self._stopping = True
+        if self._requests is not None:
+            self._requests.put(None)
+        if self._process is not None:
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+
+
+    def submit(self, session_id: str, message_id: str, sequence: int, text: str):
+        """Queues a sentence for synthesis.
+
+        Args:
+            session_id (str): The session the answer is sent to.
+            message_id (str): The answer the sentence belongs to.
+            sequence (int): The position of the sentence in the answer, starting at 0.
+            text (str): The sentence.
+        """
+        key = (session_id, str(message_id))
+        with self._lock:
+            self._submitted[key] = self._submitted.get(key, 0) + 1
+            self._next_sequence.setdefault(key, 0)
+            self._ready.setdefault(key, {})
+            self.submitted_requests += 1
+            requests = self._requests
+
+        audio = self.cache.get(self._cache_key(text)) if self.cache is not None else None
+        if audio is not None:
+            logging.debug(f"Speech of '{text}' found in cache")
+            self._deliver(SpeechResult(session_id, str(message_id), sequence, text, audio, self.audio_format))
+            return
+
+        if requests is None:
+            raise RuntimeError("TTS worker is not started")
+        requests.put(SpeechRequest(session_id, str(message_id), sequence, text))
+
+
+    def finish(self, session_id: str, message_id: str):
+        """Marks that every sentence of an answer was submitted, its state is dropped once they are delivered."""
+        key = (session_id, str(message_id))
+        with self._lock:
+            if key not in self._submitted:
+                return
+            self._complete.add(key)
+            if self._next_sequence[key] >= self._submitted[key]:
+                self._forget(key)
+
+
+    def cancel(self, session_id: str):
+        """Drops the speech of a session still being synthesized, e.g. when it ends."""
+        with self._lock:
+            for key in [key for key in self._submitted if key[0] == session_id]:
+                self._forget(key)
+
+
+    def _cache_key(self, text: str) -> str:
+        return speech_key(text, self.voice, self.rate, self.audio_format)
+
+
+    def _forget(self, key: AnswerKey):
+        """Drops the reorder buffer of an answer. Must be called with `_lock` held."""
+        self._submitted.pop(key, None)
+        self._next_sequence.pop(key, None)
+        self._ready.pop(key, None)
+        self._complete.discard(key)
+
+
+    def _deliver(self, result: SpeechResult):
+        """Hands a result to `on_result` once the previous sentences of its answer are delivered."""
+        key = (result.session_id, result.message_id)
+        with self._lock:
+            if key not in self._submitted:
+                return
+
+            ready = self._ready[key]
+            ready[result.sequence] = result
+
+            # Results are delivered under the lock, so those of one answer never overtake each other
+            while self._next_sequence[key] in ready:
+                next_result = ready.pop(self._next_sequence[key])
+                self._next_sequence[key] += 1
+                try:
+                    self.on_result(next_result)
+                except Exception as e:
+                    logging.error(f"Error while handling speech of message {next_result.message_id}: {e}")
+
+            if key in self._complete and self._next_sequence[key] >= self._submitted[key]:
+                self._forget(key)
+
+
+    def _start_process(self):
+        with self._lock:
+            self._requests = self._context.Queue()
+            self._results = self._context.Queue()
+            self._process = self._context.Process(target=serve_speech_requests,
+                                                  args=(self._requests, self._results, self.tts_timeout,
+                                                        self.voice, self.rate, self.audio_format),
+                                                  name="tts-worker", daemon=True)
+            self._process.start()
+        logging.info(f"TTS worker process started, pid {self._process.pid}")
+
+
+    def _read_results(self):
+        """Reader loop, caches and delivers the results, and restarts the worker process if it dies."""
+        while True:
+            try:
+                result: SpeechResult = run_blocking(self._results.get, timeout=WORKER_POLL_INTERVAL)  # type: ignore
+            except queue.Empty:
+                if self._stopping:
+                    return
+                if not self._process.is_alive():  # type: ignore
+                    # The sentences queued in the dead process are lost, so are the answers waiting for them
+                    logging.error(f"TTS worker process exited with code {self._process.exitcode}, restarting it")  # type: ignore
+                    with self._lock:
+                        for key in list(self._submitted):
+                            self._forget(key)
+                    self._start_process()
+                continue
+
+            if result.audio is None:
+                self.failed_requests += 1
+                logging.error(f"Audio error : {result.error}")
+            else:
+                SYNTHESIS_SECONDS.observe(result.synthesis_seconds)
+                ENCODING_SECONDS.observe(result.encoding_seconds)
+
+            if result.audio is not None and self.cache is not None and result.audio_format == self.audio_format:
+                self.cache.put(self._cache_key(result.text), result.audio)
+
+            self._deliver(result)
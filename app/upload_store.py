@@ -0,0 +1,397 @@
+"""
+upload_store.py
+
+Receives the audio files the clients upload in chunks. An upload is started with the size of the file, its numbered
+chunks are written to disk in order as they arrive, each one verified against its SHA-256 digest, and it is committed
+once complete, after the digest of the file is verified. Only the chunk being written is held in memory, whatever
+the size of the file.
+
+The digest of a file is the SHA-256 digest of the digests of its chunks, in order. Both sides compute it a chunk at
+a time, so the client never reads the whole file at once, which the WebCrypto API would require for a plain digest.
+
+An upload outlives the connection that started it: after a reconnect, the client resumes it with its ID, from the
+first chunk the store did not receive. An upload left without a chunk for `resume_timeout` seconds is dropped,
+with its file.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from .utils.custom_exceptions import UploadError
+
+if TYPE_CHECKING:
+    from .audio_processing import UploadTranscription
+
+# Default time between two sweeps of the interrupted uploads, in seconds
+DEFAULT_SWEEP_INTERVAL = 30.0
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class Upload:
+    """An audio file being uploaded.
+
+    Attributes:
+        upload_id (str): The random ID of the upload, which the client resumes it with.
+        session_id (str): The session sending the chunks, updated when the upload is resumed by a new connection.
+        name (str): The name of the file on the client, only used in logs.
+        size (int): The declared size of the file, in bytes.
+        path (str): The file the chunks are written to.
+        received (int): The number of bytes received.
+        next_index (int): The index of the next chunk expected.
+        committed (bool): Whether the file is complete and verified.
+        last_active (float): The monotonic time of the last chunk.
+        transcription (Optional[UploadTranscription]): Receives each chunk once written, to transcribe the file
+            while it is uploaded.
+    """
+
+    def __init__(self, upload_id: str, session_id: str, name: str, size: int, path: str, now: float):
+        self.upload_id = upload_id
+        self.session_id = session_id
+        self.name = name
+        self.size = size
+        self.path = path
+        self.received = 0
+        self.next_index = 0
+        self.committed = False
+        self.last_active = now
+        self.transcription: Optional["UploadTranscription"] = None
+
+        self.lock = threading.Lock()
+        self._hasher = hashlib.sha256()
+        self._file = open(path, "wb")
+        self._feed_condition = threading.Condition()
+        self._fed_chunks = 0
+
+
+    def write(self, data: bytes, digest: bytes):
+        """Appends the next chunk to the file, and its verified digest to the digest of the file. Must be called with
+        `lock` held."""
+        self._file.write(data)
+        self._hasher.update(digest)
+        self.received += len(data)
+        self.next_index += 1
+
+
+    def feed(self, index: int, data: bytes):
+        """Hands a written chunk to the transcription, in the order of the chunks.
+
+        Must be called without `lock` held: the decoder write blocks while ffmpeg lags behind, and the store must
+        keep serving the upload meanwhile.
+        """
+        with self._feed_condition:
+            self._feed_condition.wait_for(lambda: self._fed_chunks >= index)
+            try:
+                if self.transcription is not None:
+                    self.transcription.feed(data)
+            finally:
+                self._fed_chunks = index + 1
+                self._feed_condition.notify_all()
+
+
+    def hexdigest(self) -> str:
+        """The digest of the chunks received, in hexadecimal: the SHA-256 digest of their digests."""
+        return self._hasher.hexdigest()
+
+
+    def close(self):
+        """Closes the file, which is complete or abandoned."""
+        if not self._file.closed:
+            self._file.close()
+
+
+    def remove(self):
+        """Stops the transcription of the file and removes it."""
+        self.close()
+        if self.transcription is not None:
+            self.transcription.cancel()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadStore:
+    """The uploads in progress, and the committed ones until their transcription completes.
+
+    Attributes:
+        chunk_bytes (int): The maximum size of a chunk, in bytes.
+        max_bytes (int): The maximum size of a file, in bytes.
+        resume_timeout (float): The time an upload without new chunks is kept for, in seconds.
+        received_bytes (int): The number of bytes written by all the uploads.
+        expired (int): The number of uploads dropped after `resume_timeout`.
+    """
+
+    def __init__(self, directory: Optional[str] = None, chunk_bytes: int = 1024 ** 2, max_bytes: int = 1024 ** 3,
+                 resume_timeout: float = 600.0, clock: Callable[[], float] = time.monotonic):
+        """Initializes the store, the sweeps are only started by `start`.
+
+        Args:
+            directory (Optional[str]): The folder the files are written to, a temporary folder removed by `stop`
+                                       if None.
+            chunk_bytes (int): The maximum size of a chunk, in bytes.
+            max_bytes (int): The maximum size of a file, in bytes.
+            resume_timeout (float): The time an upload without new chunks is kept for, in seconds.
+            clock (Callable[[], float]): The time source.
+        """
+        if directory is None:
+            self.directory = tempfile.mkdtemp(prefix="chronos-uploads-")
+            self._owns_directory = True
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+            self._owns_directory = False
+
+        self.chunk_bytes = chunk_bytes
+        self.max_bytes = max_bytes
+        self.resume_timeout = resume_timeout
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._uploads: Dict[str, Upload] = {}
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+        self.received_bytes = 0
+        self.expired = 0
+
+
+    def __len__(self) -> int:
+        return len(self._uploads)
+
+
+    def begin(self, session_id: str, name: str, size: int) -> Upload:
+        """Starts a new upload.
+
+        Args:
+            session_id (str): The session sending the file.
+            name (str): The name of the file on the client.
+            size (int): The size of the file, in bytes.
+
+        Raises:
+            UploadError: If the size is invalid, or the file is too large.
+        """
+        if size <= 0:
+            raise UploadError("The file to upload is empty")
+        if size > self.max_bytes:
+            raise UploadError(f"The file is too large, the limit is {self.max_bytes // 1024 ** 2} MB")
+
+        upload_id = uuid.uuid4().hex
+        upload = Upload(upload_id, session_id, name, size, os.path.join(self.directory, f"{upload_id}.upload"),
+                        self._clock())
+        with self._lock:
+            self._uploads[upload_id] = upload
+
+        logging.info(f"Session {session_id} started upload {upload_id} of {name}, {size} bytes")
+        return upload
+
+
+    def get(self, upload_id: str, session_id: str) -> Upload:
+        """Returns an upload of a session.
+
+        Raises:
+            UploadError: If the upload is unknown, expired, or was started by another session.
+        """
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload.session_id != session_id:
+            raise UploadError("Unknown or expired upload")
+        return upload
+
+
+    def resume(self, upload_id: str, session_id: str) -> Upload:
+        """Hands an interrupted upload over to a new session, e.g. after the client reconnected.
+
+        The ID of the upload is the secret the client resumes it with. A committed upload can be resumed too, its
+        transcription is then sent to the new session.
+
+        Raises:
+            UploadError: If the upload is unknown or expired.
+        """
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise UploadError("Unknown or expired upload")
+
+        with upload.lock:
+            if upload.session_id != session_id:
+                logging.info(f"Upload {upload_id} resumed by session {session_id} at chunk {upload.next_index}")
+            upload.session_id = session_id
+            upload.last_active = self._clock()
+        return upload
+
+
+    def write(self, upload_id: str, session_id: str, index: int, data: bytes, sha256: str) -> Upload:
+        """Writes a chunk of an upload, and hands it to the transcription of the upload.
+
+        A chunk received again, e.g. because its acknowledgment was lost in a reconnect, is ignored.
+
+        Args:
+            upload_id (str): The ID of the upload.
+            session_id (str): The session sending the chunk.
+            index (int): The index of the chunk in the file.
+            data (bytes): The content of the chunk.
+            sha256 (str): The SHA-256 digest of the chunk, in hexadecimal.
+
+        Raises:
+            UploadError: If the upload is unknown, the chunk is not the next one, is too large, exceeds the
+                         declared size, or does not match its digest.
+        """
+        upload = self.get(upload_id, session_id)
+        digest = hashlib.sha256(data).digest()
+
+        with upload.lock:
+            if upload.committed:
+                raise UploadError("The upload is already complete")
+            if index < upload.next_index:
+                return upload
+            if index > upload.next_index:
+                raise UploadError(f"Expected chunk {upload.next_index}, received chunk {index}")
+            if not data or len(data) > self.chunk_bytes:
+                raise UploadError(f"A chunk must hold between 1 and {self.chunk_bytes} bytes")
+            if upload.received + len(data) > upload.size:
+                raise UploadError(f"The upload exceeds its declared size of {upload.size} bytes")
+            if digest.hex() != sha256.lower():
+                raise UploadError(f"Chunk {index} does not match its checksum")
+
+            upload.write(data, digest)
+            upload.last_active = self._clock()
+            self.received_bytes += len(data)
+
+        # The decoder receives the chunks in order, outside of the lock as its write can block
+        upload.feed(index, data)
+        return upload
+
+
+    def commit(self, upload_id: str, session_id: str, sha256: str) -> bool:
+        """Completes an upload once every chunk is received, and verifies its digest.
+
+        The committed upload is kept until `discard` is called, once its file is transcribed.
+
+        Args:
+            upload_id (str): The ID of the upload.
+            session_id (str): The session sending the file.
+            sha256 (str): The digest of the file, see `Upload.hexdigest`, in hexadecimal.
+
+        Returns:
+            bool: True if the upload was committed by this call, False if it already was.
+
+        Raises:
+            UploadError: If the upload is unknown or incomplete, or the digest is invalid. If the digest does not
+                         match, the upload is then discarded.
+        """
+        sha256 = sha256.lower()
+        if not SHA256_PATTERN.fullmatch(sha256):
+            raise UploadError("The checksum of the file must be a hexadecimal SHA-256 digest")
+        upload = self.get(upload_id, session_id)
+
+        with upload.lock:
+            if upload.committed:
+                return False
+            if upload.received != upload.size:
+                raise UploadError(f"The upload is incomplete, {upload.received} of {upload.size} bytes received")
+            upload.close()
+            digest = upload.hexdigest()
+            if digest == sha256:
+                upload.committed = True
+
+        if not upload.committed:
+            logging.warning(f"Upload {upload_id} does not match its checksum, discarding it")
+            self.discard(upload_id)
+            raise UploadError("The uploaded file does not match its checksum, please send it again")
+
+        logging.info(f"Upload {upload_id} of session {session_id} complete, {upload.size} bytes")
+        return True
+
+
+    def discard(self, upload_id: str) -> bool:
+        """Removes an upload and its file, e.g. once transcribed or when the client aborts it.
+
+        Returns:
+            bool: True if the upload was in the store.
+        """
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is None:
+            return False
+        self._remove(upload)
+        return True
+
+
+    def sweep(self) -> List[Upload]:
+        """Drops the uploads not committed and without a new chunk for `resume_timeout` seconds.
+
+        Returns:
+            List[Upload]: The dropped uploads.
+        """
+        now = self._clock()
+        with self._lock:
+            expired = [upload for upload in self._uploads.values()
+                       if not upload.committed and now - upload.last_active >= self.resume_timeout]
+            for upload in expired:
+                del self._uploads[upload.upload_id]
+                self.expired += 1
+
+        for upload in expired:
+            logging.info(f"Dropping upload {upload.upload_id}, not resumed for {self.resume_timeout:.0f}s")
+            self._remove(upload)
+        return expired
+
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number of uploads, the bytes they hold on disk and the counters."""
+        with self._lock:
+            uploads = list(self._uploads.values())
+        return {
+            "uploads": len(uploads),
+            "disk_bytes": sum(upload.received for upload in uploads),
+            "received_bytes": self.received_bytes,
+            "expired": self.expired,
+        }
+
+
+    def start(self, sweep_interval: float = DEFAULT_SWEEP_INTERVAL):
+        """Starts the background sweeps."""
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._run, args=(sweep_interval,), name="upload-sweeper", daemon=True)
+        self._sweeper.start()
+
+
+    def stop(self):
+        """Stops the background sweeps and removes every upload."""
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+        with self._lock:
+            uploads = list(self._uploads.values())
+            self._uploads.clear()
+        for upload in uploads:
+            self._remove(upload)
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+    def _run(self, sweep_interval: float):
+        while not self._stop.wait(sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error while sweeping the uploads: {e}")
+
+
+    def _remove(self, upload: Upload):
+        try:
+            with upload.lock:
+                upload.remove()
+        except Exception as e:
+            logging.error(f"Error while removing upload {upload.upload_id}: {e}")
@@ -1,6 +1,9 @@
+from .concurrency import run_blocking, iterate_blocking, green_backend
 from .file_utils import save_data_to_file, generate_filename, purge_file
 #from .transcription_utils import process_transcription
-from .audio_utils import check_ffmpeg_installed, convert_audio_data
-from .model_utils import load_text_model
+from .audio_utils import check_ffmpeg_installed, convert_audio_data, decode_audio_bytes, decode_audio_file, is_stream_start, StreamDecoder, SAMPLE_RATE
+from .audio_utils import encode_audio_bytes, SPEECH_ENCODERS, SPEECH_MIME_TYPES
+from .download_utils import download_file, file_sha256, log_progress
+from .model_utils import load_text_model, load_audio_model, resident_memory_bytes
 from .text_to_speech import TextToSpeechConverter
-from .custom_exceptions import MissingPackageError
+from .custom_exceptions import MissingPackageError, ConfigurationError, DownloadError, ModelUnavailableError, UploadError
@@ -1,11 +1,33 @@
+import functools
 import subprocess
+import threading
 import logging
 
+import numpy as np
+
+from typing import Callable, Optional
+
+from .concurrency import run_blocking
+
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+# Size of the reads on the decoder output, 0.1s of s16le audio
+DECODER_READ_SIZE = SAMPLE_RATE // 10 * 2
+
+# Magic numbers of the containers produced by MediaRecorder, a blob starting with one of them starts a new stream
+EBML_MAGIC = b"\x1a\x45\xdf\xa3" # WebM / Matroska
+MP4_MAGIC = b"ftyp" # MP4, at offset 4
+
+@functools.lru_cache(maxsize=None)
 def check_ffmpeg_installed():
-    """Check if ffmpeg is installed on the system."""
+    """Check if ffmpeg is installed on the system.
+
+    The probe runs once per process, the result is cached for the following calls.
+    """
     try:
         # Run 'ffmpeg -version' command and capture its output
-        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        run_blocking(subprocess.run, ["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
         return True
     except subprocess.CalledProcessError as e:
         logging.error("ffmpeg is not installed or not in PATH.")
@@ -25,3 +47,257 @@ def convert_audio_data(origin, destination):
     except FileNotFoundError:
         logging.error("ffmpeg command not found.")
         return False
+
+
+def decode_audio_bytes(data: bytes, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Decode an encoded audio payload (WebM, WAV, ...) to mono float32 PCM without touching the disk.
+
+    The payload is piped to ffmpeg on stdin and the raw s16le samples are read back from stdout,
+    which is the same format Whisper's own loader produces, so the result can be handed straight to the model.
+
+    Args:
+        data (bytes): The encoded audio data, as received from the client.
+        sample_rate (int): The output sample rate. Defaults to 16 kHz.
+
+    Returns:
+        np.ndarray: The decoded samples, as float32 values in [-1, 1].
+
+    Raises:
+        ValueError: If the data is empty.
+        subprocess.CalledProcessError: If ffmpeg fails to decode the data.
+        FileNotFoundError: If ffmpeg is not installed.
+    """
+    if not data:
+        raise ValueError("Audio data to decode cannot be empty.")
+
+    ffmpeg_cmd = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+                  "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+
+    try:
+        process = run_blocking(subprocess.run, ffmpeg_cmd, input=bytes(data), capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"ffmpeg Error during decoding: {e.stderr.decode(errors='ignore').strip()}")
+        raise
+    except FileNotFoundError:
+        logging.error("ffmpeg command not found.")
+        raise
+
+    return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+
+
+def decode_audio_file(path: str, start: float = 0.0, duration: Optional[float] = None, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Decode a window of an audio file to mono float32 PCM.
+
+    ffmpeg reads the file itself, so it can seek in it: this decodes the formats which cannot be read from a pipe,
+    e.g. MP4 files whose index is written at the end, and a long file can be decoded a window at a time.
+
+    Args:
+        path (str): The path of the encoded audio file.
+        start (float): The position of the window in the file, in seconds.
+        duration (Optional[float]): The length of the window, in seconds, up to the end of the file if None.
+        sample_rate (int): The output sample rate. Defaults to 16 kHz.
+
+    Returns:
+        np.ndarray: The decoded samples, as float32 values in [-1, 1]. Empty past the end of the file.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails to decode the file.
+        FileNotFoundError: If ffmpeg is not installed.
+    """
+    ffmpeg_cmd = ["ffmpeg", "-loglevel", "error", "-ss", f"{start:.3f}", "-i", path]
+    if duration is not None:
+        ffmpeg_cmd += ["-t", f"{duration:.3f}"]
+    ffmpeg_cmd += ["-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+
+    try:
+        process = run_blocking(subprocess.run, ffmpeg_cmd, capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"ffmpeg Error during decoding: {e.stderr.decode(errors='ignore').strip()}")
+        raise
+    except FileNotFoundError:
+        logging.error("ffmpeg command not found.")
+        raise
+
+    return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+
+
+# Encoders of the speech output formats, None for formats sent as is
+SPEECH_ENCODERS = {
+    "wav": None,
+    "ogg": ["-c:a", "libopus", "-b:a", "24k", "-f", "ogg"],
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "48k", "-f", "mp3"],
+}
+
+SPEECH_MIME_TYPES = {"wav": "audio/wav", "ogg": "audio/ogg", "mp3": "audio/mpeg"}
+
+
+def encode_audio_bytes(data: bytes, audio_format: str) -> bytes:
+    """Compress a WAV payload to one of the speech output formats without touching the disk.
+
+    Args:
+        data (bytes): The WAV data.
+        audio_format (str): The output format, one of `SPEECH_ENCODERS`.
+
+    Returns:
+        bytes: The encoded audio, the input itself for the "wav" format.
+
+    Raises:
+        ValueError: If the format is not supported.
+        subprocess.CalledProcessError: If ffmpeg fails to encode the data.
+        FileNotFoundError: If ffmpeg is not installed.
+    """
+    if audio_format not in SPEECH_ENCODERS:
+        raise ValueError(f"Unsupported speech format: {audio_format}")
+
+    encoder = SPEECH_ENCODERS[audio_format]
+    if encoder is None:
+        return data
+
+    ffmpeg_cmd = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-ac", "1", *encoder, "pipe:1"]
+
+    try:
+        process = subprocess.run(ffmpeg_cmd, input=bytes(data), capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"ffmpeg Error during encoding: {e.stderr.decode(errors='ignore').strip()}")
+        raise
+    except FileNotFoundError:
+        logging.error("ffmpeg command not found.")
+        raise
+
+    return process.stdout
+
+
+def is_stream_start(data: bytes) -> bool:
+    """Check whether an audio blob starts with a container header, i.e. is the first blob of a new recording."""
+    return data[:4] == EBML_MAGIC or data[4:8] == MP4_MAGIC
+
+
+class StreamDecoder:
+    """Long-lived ffmpeg process decoding a continuous audio stream to PCM.
+
+    The encoded stream (e.g. the successive blobs of a MediaRecorder) is written to ffmpeg's stdin, and a
+    background reader hands the decoded 16 kHz mono samples to the `on_samples` callback as soon as they are
+    available on stdout. A single process serves the whole recording, instead of one process per blob.
+    """
+
+    def __init__(self, on_samples: Callable[[np.ndarray], None], sample_rate: int = SAMPLE_RATE):
+        """Starts the ffmpeg process and its reader thread.
+
+        Args:
+            on_samples (Callable[[np.ndarray], None]): Called from the reader thread with each block of decoded
+                                                       float32 samples.
+            sample_rate (int): The output sample rate. Defaults to 16 kHz.
+
+        Raises:
+            FileNotFoundError: If ffmpeg is not installed.
+        """
+        self._on_samples = on_samples
+        self._write_lock = threading.Lock()
+
+        ffmpeg_cmd = ["ffmpeg", "-loglevel", "error", "-fflags", "nobuffer", "-i", "pipe:0",
+                      "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+
+        try:
+            self._process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            logging.error("ffmpeg command not found.")
+            raise
+
+        self._reader = threading.Thread(target=self._read_output, name=f"ffmpeg-reader-{self._process.pid}", daemon=True)
+        self._reader.start()
+
+
+    @property
+    def running(self) -> bool:
+        """Whether the decoder still accepts data."""
+        return self._process.poll() is None and self._process.stdin is not None and not self._process.stdin.closed
+
+
+    def write(self, data: bytes) -> bool:
+        """Feeds encoded data to the decoder.
+
+        Args:
+            data (bytes): The next part of the encoded stream.
+
+        Returns:
+            bool: False if the decoder is not running anymore and the data was dropped.
+        """
+        with self._write_lock:
+            if not self.running:
+                return False
+            try:
+                # The pipe blocks while ffmpeg lags behind, the write must not stall the event loop meanwhile
+                run_blocking(self._write, data)
+                return True
+            except (BrokenPipeError, ValueError) as e:
+                logging.error(f"ffmpeg decoder stopped accepting data: {e}")
+                return False
+
+
+    def _write(self, data: bytes):
+        self._process.stdin.write(data) # type: ignore
+        self._process.stdin.flush() # type: ignore
+
+
+    def close(self, timeout: Optional[float] = 5):
+        """Ends the stream and waits until every decoded sample was handed to the callback.
+
+        Args:
+            timeout (Optional[float]): The maximum time to wait for ffmpeg to flush its output, in seconds.
+                                       The process is killed past this delay.
+        """
+        with self._write_lock:
+            try:
+                if self._process.stdin and not self._process.stdin.closed:
+                    self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        try:
+            run_blocking(self._process.wait, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f"ffmpeg decoder {self._process.pid} did not exit in time, killing it")
+            self._process.kill()
+            run_blocking(self._process.wait)
+
+        self._reader.join(timeout=timeout)
+
+
+    def kill(self):
+        """Stops the decoder immediately, discarding any pending output."""
+        # A write blocked on the pipe of a stalled ffmpeg holds the lock, it fails with a broken pipe once killed
+        if self._process.poll() is None:
+            self._process.kill()
+        run_blocking(self._process.wait)
+
+        with self._write_lock:
+            try:
+                if self._process.stdin:
+                    self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        self._reader.join()
+
+
+    def _read_output(self):
+        """Reader loop, converts the s16le output to float32 blocks until ffmpeg closes stdout."""
+        remainder = b""
+        stdout = self._process.stdout
+
+        while True:
+            block = run_blocking(stdout.read1, DECODER_READ_SIZE) # type: ignore
+            if not block:
+                break
+
+            block = remainder + block
+            usable = len(block) - len(block) % 2
+            remainder = block[usable:]
+
+            if usable:
+                try:
+                    self._on_samples(np.frombuffer(block[:usable], np.int16).astype(np.float32) / 32768.0)
+                except Exception as e:
+                    logging.error(f"Error handling decoded samples: {e}")
+
+        stdout.close() # type: ignore
@@ -0,0 +1,59 @@
+"""
+concurrency.py
+
+Keeps blocking work off the event loop when the server runs on eventlet or gevent. Under those servers the
+threads of the application are green threads sharing one OS thread, so a call into native code (model
+inference, a blocking pipe read) would stall every connection. `run_blocking` runs such calls in a pool of
+real OS threads when a green server is active, and calls them directly otherwise.
+"""
+
+import sys
+
+from typing import Any, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+_STOP = object()
+
+
+def green_backend() -> str:
+    """Returns the green threads library that patched the standard library, "" if none did."""
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched("thread"):
+            return "eventlet"
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            return "gevent"
+    return ""
+
+
+def run_blocking(function: Callable[..., T], *args, **kwargs) -> T:
+    """Runs a blocking call without stalling the event loop of a green server.
+
+    Args:
+        function (Callable[..., T]): The blocking call.
+        *args, **kwargs: Its arguments.
+
+    Returns:
+        T: The value returned by the call, whose exceptions are raised in the caller.
+    """
+    backend = green_backend()
+    if backend == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(function, *args, **kwargs)
+    if backend == "gevent":
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+    return function(*args, **kwargs)
+
+
+def iterate_blocking(iterator: Iterator[T]) -> Iterator[T]:
+    """Iterates over a blocking iterator, e.g. a token stream, fetching each item with `run_blocking`."""
+    iterator = iter(iterator)
+    while True:
+        item: Any = run_blocking(next, iterator, _STOP)
+        if item is _STOP:
+            return
+        yield item
@@ -8,4 +8,28 @@ class MissingPackageError(Exception):
 
 class TextToSpeechTimeoutError(Exception):
     """Exception raised when text-to-speech conversion exceeds the allowed time."""
-    pass
\ No newline at end of file
+    pass
+
+class ServerBusyError(Exception):
+    """Exception raised when a request queue is full and the request is rejected."""
+    pass
+
+class RequestInFlightError(Exception):
+    """Exception raised when a session submits a request while its previous one is not served yet."""
+    pass
+
+class ConfigurationError(Exception):
+    """Exception raised when the runtime configuration is invalid."""
+    pass
+
+class DownloadError(Exception):
+    """Exception raised when a download fails or the downloaded file does not match its checksum."""
+    pass
+
+class ModelUnavailableError(Exception):
+    """Exception raised when a model is disabled, failed to load, or is not loaded in time."""
+    pass
+
+class UploadError(Exception):
+    """Exception raised when a chunked upload is unknown, out of order, incomplete, or does not match its checksum."""
+    pass
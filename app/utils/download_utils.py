@@ -0,0 +1,274 @@
+"""
+download_utils.py
+
+Downloads large files, such as model weights, without holding them in memory. The data is streamed in
+fixed-size chunks to a `.part` file next to the destination, interrupted downloads resume where they
+stopped using HTTP range requests, and the file only gets its final name once it is complete and its
+checksum is verified, so a file found at the destination is always usable.
+Both http(s) and file:// URLs are supported.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+from .custom_exceptions import DownloadError
+
+# Size of the chunks read from the network and written to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Attempts of a download, or of each range of a parallel download, before giving up
+DOWNLOAD_RETRIES = 3
+# Below this size, a parallel download is not worth the extra requests
+MIN_PARALLEL_RANGE_SIZE = 64 * 1024 * 1024
+
+ProgressCallback = Callable[[int, Optional[int]], None]
+
+
+def log_progress(name: str, step: float = 0.1) -> ProgressCallback:
+    """Builds a progress callback logging the progress of a download every `step` of its size.
+
+    Args:
+        name (str): The name of the downloaded file, used in the logs.
+        step (float): The share of the file downloaded between two logs.
+    """
+    lock = threading.Lock()
+    next_share = [step]
+    start = time.monotonic()
+
+    def callback(downloaded: int, total: Optional[int]):
+        if not total:
+            return
+        with lock:
+            if downloaded / total < next_share[0] and downloaded < total:
+                return
+            while next_share[0] <= downloaded / total:
+                next_share[0] += step
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logging.info(f"Downloading {name}: {downloaded / 1024 ** 2:.0f}/{total / 1024 ** 2:.0f}MB "
+                     f"({100 * downloaded / total:.0f}%, {downloaded / elapsed / 1024 ** 2:.1f}MB/s)")
+
+    return callback
+
+
+def file_sha256(path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    """Computes the SHA-256 digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_path(url: str) -> Optional[str]:
+    """The local path of a file:// URL, None for other URLs."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != "file":
+        return None
+    return urllib.request.url2pathname(parsed.path)
+
+
+def probe_size(url: str, timeout: float = 30) -> Tuple[Optional[int], bool]:
+    """Finds the size of a remote file and whether the server accepts range requests.
+
+    Returns:
+        Tuple[Optional[int], bool]: The size in bytes, None if unknown, and whether ranges are supported.
+    """
+    path = _file_path(url)
+    if path is not None:
+        try:
+            return os.path.getsize(path), True
+        except OSError as e:
+            raise DownloadError(f"Cannot read {url}: {e}") from e
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=timeout) as response:
+            length = response.headers.get("Content-Length")
+            accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+            return (int(length) if length else None), accepts_ranges
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        # Some servers reject HEAD requests, the download itself tells whether ranges are supported
+        logging.debug(f"HEAD request to {url} failed: {e}")
+        return None, False
+
+
+def _open_range(url: str, start: int, end: Optional[int], timeout: float) -> Tuple[Optional[BinaryIO], bool]:
+    """Opens a stream on the bytes `start` to `end` (inclusive, None for the end of file) of a URL.
+
+    Returns:
+        Tuple[Optional[BinaryIO], bool]: The stream, None if the range is beyond the end of the file, and
+                                         whether it starts at `start`. A server ignoring the range returns the
+                                         whole file, the stream then starts at 0.
+    """
+    path = _file_path(url)
+    if path is not None:
+        file = open(path, "rb")
+        file.seek(start)
+        return file, True
+
+    headers = {}
+    if start or end is not None:
+        headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            return None, True
+        raise
+
+    return response, response.status == 206 or not headers
+
+
+def _fetch_range(url: str, part_path: str, start: int, end: Optional[int], chunk_size: int, timeout: float,
+                 on_chunk: Callable[[int], None], retries: int = DOWNLOAD_RETRIES):
+    """Downloads the bytes `start` to `end` of a URL to a part file, resuming from the data it already holds.
+
+    Raises:
+        DownloadError: If the download keeps failing.
+    """
+    expected = None if end is None else end - start + 1
+    attempt = 0
+
+    while True:
+        done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected is not None and done >= expected:
+            return
+
+        try:
+            stream, ranged = _open_range(url, start + done, end, timeout)
+            if stream is None:
+                # Nothing left past the downloaded data, when the size was unknown the part file is complete
+                if expected is None:
+                    return
+                raise DownloadError(f"Range {start + done}-{end} not satisfiable for {url}")
+
+            with stream:
+                if not ranged and start:
+                    raise DownloadError(f"Server does not support range requests for {url}")
+                if not ranged and done:
+                    logging.warning(f"Server ignored the range request for {url}, restarting the download")
+                    done = 0
+                    on_chunk(-os.path.getsize(part_path))
+
+                with open(part_path, "ab" if done else "wb") as part_file:
+                    remaining = None if expected is None else expected - done
+                    while remaining is None or remaining > 0:
+                        chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                        if not chunk:
+                            break
+                        part_file.write(chunk)
+                        on_chunk(len(chunk))
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                    part_file.flush()
+                    os.fsync(part_file.fileno())
+
+            if expected is None or os.path.getsize(part_path) >= expected:
+                return
+            raise ConnectionError(f"Connection closed after {os.path.getsize(part_path)} of {expected} bytes")
+
+        except (urllib.error.URLError, OSError) as e:
+            attempt += 1
+            if attempt >= retries:
+                raise DownloadError(f"Download of {url} failed after {attempt} attempts: {e}") from e
+            logging.warning(f"Download of {url} interrupted ({e}), resuming, attempt {attempt + 1}/{retries}")
+            time.sleep(min(2 ** attempt, 30))
+
+
+def download_file(url: str, destination: str, sha256: Optional[str] = None, parallel: int = 1,
+                  chunk_size: int = DOWNLOAD_CHUNK_SIZE, progress: Optional[ProgressCallback] = None,
+                  timeout: float = 30) -> str:
+    """Downloads a file to a destination path, resuming any previous attempt.
+
+    The data is written to `<destination>.part`, or to one `<destination>.part.<index>` file per range for a
+    parallel download, and moved to the destination once complete and verified.
+
+    Args:
+        url (str): The http(s) or file:// URL of the file.
+        destination (str): The path the file is saved to.
+        sha256 (Optional[str]): The expected SHA-256 digest of the file, in hexadecimal. Not verified if None.
+        parallel (int): The number of ranges downloaded concurrently, if the server supports range requests.
+        chunk_size (int): The size of the chunks read and written, in bytes.
+        progress (Optional[ProgressCallback]): Called with the downloaded and total sizes (None if unknown)
+                                               after each chunk, possibly from several threads.
+        timeout (float): The timeout of the network operations, in seconds.
+
+    Returns:
+        str: The destination path.
+
+    Raises:
+        DownloadError: If the download fails or the checksum does not match. A corrupt file is deleted,
+                       an interrupted one is kept to be resumed.
+    """
+    part_path = destination + ".part"
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+
+    total, accepts_ranges = probe_size(url, timeout)
+
+    lock = threading.Lock()
+    downloaded = [0]
+
+    def on_chunk(size: int):
+        with lock:
+            downloaded[0] += size
+            current = downloaded[0]
+        if progress is not None:
+            progress(current, total)
+
+    ranges: List[Tuple[int, int]] = []
+    if parallel > 1 and accepts_ranges and total and total >= 2 * MIN_PARALLEL_RANGE_SIZE:
+        count = min(parallel, total // MIN_PARALLEL_RANGE_SIZE)
+        bounds = [total * index // count for index in range(count + 1)]
+        ranges = [(bounds[index], bounds[index + 1] - 1) for index in range(count)]
+
+    if ranges:
+        range_paths = [f"{part_path}.{index}" for index in range(len(ranges))]
+        downloaded[0] = sum(os.path.getsize(path) for path in range_paths if os.path.exists(path))
+        logging.info(f"Downloading {url} in {len(ranges)} parallel ranges, {downloaded[0]} bytes already downloaded")
+
+        with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="download") as executor:
+            futures = [executor.submit(_fetch_range, url, range_path, start, end, chunk_size, timeout, on_chunk)
+                       for range_path, (start, end) in zip(range_paths, ranges)]
+            for future in futures:
+                future.result()
+
+        with open(part_path, "wb") as part_file:
+            for range_path in range_paths:
+                with open(range_path, "rb") as range_file:
+                    shutil.copyfileobj(range_file, part_file, chunk_size)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+        for range_path in range_paths:
+            os.remove(range_path)
+    else:
+        downloaded[0] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if total is not None and downloaded[0] > total:
+            logging.warning(f"Discarding {part_path}, larger than the file to download")
+            os.remove(part_path)
+            downloaded[0] = 0
+        if downloaded[0]:
+            logging.info(f"Resuming download of {url} from {downloaded[0]} bytes")
+        _fetch_range(url, part_path, 0, total - 1 if total else None, chunk_size, timeout, on_chunk)
+
+    if total is not None and os.path.getsize(part_path) != total:
+        raise DownloadError(f"Downloaded {os.path.getsize(part_path)} bytes of {url}, expected {total}")
+
+    if sha256:
+        digest = file_sha256(part_path, chunk_size)
+        if digest.lower() != sha256.lower():
+            os.remove(part_path)
+            raise DownloadError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+        logging.debug(f"Checksum of {destination} verified")
+
+    os.replace(part_path, destination)
+    logging.info(f"Downloaded {url} to {destination}")
+    return destination
@@ -0,0 +1,192 @@
+"""
+metrics.py
+
+Counters, gauges and histograms of the pipeline stages, rendered in the Prometheus text format. An observation
+only takes a lock and increments a few numbers, so the metrics can stay enabled on the hot paths. Gauges, and
+counters maintained by another component, can be read from a function when the registry is rendered instead.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+# Bucket bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket bounds of the generation speed histogram, in tokens per second
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 30.0, 50.0, 100.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """A named metric, registered in a registry on creation."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, registry: Optional["MetricsRegistry"] = None):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. a number of requests."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None,
+                 registry: Optional["MetricsRegistry"] = None):
+        """Initializes the counter at 0.
+
+        Args:
+            function (Optional[Callable[[], float]]): Reads the value when it is kept by another component.
+        """
+        super().__init__(name, help, registry)
+        self._value = 0.0
+        self._function = function
+
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {format_value(self.value)}"]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None,
+                 registry: Optional["MetricsRegistry"] = None):
+        """Initializes the gauge at 0.
+
+        Args:
+            function (Optional[Callable[[], float]]): Reads the value when the registry is rendered.
+        """
+        super().__init__(name, help, registry)
+        self._value = 0.0
+        self._function = function
+
+
+    def set(self, value: float):
+        self._value = value
+
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {format_value(self.value)}"]
+
+
+class Histogram(Metric):
+    """The distribution of observed values, e.g. latencies, counted in fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 registry: Optional["MetricsRegistry"] = None):
+        super().__init__(name, help, registry)
+        self._bounds = tuple(sorted(buckets))
+        # The last bucket counts the values above every bound
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """Observes the duration of the block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics of the process, in their registration order."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception:
+                # A gauge whose component is not ready yet is left out of this scrape
+                lines.pop()
+                lines.pop()
+        return "\n".join(lines) + "\n"
+
+# The registry served on /metrics
+REGISTRY = MetricsRegistry()
@@ -1,68 +1,128 @@
 import os
-import requests
+import time
+import resource
 import logging
 
+from typing import Optional, TYPE_CHECKING
+
 from dotenv import load_dotenv
-from llama_cpp import Llama
+
+from .download_utils import download_file, log_progress
+
+if TYPE_CHECKING:
+    from ..config import LlamaConfig, WhisperConfig
 
 load_dotenv()
 
-def load_text_model(model_path = None, model_url : str = "https://huggingface.co/TheBloke/zephyr-7B-beta-GGUF/resolve/main/zephyr-7b-beta.Q6_K.gguf"):
+
+def resident_memory_bytes() -> int:
+    """Returns the resident memory of the process, in bytes.
+
+    Reads /proc on Linux, falls back to the peak resident memory elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_text_model(config: Optional["LlamaConfig"] = None):
     """
     Load the Llama model, downloading it from a specified URL if it's not already present locally.
 
-    This function attempts to load a Llama model from a specified path. If the model is not found,
-    it downloads the model from a specified URL or a default URL. The function checks for the
-    presence of a model at 'model_path'. If not found, it attempts to download the model from
-    'model_url'.
+    This function attempts to load a Llama model from the configured path. If the model is not found,
+    it downloads it from the configured URL, resuming any interrupted download. The context, batch
+    and thread sizes, and the way the weights are mapped in memory, are taken from the configuration.
 
     Args:
-        model_path (str, optional): The local file system path where the model is stored or will be saved.
-                                    If not provided, the function tries to retrieve it from the
-                                    'LLAMA_MODEL_PATH' environment variable.
-        model_url (str, optional): The URL to download the model if it's not present at 'model_path'.
-                         Defaults to a specific model URL on Hugging Face. This parameter is
-                         overridden by the 'LLAMA_MODEL_URL' environment variable if it's set.
+        config (LlamaConfig, optional): The settings of the model. Defaults to the application
+                                        configuration, see `app.config`.
 
     Returns:
         Llama: An instance of the Llama model loaded from 'model_path'.
 
     Raises:
-        EnvironmentError: If 'model_path' is not provided and the 'LLAMA_MODEL_PATH' environment
-                          variable is not set or if the model cannot be found and fails to download.
-        Exception: If the model download fails due to network issues or other errors indicated by
-                   a non-200 HTTP status code.
+        EnvironmentError: If no model path is configured ('LLAMA_MODEL_PATH').
+        DownloadError: If the model download fails, or the downloaded file does not match the
+                       configured checksum.
         ValueError: If the Llama model initialization fails due to invalid parameters or other issues.
-
-    Note:
-        It is recommended to set 'LLAMA_MODEL_PATH' and 'LLAMA_MODEL_URL' environment variables
-        for flexibility and to avoid hardcoded paths, even if the code works around it if necessary.
     """
+    # llama.cpp is only imported by the processes running the text model
+    from llama_cpp import Llama
+
+    if config is None:
+        from ..config import get_config
+        config = get_config().llama
 
-    model_path = os.getenv("LLAMA_MODEL_PATH") or model_path
+    model_path = config.model_path
 
     if model_path is None:
         raise EnvironmentError(f"LLAMA_MODEL_PATH environment variable not set")
 
     if not os.path.exists(model_path):
-        model_url = os.getenv("LLAMA_MODEL_URL") or model_url
-        logging.warning(f"Model not found at {model_path}, downloading from {model_url}...")
-
-        response = requests.get(model_url)
-
-        if response.status_code == 200:
-            os.makedirs(os.path.dirname(model_path), exist_ok=True)
-            with open(model_path, 'wb') as model_file:
-                model_file.write(response.content)
-        else:
-            raise Exception(f"Failed to download model. HTTP status code: {response.status_code}")
+        logging.warning(f"Model not found at {model_path}, downloading from {config.model_url}...")
+        download_file(config.model_url, model_path, sha256=config.model_sha256, parallel=config.download_workers,
+                      progress=log_progress(os.path.basename(model_path)))
     else:
         logging.debug(f"Model found at {model_path}, loading...")
 
+    memory_before = resident_memory_bytes()
+    load_start = time.monotonic()
+
     try:
-        # TODO : These need to be modified, loaded from a config class ?
-        llm = Llama(model_path=model_path, n_ctx=40960, n_batch=128, verbose=False)
-        return llm
+        llm = Llama(model_path=model_path,
+                    n_ctx=config.n_ctx,
+                    n_batch=config.n_batch,
+                    n_threads=config.n_threads,
+                    n_threads_batch=config.n_threads_batch,
+                    use_mmap=config.use_mmap,
+                    use_mlock=config.use_mlock,
+                    verbose=False)
     except ValueError as ve:
         logging.error(ve)
         raise
+
+    # With mmap, the weights are only counted in the resident memory once their pages are touched
+    logging.info(f"Llama model loaded in {time.monotonic() - load_start:.1f}s: "
+                 f"file {os.path.getsize(model_path) / 1024 ** 2:.0f}MB, "
+                 f"resident memory +{(resident_memory_bytes() - memory_before) / 1024 ** 2:.0f}MB, "
+                 f"n_ctx={llm.n_ctx()}, n_batch={config.n_batch}, "
+                 f"n_threads={llm.context_params.n_threads}, n_threads_batch={llm.context_params.n_threads_batch}, "
+                 f"use_mmap={config.use_mmap}, use_mlock={config.use_mlock}")
+    return llm
+
+
+def load_audio_model(config: Optional["WhisperConfig"] = None):
+    """
+    Load the Whisper model, downloading its checkpoint if it's not already present locally.
+
+    Args:
+        config (WhisperConfig, optional): The settings of the model. Defaults to the application
+                                          configuration, see `app.config`.
+
+    Returns:
+        whisper.Whisper: The loaded model.
+    """
+    import torch
+    import whisper
+
+    if config is None:
+        from ..config import get_config
+        config = get_config().whisper
+
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    memory_before = resident_memory_bytes()
+    load_start = time.monotonic()
+
+    audio_model = whisper.load_model(config.model, device=config.device, download_root=config.download_root)
+
+    parameters_bytes = sum(parameter.numel() * parameter.element_size() for parameter in audio_model.parameters())
+    logging.info(f"Whisper model {config.model} loaded in {time.monotonic() - load_start:.1f}s on {audio_model.device}: "
+                 f"parameters {parameters_bytes / 1024 ** 2:.0f}MB, "
+                 f"resident memory +{(resident_memory_bytes() - memory_before) / 1024 ** 2:.0f}MB, "
+                 f"torch threads={torch.get_num_threads()}")
+    return audio_model
@@ -0,0 +1,208 @@
+"""
+prompt_cache.py
+
+Caches llama.cpp evaluation states, so a conversation turn only evaluates the tokens that were not
+evaluated before. A pinned snapshot of the system prompt starts every new conversation, and the state
+reached at the end of each session's last turn is kept in an LRU bounded in bytes, optionally spilling
+to disk.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama, LlamaState
+
+# Default memory budget of the session states, a 7B model state is roughly 0.5MB per token
+DEFAULT_CAPACITY_BYTES = 2 * 1024 ** 3
+
+
+def state_size(state: "LlamaState") -> int:
+    """Estimates the memory used by a saved state, in bytes."""
+    return int(state.llama_state_size) + state.input_ids.nbytes + state.scores.nbytes
+
+
+class PromptStateCache:
+    """Saves and restores the Llama context state of each session around its turns.
+
+    llama.cpp reuses the longest common prefix between the tokens in its context and a new prompt, and
+    only evaluates the rest. Restoring the state a session reached at the end of its last turn therefore
+    reduces the prefill of the next turn to the new user message, even if other sessions used the model
+    in between.
+
+    Attributes:
+        capacity_bytes (int): The memory budget of the session states.
+        spill_dir (Optional[str]): The folder where states evicted from memory are written, None to drop them.
+        disk_capacity_bytes (Optional[int]): The budget of the spilled states, None for no limit.
+    """
+
+    def __init__(self, capacity_bytes: int = DEFAULT_CAPACITY_BYTES, spill_dir: Optional[str] = None,
+                 disk_capacity_bytes: Optional[int] = None):
+        self.capacity_bytes = capacity_bytes
+        self.spill_dir = spill_dir
+        self.disk_capacity_bytes = disk_capacity_bytes
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._prefix_state: Optional["LlamaState"] = None
+        self._states: "OrderedDict[str, LlamaState]" = OrderedDict()
+        self._spilled: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._active_session: Optional[str] = None
+
+        self.hits = 0
+        self.misses = 0
+
+
+    @property
+    def size(self) -> int:
+        """The memory used by the session states, in bytes."""
+        return self._size
+
+
+    def prime(self, llm: "Llama", prefix: str):
+        """Evaluates the prompt prefix shared by every conversation and keeps its state.
+
+        Args:
+            llm (Llama): The model.
+            prefix (str): The prefix of every prompt, i.e. the system template.
+        """
+        llm.reset()
+        llm.eval(llm.tokenize(prefix.encode("utf-8"), special=True))
+
+        with self._lock:
+            self._prefix_state = llm.save_state()
+            self._active_session = None
+
+        logging.info(f"Prompt prefix cached, {llm.n_tokens} tokens, {state_size(self._prefix_state) / 1024 ** 2:.1f}MB")
+
+
+    def restore(self, llm: "Llama", session_id: str):
+        """Loads the state of a session in the model context, before generating for it.
+
+        Falls back to the prefix state for a session without saved state. Nothing is loaded if the context
+        already holds the session state, i.e. if the model last served this session.
+
+        Args:
+            llm (Llama): The model.
+            session_id (str): The session about to be served.
+        """
+        with self._lock:
+            if self._active_session == session_id:
+                self.hits += 1
+                return
+
+            state = self._states.get(session_id)
+            if state is not None:
+                self._states.move_to_end(session_id)
+            elif session_id in self._spilled:
+                state = self._load_spilled(session_id)
+
+            if state is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                state = self._prefix_state
+
+            self._active_session = session_id
+
+        if state is not None:
+            llm.load_state(state)
+
+
+    def save(self, llm: "Llama", session_id: str):
+        """Saves the state of the model context at the end of a session's turn.
+
+        Args:
+            llm (Llama): The model.
+            session_id (str): The session that was just served.
+        """
+        state = llm.save_state()
+        size = state_size(state)
+
+        with self._lock:
+            self._remove(session_id)
+            self._active_session = session_id
+
+            if size > self.capacity_bytes:
+                logging.debug(f"State of session {session_id} ({size} bytes) exceeds the cache capacity")
+                self._spill(session_id, state)
+                return
+
+            self._states[session_id] = state
+            self._size += size
+
+            while self._size > self.capacity_bytes:
+                evicted_session, evicted_state = self._states.popitem(last=False)
+                self._size -= state_size(evicted_state)
+                self._spill(evicted_session, evicted_state)
+
+
+    def discard(self, session_id: str):
+        """Forgets the state of a session, e.g. when it ends."""
+        with self._lock:
+            self._remove(session_id)
+            if self._active_session == session_id:
+                self._active_session = None
+
+
+    def _remove(self, session_id: str):
+        """Drops the memory and disk states of a session. Must be called with `_lock` held."""
+        state = self._states.pop(session_id, None)
+        if state is not None:
+            self._size -= state_size(state)
+
+        if self._spilled.pop(session_id, None) is not None:
+            try:
+                os.remove(self._spill_path(session_id))
+            except OSError as e:
+                logging.warning(f"Failed to delete spilled state: {e}")
+
+
+    def _spill(self, session_id: str, state: "LlamaState"):
+        """Writes an evicted state to disk, if spilling is enabled. Must be called with `_lock` held."""
+        if not self.spill_dir:
+            return
+
+        path = self._spill_path(session_id)
+        try:
+            with open(path, "wb") as state_file:
+                pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logging.warning(f"Failed to spill state of session {session_id}: {e}")
+            return
+
+        self._spilled[session_id] = os.path.getsize(path)
+
+        if self.disk_capacity_bytes is None:
+            return
+
+        while sum(self._spilled.values()) > self.disk_capacity_bytes and self._spilled:
+            evicted_session, _ = self._spilled.popitem(last=False)
+            try:
+                os.remove(self._spill_path(evicted_session))
+            except OSError as e:
+                logging.warning(f"Failed to delete spilled state: {e}")
+
+
+    def _load_spilled(self, session_id: str) -> Optional["LlamaState"]:
+        """Reads a spilled state back from disk. Must be called with `_lock` held."""
+        try:
+            with open(self._spill_path(session_id), "rb") as state_file:
+                return pickle.load(state_file)
+        except (OSError, pickle.UnpicklingError) as e:
+            logging.warning(f"Failed to load spilled state of session {session_id}: {e}")
+            self._spilled.pop(session_id, None)
+            return None
+
+
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir or "", hashlib.sha256(session_id.encode("utf-8")).hexdigest() + ".state")
@@ -0,0 +1,181 @@
+"""
+sentence_segmenter.py
+
+Splits the token stream of an answer into segments worth synthesizing. A segment ends at the end of a
+sentence, not at every punctuation token: decimal numbers, abbreviations, URLs and list markers do not
+split the text, short sentences are grouped together, long ones are cut at a pause, and a segment is
+flushed when the text waits for too long, so the first audio is not delayed.
+"""
+
+import re
+import time
+
+from typing import Callable, FrozenSet, List, Optional
+
+# Default minimum length of a segment, shorter sentences are grouped with the next ones
+DEFAULT_MIN_CHARS = 40
+# Default minimum length of the first segment, kept low so the first audio comes early
+DEFAULT_FIRST_MIN_CHARS = 10
+# Default maximum length of a segment, longer sentences are cut at a pause
+DEFAULT_MAX_CHARS = 250
+# Default time after which pending text is flushed at a word boundary, in seconds
+DEFAULT_MAX_DELAY = 2.0
+
+ABBREVIATIONS: FrozenSet[str] = frozenset({
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "etc", "e.g", "i.e", "cf", "al", "approx",
+    "no", "nos", "fig", "p", "pp", "vol", "ch", "sec", "inc", "ltd", "co", "corp", "dept", "est", "min", "max",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    "mme", "mlle", "m", "env", "ex",
+})
+
+# Sentence ending punctuation, possibly followed by closing quotes or brackets, then whitespace
+SENTENCE_END = re.compile(r"([.!?…;:]+)[\"'”’)\]]*(?=\s)|\n+")
+# Pauses a long sentence can be cut at
+PAUSE = re.compile(r"[,;:—–-](?=\s)")
+# Word right before a period, to detect abbreviations and initials
+WORD_BEFORE_PERIOD = re.compile(r"(\S+)$")
+# List marker at the start of a line, e.g. "1." or "a)"
+LIST_MARKER = re.compile(r"(?:^|\n)\s*(?:\d+|[a-zA-Z])[.)]$")
+
+
+class SentenceSegmenter:
+    """Consumes the chunks of a streamed text and returns the segments to synthesize.
+
+    The deadline is checked whenever a chunk is fed, so it is only as precise as the stream is regular.
+
+    Attributes:
+        min_chars (int): The minimum length of a segment, except the first one and the last one.
+        first_min_chars (int): The minimum length of the first segment.
+        max_chars (int): The maximum length of a segment.
+        max_delay (float): The time after which pending text is flushed, in seconds.
+        segment_count (int): The number of segments returned so far.
+    """
+
+    def __init__(self, min_chars: int = DEFAULT_MIN_CHARS, first_min_chars: int = DEFAULT_FIRST_MIN_CHARS,
+                 max_chars: int = DEFAULT_MAX_CHARS, max_delay: float = DEFAULT_MAX_DELAY,
+                 abbreviations: FrozenSet[str] = ABBREVIATIONS, clock: Callable[[], float] = time.monotonic):
+        if not 0 < first_min_chars <= max_chars or not 0 < min_chars <= max_chars:
+            raise ValueError("Minimum segment lengths must be positive and not exceed max_chars")
+
+        self.min_chars = min_chars
+        self.first_min_chars = first_min_chars
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.abbreviations = abbreviations
+        self._clock = clock
+
+        self._buffer = ""
+        self._pending_since: Optional[float] = None
+        self.segment_count = 0
+
+
+    def feed(self, chunk: str) -> List[str]:
+        """Adds a chunk of the stream.
+
+        Args:
+            chunk (str): The text of the chunk, e.g. a token.
+
+        Returns:
+            List[str]: The segments completed by this chunk, possibly none.
+        """
+        if not chunk:
+            return []
+
+        if self._pending_since is None and chunk.strip():
+            self._pending_since = self._clock()
+        self._buffer += chunk
+
+        segments = []
+        while (segment := self._next_segment()) is not None:
+            segments.append(segment)
+        return segments
+
+
+    def flush(self) -> List[str]:
+        """Returns the remaining text as a last segment, at the end of the stream."""
+        segment = self._buffer.strip()
+        self._buffer = ""
+        self._pending_since = None
+        if not segment:
+            return []
+        self.segment_count += 1
+        return [segment]
+
+
+    def _next_segment(self) -> Optional[str]:
+        """Cuts the next segment from the buffer, None if it does not hold one yet."""
+        min_chars = self.first_min_chars if self.segment_count == 0 else self.min_chars
+
+        end = self._last_sentence_end(min_chars)
+        if end is None and len(self._buffer.strip()) > self.max_chars:
+            end = self._pause_before(self.max_chars) or self._word_end_before(self.max_chars)
+        if end is None and self._deadline_passed():
+            end = self._pause_before(len(self._buffer)) or self._word_end_before(len(self._buffer))
+
+        if end is None:
+            return None
+        return self._cut(end)
+
+
+    def _last_sentence_end(self, min_chars: int) -> Optional[int]:
+        """The position after the last sentence end giving a segment between `min_chars` and `max_chars` long."""
+        best = None
+        for match in SENTENCE_END.finditer(self._buffer):
+            end = match.end()
+            length = len(self._buffer[:end].strip())
+            if length > self.max_chars:
+                break
+            if length >= min_chars and self._is_sentence_end(match):
+                best = end
+        return best
+
+
+    def _is_sentence_end(self, match: "re.Match") -> bool:
+        """Whether a punctuation match really ends a sentence."""
+        if match.group(0).startswith("\n"):
+            return bool(self._buffer[:match.start()].strip())
+
+        punctuation = match.group(1)
+        if punctuation != ".":
+            return True
+
+        before = self._buffer[:match.start() + 1]
+        if LIST_MARKER.search(before):
+            return False
+
+        word = WORD_BEFORE_PERIOD.search(before[:-1])
+        if word is None:
+            return False
+        word = word.group(1).lstrip("(\"'“‘").lower()
+        # Abbreviations, initials ("J. Doe") and numbered items ("No. 5")
+        return word not in self.abbreviations and not (len(word) == 1 and word.isalpha())
+
+
+    def _pause_before(self, limit: int) -> Optional[int]:
+        """The position after the last pause in the first `limit` characters of the buffer, if any."""
+        ends = [match.end() for match in PAUSE.finditer(self._buffer, 0, limit)
+                if len(self._buffer[:match.end()].strip()) >= self.first_min_chars]
+        return ends[-1] if ends else None
+
+
+    def _word_end_before(self, limit: int) -> Optional[int]:
+        """The position after the last complete word in the first `limit` characters of the buffer, if any."""
+        position = self._buffer.rfind(" ", 0, limit + 1)
+        if position <= 0 or not self._buffer[:position].strip():
+            return None
+        return position
+
+
+    def _deadline_passed(self) -> bool:
+        return self._pending_since is not None and self._clock() - self._pending_since >= self.max_delay
+
+
+    def _cut(self, end: int) -> Optional[str]:
+        """Removes the text before `end` from the buffer and returns it as a segment."""
+        segment = self._buffer[:end].strip()
+        self._buffer = self._buffer[end:]
+        self._pending_since = self._clock() if self._buffer.strip() else None
+        if not segment:
+            return None
+        self.segment_count += 1
+        return segment
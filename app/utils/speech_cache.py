@@ -0,0 +1,169 @@
+"""
+speech_cache.py
+
+Caches synthesized speech, so the sentences the chatbot repeats (greetings, short answers to the same
+questions) are only synthesized once. Entries are keyed by the normalized text and the synthesis settings,
+kept in an LRU bounded in bytes, and optionally written to a folder that is reloaded on restart.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+from typing import Optional
+
+# Default memory budget of the cached speech
+DEFAULT_CAPACITY_BYTES = 64 * 1024 ** 2
+
+CACHE_FILE_SUFFIX = ".speech"
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a sentence for caching, the case and the spacing do not change the synthesized speech."""
+    return " ".join(text.split()).casefold()
+
+
+def speech_key(text: str, voice: Optional[str], rate: Optional[int], audio_format: str) -> str:
+    """Builds the cache key of a sentence synthesized with the given settings."""
+    return hashlib.sha256(f"{voice}|{rate}|{audio_format}|{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class SpeechCache:
+    """An LRU cache of synthesized speech, as encoded audio, with an optional disk tier.
+
+    The disk tier holds every cached entry, not only the evicted ones, so the cache is warm after a restart.
+
+    Attributes:
+        capacity_bytes (int): The memory budget of the cached speech.
+        cache_dir (Optional[str]): The folder where the speech is written, None for a memory-only cache.
+        disk_capacity_bytes (Optional[int]): The budget of the cache folder, None for no limit.
+    """
+
+    def __init__(self, capacity_bytes: int = DEFAULT_CAPACITY_BYTES, cache_dir: Optional[str] = None,
+                 disk_capacity_bytes: Optional[int] = None):
+        self.capacity_bytes = capacity_bytes
+        self.cache_dir = cache_dir
+        self.disk_capacity_bytes = disk_capacity_bytes
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._index_files()
+
+
+    @property
+    def size(self) -> int:
+        """The memory used by the cached speech, in bytes."""
+        return self._size
+
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the cached speech of a key, None if it is not cached."""
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+            elif key in self._files:
+                audio = self._load_file(key)
+                if audio is not None:
+                    self._store(key, audio)
+
+            if audio is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if key in self._files:
+                    self._files.move_to_end(key)
+            return audio
+
+
+    def put(self, key: str, audio: bytes):
+        """Caches the speech of a key.
+
+        Args:
+            key (str): The key, see `speech_key`.
+            audio (bytes): The encoded audio.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._store(key, audio)
+            if self.cache_dir and key not in self._files:
+                self._write_file(key, audio)
+
+
+    def _store(self, key: str, audio: bytes):
+        """Adds an entry to the memory tier, evicting the least recently used ones. Must be called with `_lock` held."""
+        if len(audio) > self.capacity_bytes:
+            return
+
+        self._entries[key] = audio
+        self._size += len(audio)
+
+        while self._size > self.capacity_bytes:
+            _, evicted_audio = self._entries.popitem(last=False)
+            self._size -= len(evicted_audio)
+
+
+    def _index_files(self):
+        """Lists the entries of the cache folder, the least recently modified first."""
+        paths = []
+        for file_name in os.listdir(self.cache_dir):  # type: ignore
+            if file_name.endswith(CACHE_FILE_SUFFIX):
+                path = os.path.join(self.cache_dir, file_name)  # type: ignore
+                paths.append((os.path.getmtime(path), file_name[:-len(CACHE_FILE_SUFFIX)], os.path.getsize(path)))
+
+        for _, key, size in sorted(paths):
+            self._files[key] = size
+
+        if self._files:
+            logging.info(f"Speech cache: {len(self._files)} entries found in {self.cache_dir}")
+
+
+    def _write_file(self, key: str, audio: bytes):
+        """Writes an entry to the cache folder, evicting the oldest ones. Must be called with `_lock` held."""
+        path = self._file_path(key)
+        try:
+            with open(path + ".tmp", "wb") as cache_file:
+                cache_file.write(audio)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(f"Failed to write cached speech: {e}")
+            return
+
+        self._files[key] = os.path.getsize(path)
+
+        if self.disk_capacity_bytes is None:
+            return
+
+        while sum(self._files.values()) > self.disk_capacity_bytes and self._files:
+            evicted_key, _ = self._files.popitem(last=False)
+            try:
+                os.remove(self._file_path(evicted_key))
+            except OSError as e:
+                logging.warning(f"Failed to delete cached speech: {e}")
+
+
+    def _load_file(self, key: str) -> Optional[bytes]:
+        """Reads an entry from the cache folder. Must be called with `_lock` held."""
+        try:
+            with open(self._file_path(key), "rb") as cache_file:
+                return cache_file.read()
+        except OSError as e:
+            logging.warning(f"Failed to load cached speech: {e}")
+            self._files.pop(key, None)
+            return None
+
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir or "", key + CACHE_FILE_SUFFIX)
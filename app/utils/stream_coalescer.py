@@ -0,0 +1,73 @@
+"""
+stream_coalescer.py
+
+Groups the tokens of a streamed answer into larger frames before they are sent to the client. The first
+token is sent at once, the next ones are buffered and sent together once a time window has elapsed or
+enough text is buffered, which keeps the stream smooth with far fewer emits.
+"""
+
+import time
+
+from typing import Callable
+
+# Default time between two frames, in seconds
+DEFAULT_FLUSH_INTERVAL = 0.04
+# Default size of the buffered text that triggers a frame, in characters
+DEFAULT_FLUSH_CHARS = 256
+
+
+class StreamCoalescer:
+    """Buffers the chunks of a stream and hands them to `emit` in frames.
+
+    The window is checked whenever a chunk is pushed, so when the stream stalls the buffered text waits for
+    the next chunk or for `flush`, never longer than the time between two chunks.
+
+    Attributes:
+        flush_interval (float): The minimum time between two frames, in seconds.
+        flush_chars (int): The buffered text size that triggers a frame regardless of the window.
+        frame_count (int): The number of frames emitted.
+        chunk_count (int): The number of chunks pushed.
+    """
+
+    def __init__(self, emit: Callable[[str], None], flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 flush_chars: int = DEFAULT_FLUSH_CHARS, clock: Callable[[], float] = time.monotonic):
+        self._emit = emit
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self._clock = clock
+
+        self._buffer: list = []
+        self._buffered_chars = 0
+        self._last_flush = None
+
+        self.frame_count = 0
+        self.chunk_count = 0
+
+
+    def push(self, chunk: str):
+        """Adds a chunk to the stream, and emits the buffered text if a frame is due."""
+        if not chunk:
+            return
+
+        self._buffer.append(chunk)
+        self._buffered_chars += len(chunk)
+        self.chunk_count += 1
+
+        # The first chunk is emitted at once, the client sees the answer start as early as possible
+        if (self._last_flush is None
+                or self._buffered_chars >= self.flush_chars
+                or self._clock() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+
+    def flush(self):
+        """Emits the buffered text, e.g. at the end of the stream."""
+        if not self._buffer:
+            return
+
+        text = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered_chars = 0
+        self._last_flush = self._clock()
+        self.frame_count += 1
+        self._emit(text)
@@ -1,35 +1,46 @@
 import os
-import pyttsx3
 import uuid
 import base64
 import time
 import logging
 
+from typing import Optional
+
 from .custom_exceptions import TextToSpeechTimeoutError
 
 # Default timeout, 10s
 TTS_TIMEOUT = 10
 
+# pyttsx3 can only save to a file, on Linux it is written to this memory-backed folder when it exists
+MEMORY_FOLDER = "/dev/shm"
+
 class TextToSpeechConverter:
-    def __init__(self, tts_timeout : int = TTS_TIMEOUT):
+    def __init__(self, tts_timeout : int = TTS_TIMEOUT, voice: Optional[str] = None, rate: Optional[int] = None):
+        # pyttsx3 is only imported by the process synthesizing the speech
+        import pyttsx3
+
         self.engine = pyttsx3.init()
         self._tts_timeout = tts_timeout # Timeout in seconds
+        if voice is not None:
+            self.engine.setProperty('voice', voice)
+        if rate is not None:
+            self.engine.setProperty('rate', rate)
 
-    def convert_text_to_speech(self, text: str, folder: str):
+    def synthesize(self, text: str, folder: str) -> bytes:
         """
-        Convert text to speech, save as an audio file, and return the content encoded in base64.
+        Convert text to speech and return the audio, as produced by the engine (WAV with espeak).
 
         Args:
             text (str): The text to convert to speech.
             folder (str): The folder where the temporary audio file will be saved.
 
         Returns:
-            str: The base64 encoded content of the generated audio file.
+            bytes: The content of the generated audio file.
 
         Raises:
             TextToSpeechTimeoutError: If the audio file creation exceeds the timeout.
         """
-        file_name = str(uuid.uuid4()) + ".mp3"
+        file_name = str(uuid.uuid4()) + ".wav"
         temp_filename = os.path.join(folder, file_name)
 
         os.makedirs(folder, exist_ok=True)
@@ -39,7 +50,7 @@ class TextToSpeechConverter:
         start_time = time.time()
 
         while not os.path.exists(temp_filename):
-            time.sleep(0.2)  # Wait a bit for the file to be created
+            time.sleep(0.05)  # Wait a bit for the file to be created
             if time.time() - start_time > self._tts_timeout:
                 logging.error(f"Timeout while waiting for the audio file {temp_filename} to be created.")
                 raise TextToSpeechTimeoutError("Timeout waiting for the audio file to be created.")
@@ -47,10 +58,24 @@ class TextToSpeechConverter:
         try:
             with open(temp_filename, 'rb') as audio_file:
                 audio_data = audio_file.read()
-                base64_audio = base64.b64encode(audio_data).decode('utf-8')
-            logging.debug(f"Audio file {temp_filename} successfully converted to base64.")
         finally:
             os.remove(temp_filename)
             logging.debug(f"Temporary audio file {temp_filename} deleted.")
 
-        return base64_audio
+        return audio_data
+
+    def convert_text_to_speech(self, text: str, folder: str):
+        """
+        Convert text to speech, save as an audio file, and return the content encoded in base64.
+
+        Args:
+            text (str): The text to convert to speech.
+            folder (str): The folder where the temporary audio file will be saved.
+
+        Returns:
+            str: The base64 encoded content of the generated audio file.
+
+        Raises:
+            TextToSpeechTimeoutError: If the audio file creation exceeds the timeout.
+        """
+        return base64.b64encode(self.synthesize(text, folder)).decode('utf-8')
@@ -0,0 +1,135 @@
+"""
+transcription_utils.py
+
+Helpers for streaming transcription. The HypothesisBuffer implements a committed-prefix
+policy: a word is only committed once two consecutive transcription passes agree on it,
+so the caller can freeze that text and drop the matching audio from its buffer.
+"""
+
+import re
+
+from typing import List, Tuple
+
+# A transcribed word as (start, end, text), with times in seconds from the start of the stream
+Word = Tuple[float, float, str]
+
+# Words starting this close before the last committed word end are considered already handled
+COMMIT_TOLERANCE = 0.1 # in seconds
+
+# Longest n-gram checked when removing words repeated at the start of a new hypothesis
+MAX_OVERLAP_WORDS = 5
+
+
+def extract_words(result: dict, offset: float = 0.0) -> List[Word]:
+    """Extracts the timestamped words from a Whisper transcription result.
+
+    Args:
+        result (dict): The result of a transcription ran with `word_timestamps=True`.
+        offset (float): The stream time of the first sample of the transcribed audio, in seconds.
+
+    Returns:
+        List[Word]: The words of the result, with times shifted by `offset`.
+    """
+    return [(word['start'] + offset, word['end'] + offset, word['word'])
+            for segment in result.get('segments', [])
+            for word in segment.get('words', [])]
+
+
+def normalize_word(word: str) -> str:
+    """Normalizes a word for comparison between two hypotheses (case and punctuation insensitive)."""
+    return re.sub(r"[^\w']", "", word).lower()
+
+
+def join_words(words: List[Word]) -> str:
+    """Joins words into text, Whisper words already carry their leading space."""
+    return "".join(word[2] for word in words).strip()
+
+
+class HypothesisBuffer:
+    """Keeps track of the committed and tentative words of a streaming transcription.
+
+    Each transcription pass over the uncommitted audio produces a new hypothesis. The longest
+    common prefix between this hypothesis and the previous one is committed, the remainder is
+    kept as the tentative part until the next pass confirms or replaces it.
+
+    Attributes:
+        committed (List[Word]): The words frozen so far.
+        tentative (List[Word]): The words of the last hypothesis that are not committed yet.
+    """
+
+    def __init__(self):
+        self.committed: List[Word] = []
+        self.tentative: List[Word] = []
+
+
+    @property
+    def last_committed_time(self) -> float:
+        """The end time of the last committed word, 0 if nothing is committed yet."""
+        return self.committed[-1][1] if self.committed else 0.0
+
+
+    @property
+    def stable_text(self) -> str:
+        return join_words(self.committed)
+
+
+    @property
+    def tentative_text(self) -> str:
+        return join_words(self.tentative)
+
+
+    def insert(self, words: List[Word]) -> List[Word]:
+        """Inserts a new hypothesis and commits the prefix it shares with the previous one.
+
+        Args:
+            words (List[Word]): The words of the new hypothesis, in stream time.
+
+        Returns:
+            List[Word]: The newly committed words.
+        """
+        words = [word for word in words if word[0] > self.last_committed_time - COMMIT_TOLERANCE]
+        words = self._drop_overlap(words)
+
+        newly_committed: List[Word] = []
+        for previous, current in zip(self.tentative, words):
+            if normalize_word(previous[2]) != normalize_word(current[2]):
+                break
+            newly_committed.append(current)
+
+        self.committed.extend(newly_committed)
+        self.tentative = words[len(newly_committed):]
+
+        return newly_committed
+
+
+    def flush(self) -> List[Word]:
+        """Commits every tentative word, used when the audio buffer has to be cut without agreement.
+
+        Returns:
+            List[Word]: The newly committed words.
+        """
+        newly_committed = self.tentative
+        self.committed.extend(newly_committed)
+        self.tentative = []
+
+        return newly_committed
+
+
+    def _drop_overlap(self, words: List[Word]) -> List[Word]:
+        """Removes words at the start of a hypothesis that repeat the end of the committed text.
+
+        Whisper sometimes transcribes again the last committed words when the audio was cut close to them.
+        """
+        if not words or not self.committed:
+            return words
+
+        if abs(words[0][0] - self.last_committed_time) > 1:
+            return words
+
+        for n in range(min(len(self.committed), len(words), MAX_OVERLAP_WORDS), 0, -1):
+            committed_tail = [normalize_word(word[2]) for word in self.committed[-n:]]
+            new_head = [normalize_word(word[2]) for word in words[:n]]
+            if committed_tail == new_head:
+                return words[n:]
+
+        return words
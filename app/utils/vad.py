@@ -0,0 +1,157 @@
+"""
+vad.py
+
+Energy-based voice activity detection on 16 kHz mono float32 audio. It is cheap enough to run on the
+whole transcription buffer before each pass, and is used to avoid sending silence to the Whisper model.
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .audio_utils import SAMPLE_RATE
+
+# Default detection parameters
+FRAME_SECONDS = 0.03
+THRESHOLD_DB = -45.0 # Frames below this level are always silence, in dBFS
+NOISE_MARGIN_DB = 10.0 # Frames must also be this far above the estimated noise floor
+MAX_THRESHOLD_DB = -30.0 # Upper bound of the adaptive threshold, so continuous speech is not taken as the noise floor
+MIN_SPEECH_SECONDS = 0.1 # Shorter bursts of energy (clicks, bumps) are ignored
+PADDING_SECONDS = 0.2 # Kept around speech so word edges are not cut
+
+
+class EnergyVAD:
+    """Detects speech in audio from the energy of short frames.
+
+    A frame is speech when its level is above both an absolute threshold and the noise floor of the
+    analysed audio (estimated as its 10th percentile frame level) plus a margin, the latter being capped
+    by `max_threshold_db`. Runs of speech frames shorter than `min_speech_seconds` are discarded.
+    """
+
+    def __init__(self, threshold_db: float = THRESHOLD_DB, noise_margin_db: float = NOISE_MARGIN_DB,
+                 max_threshold_db: float = MAX_THRESHOLD_DB, frame_seconds: float = FRAME_SECONDS,
+                 min_speech_seconds: float = MIN_SPEECH_SECONDS, padding_seconds: float = PADDING_SECONDS, sample_rate: int = SAMPLE_RATE):
+        self.threshold_db = threshold_db
+        self.noise_margin_db = noise_margin_db
+        self.max_threshold_db = max_threshold_db
+        self.frame_size = max(1, int(frame_seconds * sample_rate))
+        self.min_speech_frames = max(1, int(round(min_speech_seconds / frame_seconds)))
+        self.padding = int(padding_seconds * sample_rate)
+        self.sample_rate = sample_rate
+
+
+    def speech_frames(self, audio: np.ndarray) -> np.ndarray:
+        """Classifies each complete frame of the audio.
+
+        Args:
+            audio (np.ndarray): The float32 mono audio to analyse.
+
+        Returns:
+            np.ndarray: A boolean array, True for the frames containing speech.
+        """
+        return self._classify(self.frame_levels(audio))
+
+
+    def frame_levels(self, audio: np.ndarray) -> np.ndarray:
+        """Returns the level of each complete frame of the audio, in dBFS."""
+        n_frames = len(audio) // self.frame_size
+        if n_frames == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        frames = audio[:n_frames * self.frame_size].reshape(n_frames, self.frame_size)
+        return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+
+
+    def _classify(self, levels: np.ndarray) -> np.ndarray:
+        if len(levels) == 0:
+            return np.zeros(0, dtype=bool)
+
+        noise_threshold = min(float(np.percentile(levels, 10)) + self.noise_margin_db, self.max_threshold_db)
+        threshold = max(self.threshold_db, noise_threshold)
+        speech = levels > threshold
+
+        # Discard the runs of speech frames that are too short
+        edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+        for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if end - start < self.min_speech_frames:
+                speech[start:end] = False
+
+        return speech
+
+
+    def speech_bounds(self, audio: np.ndarray) -> Optional[Tuple[int, int]]:
+        """Finds the part of the audio that contains speech, padded on both sides.
+
+        Args:
+            audio (np.ndarray): The float32 mono audio to analyse.
+
+        Returns:
+            Optional[Tuple[int, int]]: The first and past-the-end sample indexes of the speech, None if the
+                                       audio is silent.
+        """
+        speech = np.flatnonzero(self.speech_frames(audio))
+        if len(speech) == 0:
+            return None
+
+        start = max(0, int(speech[0]) * self.frame_size - self.padding)
+        end = min(len(audio), (int(speech[-1]) + 1) * self.frame_size + self.padding)
+
+        return start, end
+
+
+    def split(self, audio: np.ndarray, max_seconds: float, min_seconds: float) -> List[Tuple[int, int]]:
+        """Splits audio into consecutive segments of at most `max_seconds`, cut in silences.
+
+        Each cut is placed in the middle of the longest silence found between `min_seconds` and `max_seconds` after
+        the previous cut, or at the quietest frame of that range if it is all speech, so words are rarely cut.
+
+        Args:
+            audio (np.ndarray): The float32 mono audio to split.
+            max_seconds (float): The maximum length of a segment, in seconds.
+            min_seconds (float): The minimum length of a segment, except the last one, in seconds.
+
+        Returns:
+            List[Tuple[int, int]]: The first and past-the-end sample indexes of each segment, covering the audio.
+        """
+        max_frames = max(1, int(max_seconds * self.sample_rate) // self.frame_size)
+        min_frames = min(max_frames - 1, int(min_seconds * self.sample_rate) // self.frame_size)
+        levels = self.frame_levels(audio)
+        speech = self._classify(levels)
+
+        bounds = []
+        start = 0
+        while len(audio) - start * self.frame_size > max_frames * self.frame_size:
+            low, high = start + min_frames, start + max_frames
+            silence = ~speech[low:high]
+
+            # Longest run of silent frames in the range
+            edges = np.diff(np.concatenate(([0], silence.astype(np.int8), [0])))
+            runs = list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+            if runs:
+                run_start, run_end = max(runs, key=lambda run: run[1] - run[0])
+                cut = low + (int(run_start) + int(run_end)) // 2
+            else:
+                cut = low + int(np.argmin(levels[low:high]))
+            cut = max(cut, start + 1)
+
+            bounds.append((start * self.frame_size, cut * self.frame_size))
+            start = cut
+
+        bounds.append((start * self.frame_size, len(audio)))
+        return bounds
+
+
+    def trailing_silence(self, audio: np.ndarray) -> float:
+        """Measures the silence at the end of the audio.
+
+        Args:
+            audio (np.ndarray): The float32 mono audio to analyse.
+
+        Returns:
+            float: The duration, in seconds, since the end of the last speech frame. The whole duration if the
+                   audio is silent.
+        """
+        speech = np.flatnonzero(self.speech_frames(audio))
+        last_speech_end = (int(speech[-1]) + 1) * self.frame_size if len(speech) else 0
+
+        return (len(audio) - last_speech_end) / self.sample_rate
@@ -0,0 +1,135 @@
+"""Connection load test for the Socket.IO server.
+
+Opens increasing numbers of concurrent client connections to a running server, and reports for each level
+how many connections succeeded, how long the welcome message took to arrive, and how many connections were
+still alive after a holding period. Run it against each server mode to compare their capacity:
+
+    python run.py --server werkzeug &
+    python benchmarks/connection_load.py --url http://127.0.0.1:5000 --levels 50 100 200 400 800
+
+    python run.py --server eventlet &
+    python benchmarks/connection_load.py --url http://127.0.0.1:5000 --levels 50 100 200 400 800
+
+The client side needs the packages in benchmarks/requirements.txt.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from typing import Dict, List, Optional
+
+import socketio
+
+
+class ClientResult:
+    """Outcome of one client connection."""
+
+    def __init__(self):
+        self.connected = False
+        self.welcome_latency: Optional[float] = None
+        self.alive_after_hold = False
+        self.error: Optional[str] = None
+
+
+async def run_client(url: str, transports: List[str], connect_timeout: float, hold: float,
+                     start_barrier: asyncio.Event, result: ClientResult):
+    """Connects one client, waits for the welcome message, then holds the connection open."""
+    client = socketio.AsyncClient(reconnection=False)
+    welcome = asyncio.Event()
+
+    @client.on('message')
+    async def on_message(data):
+        welcome.set()
+
+    await start_barrier.wait()
+    start = time.perf_counter()
+
+    try:
+        await asyncio.wait_for(client.connect(url, transports=transports), connect_timeout)
+        result.connected = True
+        await asyncio.wait_for(welcome.wait(), connect_timeout)
+        result.welcome_latency = time.perf_counter() - start
+
+        await asyncio.sleep(hold)
+        result.alive_after_hold = client.connected
+    except Exception as e:
+        result.error = type(e).__name__
+    finally:
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+async def run_level(url: str, clients: int, transports: List[str], connect_timeout: float, hold: float) -> Dict:
+    """Opens `clients` connections at once and summarizes their outcomes."""
+    start_barrier = asyncio.Event()
+    results = [ClientResult() for _ in range(clients)]
+    tasks = [asyncio.create_task(run_client(url, transports, connect_timeout, hold, start_barrier, result))
+             for result in results]
+
+    start = time.perf_counter()
+    start_barrier.set()
+    await asyncio.gather(*tasks)
+
+    latencies = [result.welcome_latency for result in results if result.welcome_latency is not None]
+    errors: Dict[str, int] = {}
+    for result in results:
+        if result.error:
+            errors[result.error] = errors.get(result.error, 0) + 1
+
+    return {
+        "clients": clients,
+        "connected": sum(result.connected for result in results),
+        "welcomed": len(latencies),
+        "alive_after_hold": sum(result.alive_after_hold for result in results),
+        "welcome_p50": percentile(latencies, 0.5),
+        "welcome_p95": percentile(latencies, 0.95),
+        "welcome_mean": statistics.mean(latencies) if latencies else None,
+        "duration": time.perf_counter() - start,
+        "errors": errors,
+    }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Measure the concurrent connection capacity of the Socket.IO server.')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:5000', help='Set the server URL')
+    parser.add_argument('--levels', type=int, nargs='+', default=[25, 50, 100, 200, 400], help='Set the numbers of concurrent clients')
+    parser.add_argument('--hold', type=float, default=10.0, help='Set the time each connection is held open, in seconds')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Set the connection timeout, in seconds')
+    parser.add_argument('--transport', type=str, default='websocket', choices=['websocket', 'polling'], help='Set the Socket.IO transport')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    summaries = []
+    print(f"{'clients':>8} {'connected':>10} {'welcomed':>9} {'alive':>6} {'p50':>8} {'p95':>8} {'duration':>9}  errors")
+    for clients in args.levels:
+        summary = await run_level(args.url, clients, [args.transport], args.timeout, args.hold)
+        summaries.append(summary)
+        print(f"{summary['clients']:>8} {summary['connected']:>10} {summary['welcomed']:>9} {summary['alive_after_hold']:>6} "
+              f"{format_seconds(summary['welcome_p50']):>8} {format_seconds(summary['welcome_p95']):>8} "
+              f"{summary['duration']:>8.1f}s  {summary['errors'] or ''}")
+        # Let the server clean the sessions up before the next level
+        await asyncio.sleep(2)
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump({"url": args.url, "transport": args.transport, "hold": args.hold, "levels": summaries}, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
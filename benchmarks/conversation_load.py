@@ -0,0 +1,337 @@
+"""End-to-end load test of concurrent talkers.
+
+Simulates clients that record a question, then chat: each client streams a recorded WebM chunk stream like the
+browser does, waits for its final transcription, then sends the messages of a script one at a time, waiting for
+each answer to complete. It reports, over all clients, the percentiles of:
+
+- time to transcript: from the end of the recording (`audio_stop`) to the final transcription;
+- time to first token: from a `user_message` to the first streamed frame of its answer;
+- time to first audio: from a `user_message` to the first speech frame of its answer;
+- answer time: from a `user_message` to the end of its answer;
+
+and the rate of events received by all clients. The results are saved as JSON, tagged with the current commit,
+and can be compared with a previous run.
+
+By default the server is started with the model stand-ins of benchmarks/stub_server.py:
+
+    python benchmarks/conversation_load.py --clients 10 50 100 --audio recording.webm --json results.json
+    python benchmarks/conversation_load.py --clients 50 --server-args "--server eventlet --llm-token-latency 0.05"
+    python benchmarks/conversation_load.py --clients 10 --start real --compare results.json
+    python benchmarks/conversation_load.py --clients 10 --start none --url http://10.0.0.2:5000
+
+The client side needs the packages in benchmarks/requirements.txt.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+from typing import Dict, List, Optional
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SCRIPT = [
+    "Hello, who are you?",
+    "Can you help me fill out a vacation request form?",
+    "Summarize our conversation in one sentence.",
+]
+
+METRICS = ("time_to_transcript", "time_to_first_token", "time_to_first_audio", "answer_time")
+
+
+class ClientResult:
+    """Measurements of one simulated client."""
+
+    def __init__(self):
+        self.connected = False
+        self.samples: Dict[str, List[float]] = {metric: [] for metric in METRICS}
+        self.events = 0
+        self.answers = 0
+        self.errors: Dict[str, int] = {}
+
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def load_chunks(path: Optional[str], chunk_size: int) -> List[bytes]:
+    """Loads a recorded chunk stream: the sorted files of a folder, or a WebM file cut in chunks."""
+    if path is None:
+        return []
+    if os.path.isdir(path):
+        chunks = []
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), 'rb') as chunk_file:
+                chunks.append(chunk_file.read())
+        return chunks
+    with open(path, 'rb') as audio_file:
+        data = audio_file.read()
+    return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+
+async def run_client(url: str, chunks: List[bytes], chunk_interval: float, script: List[str], think_time: float,
+                     timeout: float, start_barrier: asyncio.Event, result: ClientResult):
+    """Connects one client, streams its recording, then sends its script."""
+    client = socketio.AsyncClient(reconnection=False)
+    transcript = asyncio.Event()
+    answer_done = asyncio.Event()
+    current: Dict[str, Optional[float]] = {"sent_at": None, "first_token": None, "first_audio": None}
+    audio_stopped_at: List[float] = []
+
+    @client.on('*')
+    async def on_event(event, data=None):
+        result.events += 1
+
+    @client.on('transcription')
+    async def on_transcription(data):
+        result.events += 1
+        if data.get('final') and audio_stopped_at and not transcript.is_set():
+            result.samples["time_to_transcript"].append(time.perf_counter() - audio_stopped_at[0])
+            transcript.set()
+
+    @client.on('stream_message')
+    async def on_stream_message(data):
+        result.events += 1
+        if current["sent_at"] is not None and current["first_token"] is None:
+            current["first_token"] = time.perf_counter() - current["sent_at"]
+
+    @client.on('speech_file')
+    async def on_speech_file(data):
+        result.events += 1
+        if current["sent_at"] is not None and current["first_audio"] is None:
+            current["first_audio"] = time.perf_counter() - current["sent_at"]
+
+    @client.on('message')
+    async def on_message(data):
+        result.events += 1
+        # The end of an answer is reported by a debug message, a rejected request by an error message
+        if data.get('sender') == 'debug':
+            answer_done.set()
+        elif data.get('sender') == 'error':
+            result.error("server_error")
+            answer_done.set()
+
+    await start_barrier.wait()
+
+    try:
+        await asyncio.wait_for(client.connect(url, transports=['websocket']), timeout)
+        result.connected = True
+
+        if chunks:
+            for chunk in chunks:
+                await client.emit('audio_chunk', chunk)
+                await asyncio.sleep(chunk_interval)
+            audio_stopped_at.append(time.perf_counter())
+            await client.emit('audio_stop')
+            try:
+                await asyncio.wait_for(transcript.wait(), timeout)
+            except asyncio.TimeoutError:
+                result.error("transcript_timeout")
+
+        for message in script:
+            answer_done.clear()
+            current.update(sent_at=time.perf_counter(), first_token=None, first_audio=None)
+            await client.emit('user_message', message)
+            try:
+                await asyncio.wait_for(answer_done.wait(), timeout)
+            except asyncio.TimeoutError:
+                result.error("answer_timeout")
+                continue
+
+            result.answers += 1
+            result.samples["answer_time"].append(time.perf_counter() - current["sent_at"])  # type: ignore
+            if current["first_token"] is not None:
+                result.samples["time_to_first_token"].append(current["first_token"])
+            # Speech frames of an answer may still arrive after its end, they are given a moment
+            if current["first_audio"] is None:
+                await asyncio.sleep(min(think_time, 1.0))
+            if current["first_audio"] is not None:
+                result.samples["time_to_first_audio"].append(current["first_audio"])
+            await asyncio.sleep(think_time)
+    except Exception as e:
+        result.error(type(e).__name__)
+    finally:
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+async def run_level(url: str, clients: int, chunks: List[bytes], args) -> Dict:
+    """Runs `clients` simulated clients at once and summarizes their measurements."""
+    start_barrier = asyncio.Event()
+    results = [ClientResult() for _ in range(clients)]
+    tasks = [asyncio.create_task(run_client(url, chunks, args.chunk_interval, args.script, args.think, args.timeout,
+                                            start_barrier, result))
+             for result in results]
+
+    start = time.perf_counter()
+    start_barrier.set()
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - start
+
+    summary: Dict = {
+        "clients": clients,
+        "connected": sum(result.connected for result in results),
+        "answers": sum(result.answers for result in results),
+        "events": sum(result.events for result in results),
+        "events_per_second": sum(result.events for result in results) / duration,
+        "duration": duration,
+    }
+    for metric in METRICS:
+        samples = [sample for result in results for sample in result.samples[metric]]
+        summary[metric] = {"count": len(samples), "p50": percentile(samples, 0.5),
+                           "p95": percentile(samples, 0.95), "p99": percentile(samples, 0.99)}
+    errors: Dict[str, int] = {}
+    for result in results:
+        for kind, count in result.errors.items():
+            errors[kind] = errors.get(kind, 0) + count
+    summary["errors"] = errors
+    return summary
+
+
+def start_server(mode: str, port: int, server_args: str) -> Optional[subprocess.Popen]:
+    """Starts the server with the model stand-ins or the real models, None if it runs elsewhere."""
+    if mode == 'none':
+        return None
+    script = os.path.join(ROOT, 'benchmarks', 'stub_server.py') if mode == 'stub' else os.path.join(ROOT, 'run.py')
+    command = [sys.executable, script, '--headless', '--port', str(port), '--log-file', os.devnull] + shlex.split(server_args)
+    return subprocess.Popen(command, cwd=ROOT)
+
+
+def wait_for_port(host: str, port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"The server did not listen on {host}:{port} within {timeout:.0f}s")
+
+
+async def wait_until_ready(url: str, timeout: float):
+    """Sends a message until it is answered, the text model is loaded in the background once the server listens."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = socketio.AsyncClient(reconnection=False)
+        answered = asyncio.Event()
+        outcome: List[str] = []
+
+        @client.on('message')
+        async def on_message(data):
+            if data.get('sender') in ('debug', 'error'):
+                outcome.append(data['sender'])
+                answered.set()
+
+        try:
+            await asyncio.wait_for(client.connect(url, transports=['websocket']), 10)
+            await client.emit('user_message', DEFAULT_SCRIPT[0])
+            await asyncio.wait_for(answered.wait(), max(1.0, deadline - time.monotonic()))
+            if outcome == ['debug']:
+                return
+        except (asyncio.TimeoutError, socketio.exceptions.ConnectionError):
+            pass
+        finally:
+            await client.disconnect()
+        await asyncio.sleep(5)
+    raise TimeoutError(f"The server did not answer within {timeout:.0f}s")
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def print_summary(summary: Dict, baseline: Optional[Dict] = None):
+    print(f"{summary['clients']} clients: {summary['connected']} connected, {summary['answers']} answers, "
+          f"{summary['events_per_second']:.0f} events/s in {summary['duration']:.1f}s  {summary['errors'] or ''}")
+    for metric in METRICS:
+        values = summary[metric]
+        line = f"  {metric:<20} n={values['count']:<5} " + " ".join(
+            f"{key}={format_seconds(values[key]):>8}" for key in ("p50", "p95", "p99"))
+        if baseline is not None and baseline[metric]["p95"] and values["p95"]:
+            line += f"  p95 {(values['p95'] / baseline[metric]['p95'] - 1) * 100:+.0f}% vs baseline"
+        print(line)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Measure the latencies of concurrent talkers, end to end.')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 5, 10, 25], help='Set the numbers of concurrent clients')
+    parser.add_argument('--audio', type=str, default=None, help='Set the recorded audio, a WebM file or a folder of chunk files (no audio if unset)')
+    parser.add_argument('--chunk-size', type=int, default=16384, help='Set the chunk size a WebM file is cut in, in bytes')
+    parser.add_argument('--chunk-interval', type=float, default=0.25, help='Set the time between two audio chunks, in seconds')
+    parser.add_argument('--script', type=str, default=None, help='Set a JSON file listing the messages each client sends')
+    parser.add_argument('--think', type=float, default=1.0, help='Set the pause of a client between two messages, in seconds')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Set the timeout of each step, in seconds')
+    parser.add_argument('--start', type=str, default='stub', choices=['stub', 'real', 'none'], help='Start the server with the model stand-ins, the real models, or not at all')
+    parser.add_argument('--server-args', type=str, default='', help='Set extra options of the started server')
+    parser.add_argument('--port', type=int, default=5055, help='Set the port of the started server')
+    parser.add_argument('--url', type=str, default=None, help='Set the URL of a running server, with --start none')
+    parser.add_argument('--startup-timeout', type=float, default=300.0, help='Set the time the server has to load the models, in seconds')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='Compare the results with those of this JSON file')
+    args = parser.parse_args()
+
+    if args.script:
+        with open(args.script) as script_file:
+            args.script = json.load(script_file)
+    else:
+        args.script = DEFAULT_SCRIPT
+    chunks = load_chunks(args.audio, args.chunk_size)
+    url = args.url or f"http://127.0.0.1:{args.port}"
+
+    baselines: Dict[int, Dict] = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baselines = {level["clients"]: level for level in json.load(baseline_file)["levels"]}
+
+    server = start_server(args.start, args.port, args.server_args)
+    try:
+        if server is not None:
+            wait_for_port('127.0.0.1', args.port, args.startup_timeout)
+        await wait_until_ready(url, args.startup_timeout)
+
+        summaries = []
+        for clients in args.clients:
+            summary = await run_level(url, clients, chunks, args)
+            summaries.append(summary)
+            print_summary(summary, baselines.get(clients))
+            # Let the server clean the sessions up before the next level
+            await asyncio.sleep(2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump({"commit": current_commit(), "timestamp": time.time(), "server": args.start,
+                       "server_args": args.server_args, "audio": args.audio, "script": args.script,
+                       "levels": summaries}, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
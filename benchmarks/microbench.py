@@ -0,0 +1,392 @@
+"""Microbenchmarks of the hot paths of the pipeline, with regression thresholds.
+
+Each benchmark times one stage in isolation and compares its median time with the baseline recorded in
+benchmarks/baseline.json. A benchmark slower than its baseline by more than its tolerance fails the run, so a
+slowdown of any stage is caught before it reaches production:
+
+    python benchmarks/microbench.py                          # compare with the baseline, exit status 1 on regression
+                                                             # or on a benchmark without a baseline
+    python benchmarks/microbench.py --update-baseline        # record the current times as the baseline
+    python benchmarks/microbench.py --only conversation tts  # run the benchmarks whose name starts with these
+    python benchmarks/microbench.py --whisper-models tiny base --llama-model models/zephyr.gguf --clip question.webm
+
+The benchmarks needing the real models only run when they are given, the ones needing ffmpeg or pyttsx3 are
+skipped when those are missing. The application modules are imported with the model stand-ins of
+benchmarks/stub_server.py, without starting a server. Baselines depend on the host, record them on the
+machine that runs the benchmarks.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional
+
+import stub_server
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Allowed slowdown over the baseline, as a share of it
+DEFAULT_TOLERANCE = 0.25
+# Number of timed runs of a benchmark, after one warm-up run
+DEFAULT_REPEAT = 20
+
+HISTORY_LENGTHS = (10, 100, 1000)
+SENTENCES = {
+    "short": "Hello there.",
+    "medium": "The weather will be sunny in Montreal tomorrow, with a high of twenty degrees.",
+    "long": ("This chat interface aims to assist managers and employees so that they save time working on "
+             "repetitive tasks, such as filling up forms, generating workflows, or gathering information "
+             "from multiple sources."),
+}
+
+
+class SkipBenchmark(Exception):
+    """Raised by the setup of a benchmark that cannot run on this host or with these options."""
+
+
+class Benchmark:
+    """A timed operation.
+
+    Attributes:
+        name (str): The name of the benchmark, its key in the baseline.
+        setup (Callable): Prepares the operation from the options and returns it. The operation returns the
+                          number of units it processed (e.g. tokens), or None for a single operation.
+        tolerance (float): The allowed slowdown over the baseline, as a share of it.
+        repeat (int): The number of timed runs.
+        unit (str): What the time is measured per.
+    """
+
+    def __init__(self, name: str, setup: Callable[[argparse.Namespace], Callable[[], Optional[int]]],
+                 tolerance: float = DEFAULT_TOLERANCE, repeat: int = DEFAULT_REPEAT, unit: str = "op"):
+        self.name = name
+        self.setup = setup
+        self.tolerance = tolerance
+        self.repeat = repeat
+        self.unit = unit
+
+
+    def run(self, args: argparse.Namespace) -> float:
+        """Returns the median time of the operation, per unit, in seconds."""
+        operation = self.setup(args)
+        operation()
+
+        times = []
+        for _ in range(max(1, int(self.repeat * args.repeat_scale))):
+            start = time.perf_counter()
+            units = operation()
+            times.append((time.perf_counter() - start) / (units or 1))
+        return statistics.median(times)
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, **options):
+    """Registers a benchmark setup function."""
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name, setup, **options))
+        return setup
+    return register
+
+
+_app = None
+
+
+def load_app():
+    """Imports the application modules with the model stand-ins, once."""
+    global _app
+    if _app is None:
+        from app.config import RuntimeConfig, set_config
+        import app.utils.text_to_speech as text_to_speech
+
+        # The stand-ins only replace what a benchmark does not measure, they take no time
+        for env, _, _ in stub_server.LATENCY_SETTINGS.values():
+            os.environ[env] = "0"
+
+        config = RuntimeConfig()
+        config.llama.model_path = "stub-model.gguf"
+        config.tts.enabled = False
+        config.server.metrics = False
+        set_config(config)
+
+        # The real converter is kept for the speech benchmarks, the stand-ins serve the rest of the application
+        real_converter = text_to_speech.TextToSpeechConverter
+        stub_server.install_stubs()
+
+        # The socket routes are imported first, as create_app does, they import the other modules
+        import app.socket_routes
+        import app.text_processing as text_processing
+        import app.audio_processing as audio_processing
+
+        _app = argparse.Namespace(text_processing=text_processing, audio_processing=audio_processing,
+                                  TextToSpeechConverter=real_converter)
+    return _app
+
+
+def require_ffmpeg():
+    if shutil.which("ffmpeg") is None:
+        raise SkipBenchmark("ffmpeg is not installed")
+
+
+def test_clip(args: argparse.Namespace) -> bytes:
+    """Returns the audio clip of the benchmarks, the --clip file or a generated 5s WebM tone."""
+    if args.clip:
+        with open(args.clip, 'rb') as clip_file:
+            return clip_file.read()
+    require_ffmpeg()
+    return subprocess.run(["ffmpeg", "-f", "lavfi", "-i", "sine=frequency=220:duration=5", "-c:a", "libopus",
+                           "-f", "webm", "pipe:1"], capture_output=True, check=True).stdout
+
+
+@benchmark("audio.append_samples")
+def setup_append_samples(args):
+    """Appends a 30s stream of 250ms chunks to the audio buffer of a session, as the decoder reader does."""
+    import numpy as np
+
+    audio_processing = load_app().audio_processing
+    chunk = np.zeros(audio_processing.SAMPLE_RATE // 4, dtype=np.float32)
+    manager = audio_processing.AudioTranscriptionManager(session_id="bench")
+
+    def operation():
+        manager.audio_buffer = np.zeros(0, dtype=np.float32)
+        for _ in range(120):
+            manager._append_samples(chunk)
+    return operation
+
+
+@benchmark("audio.convert_audio_data", repeat=10)
+def setup_convert_audio_data(args):
+    from app.utils import convert_audio_data
+
+    clip = test_clip(args)
+    folder = tempfile.mkdtemp()
+    origin = os.path.join(folder, "clip.webm")
+    with open(origin, 'wb') as origin_file:
+        origin_file.write(clip)
+
+    def operation():
+        destination = os.path.join(folder, "clip.wav")
+        if os.path.exists(destination):
+            os.remove(destination)
+        if not convert_audio_data(origin, destination):
+            raise RuntimeError("ffmpeg conversion failed")
+    return operation
+
+
+@benchmark("audio.decode_audio_bytes", repeat=10)
+def setup_decode_audio_bytes(args):
+    from app.utils import decode_audio_bytes
+
+    clip = test_clip(args)
+
+    def operation():
+        decode_audio_bytes(clip)
+    return operation
+
+
+def register_whisper_benchmark(size: str):
+    @benchmark(f"whisper.transcribe_audio[{size}]", repeat=5, tolerance=0.3)
+    def setup_transcribe_audio(args):
+        if size not in args.whisper_models:
+            raise SkipBenchmark("not in --whisper-models")
+        import whisper
+        from app.transcription_engine import TranscriptionEngine
+
+        app = load_app()
+        clip = test_clip(args)
+        engine = TranscriptionEngine(whisper.load_model(size, device="cpu"))
+        engine.start()
+        manager = app.audio_processing.AudioTranscriptionManager(session_id="bench", engine=engine)
+
+        def operation():
+            manager.transcribe_audio(clip)
+        return operation
+
+for whisper_size in ("tiny", "base", "small", "medium"):
+    register_whisper_benchmark(whisper_size)
+
+
+def register_conversation_benchmark(turns: int):
+    @benchmark(f"conversation.generate_conversation[{turns}]")
+    def setup_generate_conversation(args):
+        from app.datatypes import Message
+        from app.inference import TextGenerator
+        from app.prompts import USER_PROMPT
+
+        text_processing = load_app().text_processing
+        generator = TextGenerator(stub_server.StubLlama(), text_processing.prompt_cache)
+        conversation = text_processing.Conversation(session_id="bench", history_token_budget=10 ** 9)
+        for turn in range(turns):
+            conversation.add_message(Message("user", USER_PROMPT.replace('{INSERT_PROMPT_HERE}', f"Question {turn}?")),
+                                     generator)
+            conversation.add_message(Message("system", stub_server.ANSWER), generator)
+        return conversation.generate_conversation
+
+for history_length in HISTORY_LENGTHS:
+    register_conversation_benchmark(history_length)
+
+
+@benchmark("text.sentence_segmenter", unit="token")
+def setup_sentence_segmenter(args):
+    """Segments a streamed answer for speech synthesis, token by token."""
+    from app.utils.sentence_segmenter import SentenceSegmenter
+
+    tokens = stub_server.tokenize_text(stub_server.ANSWER * 10)
+
+    def operation():
+        segmenter = SentenceSegmenter()
+        for token in tokens:
+            segmenter.feed(token)
+        segmenter.flush()
+        return len(tokens)
+    return operation
+
+
+def load_llama(args):
+    if not args.llama_model:
+        raise SkipBenchmark("no --llama-model")
+    from app.config import LlamaConfig
+    from app.utils.model_utils import load_text_model
+
+    load_app()
+    return load_text_model(LlamaConfig(model_path=args.llama_model, n_ctx=2048))
+
+
+@benchmark("llm.prefill", repeat=3, unit="token")
+def setup_prefill(args):
+    llm = load_llama(args)
+    tokens = llm.tokenize((stub_server.ANSWER + " ").encode("utf-8") * 12, special=True)[:512]
+
+    def operation():
+        llm.reset()
+        llm.eval(tokens)
+        return len(tokens)
+    return operation
+
+
+@benchmark("llm.decode", repeat=3, unit="token")
+def setup_decode(args):
+    llm = load_llama(args)
+
+    def operation():
+        llm.reset()
+        # The prompt is a few tokens, the time is spent generating
+        return sum(1 for _ in llm("Tell me a story.", max_tokens=64, stream=True))
+    return operation
+
+
+def register_tts_benchmark(length: str):
+    @benchmark(f"tts.convert_text_to_speech[{length}]", repeat=5, tolerance=0.3)
+    def setup_convert_text_to_speech(args):
+        try:
+            converter = load_app().TextToSpeechConverter()
+        except Exception as e:
+            raise SkipBenchmark(f"pyttsx3 is not available: {e}")
+        folder = tempfile.mkdtemp()
+
+        def operation():
+            converter.convert_text_to_speech(SENTENCES[length], folder)
+        return operation
+
+for sentence_length in SENTENCES:
+    register_tts_benchmark(sentence_length)
+
+
+@benchmark("tts.encode_audio_bytes[ogg]", repeat=10)
+def setup_encode_audio_bytes(args):
+    """Compresses the speech of a medium sentence, as the TTS worker does before sending it."""
+    require_ffmpeg()
+    from app.utils.audio_utils import encode_audio_bytes
+
+    wav = stub_server.StubSpeechConverter().synthesize(SENTENCES["medium"], "")
+
+    def operation():
+        encode_audio_bytes(wav, "ogg")
+    return operation
+
+
+def load_baseline(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {"benchmarks": {}}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Time the hot paths of the pipeline and compare them with the baseline.')
+    parser.add_argument('--only', type=str, nargs='+', default=None, help='Run the benchmarks whose name starts with these prefixes')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE, help='Set the baseline file')
+    parser.add_argument('--update-baseline', action='store_true', help='Record the measured times as the baseline')
+    parser.add_argument('--repeat-scale', type=float, default=1.0, help='Scale the number of timed runs of every benchmark')
+    parser.add_argument('--clip', type=str, default=None, help='Set the audio clip to decode and transcribe (a generated tone if unset)')
+    parser.add_argument('--whisper-models', type=str, nargs='*', default=[], help='Set the Whisper sizes to benchmark')
+    parser.add_argument('--llama-model', type=str, default=None, help='Set the GGUF model to benchmark')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    recorded = baseline.setdefault("benchmarks", {})
+    regressions = []
+    unrecorded = []
+
+    print(f"{'benchmark':<40} {'median':>10} {'baseline':>10} {'change':>8}")
+    for bench in BENCHMARKS:
+        if args.only and not any(bench.name.startswith(prefix) for prefix in args.only):
+            continue
+        try:
+            seconds = bench.run(args)
+        except SkipBenchmark as e:
+            print(f"{bench.name:<40} skipped: {e}")
+            continue
+
+        reference = recorded.get(bench.name)
+        line = f"{bench.name:<40} {format_time(seconds):>10}/{bench.unit}"
+        if reference is not None:
+            change = seconds / reference["seconds"] - 1
+            tolerance = reference.get("tolerance", bench.tolerance)
+            line += f" {format_time(reference['seconds']):>10} {change * 100:>+7.0f}%"
+            if change > tolerance:
+                regressions.append(bench.name)
+                line += f"  REGRESSION (tolerance {tolerance * 100:.0f}%)"
+        else:
+            unrecorded.append(bench.name)
+            line += "  no baseline"
+        print(line)
+
+        if args.update_baseline:
+            tolerance = reference.get("tolerance", bench.tolerance) if reference else bench.tolerance
+            recorded[bench.name] = {"seconds": seconds, "unit": bench.unit, "tolerance": tolerance}
+
+    if args.update_baseline:
+        baseline["host"] = {"node": platform.node(), "machine": platform.machine(), "python": platform.python_version(),
+                            "cpus": os.cpu_count()}
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+    if unrecorded:
+        # A benchmark without a baseline cannot regress, the gate would pass whatever its time
+        print(f"{len(unrecorded)} benchmark(s) without a baseline: {', '.join(unrecorded)}, "
+              f"record them with --update-baseline")
+    return 1 if regressions or unrecorded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""Runs the application with deterministic stand-ins for the models, for load tests.
+
+The stand-ins answer like the real models and take a configurable time to do it, so a load test measures the
+serving pipeline (queues, batching, ffmpeg, Socket.IO) without the hardware the models need:
+
+- the text model evaluates the prompt tokens missing from its context, then streams a fixed answer;
+- the transcription engine batches the requests like the real one, and returns the words of a fixed
+  sentence spread over the audio;
+- the speech synthesizer returns silence as long as the sentence would take to read.
+
+Every option besides the latencies is passed to run.py:
+
+    python benchmarks/stub_server.py --headless --server eventlet --llm-token-latency 0.05 --whisper-rtf 0.2
+
+The stand-ins replace the model loaders before the application loads its models. The application only imports
+llama.cpp, torch, whisper and pyttsx3 in these loaders, so the stand-ins run with flask, flask-socketio and numpy
+alone. The TTS worker process imports this module again when it is spawned, and only installs the speech
+synthesizer stand-in there.
+"""
+
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+import wave
+
+from concurrent.futures import Future
+from typing import List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The latencies are read from the environment, which the TTS worker process inherits
+LATENCY_SETTINGS = {
+    "llm_prompt_token_latency": ("STUB_LLM_PROMPT_TOKEN_LATENCY", 0.002, "Time to evaluate a prompt token, in seconds"),
+    "llm_token_latency": ("STUB_LLM_TOKEN_LATENCY", 0.08, "Time to generate a token, in seconds"),
+    "whisper_latency": ("STUB_WHISPER_LATENCY", 0.3, "Fixed time of a transcription batch, in seconds"),
+    "whisper_rtf": ("STUB_WHISPER_RTF", 0.1, "Transcription time per second of audio of the longest request of a batch"),
+    "tts_latency": ("STUB_TTS_LATENCY", 0.1, "Fixed time of a sentence synthesis, in seconds"),
+    "tts_char_latency": ("STUB_TTS_CHAR_LATENCY", 0.002, "Synthesis time per character, in seconds"),
+}
+
+ANSWER = ("Sure, here is a short answer to your question. It is generated by a stand-in model, "
+          "so every client receives the same text. The real model would answer in your language.")
+
+TRANSCRIPT = "hello could you tell me what the weather will be like tomorrow in montreal please"
+
+# Speaking rate of the stand-ins, used to place the transcribed words and to size the synthesized speech
+WORDS_PER_SECOND = 2.5
+SECONDS_PER_CHARACTER = 0.06
+SAMPLE_RATE = 16000
+
+
+def latency(name: str) -> float:
+    env, default, _ = LATENCY_SETTINGS[name]
+    return float(os.getenv(env, default))
+
+
+def tokenize_text(text: str) -> List[str]:
+    """Splits a text in stand-in tokens, a word with its leading space each."""
+    tokens = []
+    for index, word in enumerate(text.split(" ")):
+        tokens.append(word if index == 0 else " " + word)
+    return tokens
+
+
+class StubState:
+    """The saved context of the stand-in text model, with the attributes the prompt cache reads."""
+
+    def __init__(self, tokens: List[str]):
+        self.tokens = list(tokens)
+        self.input_ids = np.zeros(len(tokens), dtype=np.intc)
+        self.scores = np.zeros(0, dtype=np.single)
+        # A real state holds roughly 0.5MB per token for a 7B model, a smaller size keeps the cache realistic enough
+        self.llama_state_size = 1024 * len(tokens)
+
+
+class StubLlama:
+    """Stand-in for llama_cpp.Llama, only the calls made by the application are implemented."""
+
+    def __init__(self):
+        self._context: List[str] = []
+
+
+    @property
+    def n_tokens(self) -> int:
+        return len(self._context)
+
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[str]:
+        return tokenize_text(text.decode("utf-8"))
+
+
+    def reset(self):
+        self._context = []
+
+
+    def eval(self, tokens: List[str]):
+        time.sleep(latency("llm_prompt_token_latency") * len(tokens))
+        self._context.extend(tokens)
+
+
+    def save_state(self) -> StubState:
+        return StubState(self._context)
+
+
+    def load_state(self, state: StubState):
+        self._context = list(state.tokens)
+
+
+    def __call__(self, prompt: str, max_tokens: int = 16, echo: bool = False, stream: bool = False):
+        # Only the tokens after the prefix shared with the context are evaluated, as with llama.cpp
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        shared = 0
+        while shared < min(len(tokens), len(self._context)) and tokens[shared] == self._context[shared]:
+            shared += 1
+        self._context = self._context[:shared]
+        self.eval(tokens[shared:])
+
+        for token in tokenize_text(ANSWER)[:max_tokens]:
+            time.sleep(latency("llm_token_latency"))
+            self._context.append(token)
+            yield {"choices": [{"text": token}]}
+
+
+class StubTranscriptionRequest:
+
+    def __init__(self, audio: np.ndarray, word_timestamps: bool):
+        self.audio = audio
+        self.word_timestamps = word_timestamps
+        self.future: Future = Future()
+
+
+class StubTranscriptionEngine:
+    """Stand-in for TranscriptionEngine, batches the requests and takes the time of the longest one."""
+
+    def __init__(self, model=None, max_batch_size: int = 8, max_wait: float = 0.05):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._queue: List[StubTranscriptionRequest] = []
+        self._stopping = False
+        self._worker: Optional[threading.Thread] = None
+
+
+    def start(self):
+        self._worker = threading.Thread(target=self._run, name="stub-transcription", daemon=True)
+        self._worker.start()
+
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._worker is not None:
+            self._worker.join()
+
+
+    def transcribe(self, audio: np.ndarray, word_timestamps: bool = False, timeout: Optional[float] = None) -> dict:
+        request = StubTranscriptionRequest(audio, word_timestamps)
+        with self._condition:
+            self._queue.append(request)
+            self._condition.notify()
+        return request.future.result(timeout=timeout)
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                deadline = time.monotonic() + self.max_wait
+                while len(self._queue) < self.max_batch_size and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch, self._queue = self._queue[:self.max_batch_size], self._queue[self.max_batch_size:]
+
+            longest = max(len(request.audio) for request in batch) / SAMPLE_RATE
+            time.sleep(latency("whisper_latency") + latency("whisper_rtf") * longest)
+            for request in batch:
+                request.future.set_result(self._result(len(request.audio) / SAMPLE_RATE))
+
+
+    @staticmethod
+    def _result(duration: float) -> dict:
+        words = TRANSCRIPT.split(" ")
+        timed_words = [{"word": " " + words[index % len(words)], "start": index / WORDS_PER_SECOND,
+                        "end": (index + 0.8) / WORDS_PER_SECOND}
+                       for index in range(int(duration * WORDS_PER_SECOND))]
+        return {"text": "".join(word["word"] for word in timed_words),
+                "segments": [{"start": 0.0, "end": duration, "words": timed_words}]}
+
+
+class StubSpeechConverter:
+    """Stand-in for TextToSpeechConverter, returns silence as long as the sentence."""
+
+    def __init__(self, tts_timeout: float = 10, voice: Optional[str] = None, rate: Optional[int] = None):
+        pass
+
+
+    def synthesize(self, text: str, folder: str) -> bytes:
+        time.sleep(latency("tts_latency") + latency("tts_char_latency") * len(text))
+        output = io.BytesIO()
+        with wave.open(output, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            wav.writeframes(b"\0\0" * int(len(text) * SECONDS_PER_CHARACTER * SAMPLE_RATE))
+        return output.getvalue()
+
+
+def install_speech_stub():
+    import app.utils.text_to_speech as text_to_speech
+    text_to_speech.TextToSpeechConverter = StubSpeechConverter  # type: ignore
+
+
+def load_stub_transcription_engine(config) -> StubTranscriptionEngine:
+    engine = StubTranscriptionEngine(max_batch_size=config.max_batch_size, max_wait=config.max_batch_wait)
+    engine.start()
+    return engine
+
+
+def install_stubs():
+    """Replaces the model loaders of the application with the stand-ins.
+
+    Must be called before the modules declaring the models are imported, as they import the loaders by name.
+    """
+    import app.inference as inference
+
+    inference.load_text_model = lambda config=None: StubLlama()  # type: ignore
+    inference.load_transcription_engine = load_stub_transcription_engine  # type: ignore
+    install_speech_stub()
+
+
+if __name__ == "__mp_main__":
+    # Spawned TTS worker process
+    install_speech_stub()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the application with stand-ins for the models.", add_help=False)
+    for name, (env, default, help) in LATENCY_SETTINGS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=float, default=None, help=f"{help} (default {default})")
+    args, run_arguments = parser.parse_known_args()
+
+    for name, (env, _, _) in LATENCY_SETTINGS.items():
+        if getattr(args, name) is not None:
+            os.environ[env] = str(getattr(args, name))
+    # The model file is never read by the stand-in
+    os.environ.setdefault("LLAMA_MODEL_PATH", "stub-model.gguf")
+
+    import run
+
+    # The standard library is patched before the application is imported, as run.py does
+    sys.argv = [sys.argv[0]] + run_arguments
+    run_args = run.parse_arguments()
+    run.load_environment_variables()
+    worker = run.resolve_server_setting(run_args, run_args.server, 'SERVER_WORKER', 'worker', 'werkzeug')
+    if worker in run.SERVER_WORKERS:
+        run.monkey_patch(worker)
+
+    install_stubs()
+    run.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,17 @@ This script initializes the Flask application and runs the server with socket.io
 """
 
 import os
+import sys
+import json
+import signal
 import logging
 import argparse
 from dotenv import load_dotenv
 
-from app import create_app, socketio
+SERVER_WORKERS = ('werkzeug', 'eventlet', 'gevent')
+SERVER_ROLES = ('all', 'web', 'inference')
+PIPELINES = ('all', 'text', 'audio')
+MODEL_LOADING = ('eager', 'lazy')
 
 def configure_logging(log_level: str, log_file: str):
     """Configure the logging for the application."""
@@ -35,10 +41,77 @@ def parse_arguments():
     parser.add_argument('--log-level', type=str, default='INFO', help='Set the logging level (e.g., DEBUG, INFO, WARNING, ERROR, CRITICAL)')
     parser.add_argument('--log-file', type=str, default='log.txt', help='Set the log file location')
     parser.add_argument('--headless', action='store_true', help='Run the server in headless mode (no HTTP routes)')
+    parser.add_argument('--config', type=str, default=None, help='Set the JSON runtime configuration file (defaults to APP_CONFIG)')
+
+    server = parser.add_argument_group('server', 'Override the server settings of the configuration file and environment')
+    server.add_argument('--server', type=str, choices=SERVER_WORKERS, help='Set the server implementation, werkzeug is for development only')
+    server.add_argument('--host', type=str, help='Set the address the server listens on')
+    server.add_argument('--port', type=int, help='Set the port the server listens on')
+    server.add_argument('--max-connections', type=int, help='Set the maximum number of connected clients')
+    server.add_argument('--shutdown-timeout', type=float, help='Set the time given to running requests on shutdown, in seconds')
+
+    models = parser.add_argument_group('models', 'Select and load the models')
+    models.add_argument('--pipeline', type=str, choices=PIPELINES, help='Set the features served: all, text (chat only, no speech model) or audio (transcription only, no text model)')
+    models.add_argument('--model-loading', type=str, choices=MODEL_LOADING, help='Load the models in parallel at startup (eager) or on first use (lazy)')
+    models.add_argument('--warmup', dest='model_warmup', action=argparse.BooleanOptionalAction, default=None, help='Run a short inference once a model is loaded')
+
+    scale = parser.add_argument_group('scale-out', 'Run the models in inference workers shared by several front-end workers')
+    scale.add_argument('--role', type=str, choices=SERVER_ROLES, help='Set the process role: all (single process), web (front-end worker) or inference (model worker)')
+    scale.add_argument('--message-queue', type=str, help='Set the message queue URL shared by the front-end workers (e.g., redis://localhost:6379/0)')
+    scale.add_argument('--inference-endpoints', type=str, help='Set the comma separated host:port of the inference workers of a front-end worker')
+    scale.add_argument('--inference-bind', type=str, help='Set the host:port an inference worker listens on')
+
+    llama = parser.add_argument_group('text model', 'Override the llama settings of the configuration file and environment')
+    llama.add_argument('--llama-model-path', type=str, help='Set the GGUF model path')
+    llama.add_argument('--n-ctx', type=int, help='Set the context size, in tokens')
+    llama.add_argument('--n-batch', type=int, help='Set the prompt evaluation batch size, in tokens')
+    llama.add_argument('--n-threads', type=int, help='Set the number of generation threads')
+    llama.add_argument('--n-threads-batch', type=int, help='Set the number of prompt evaluation threads')
+    llama.add_argument('--mmap', dest='use_mmap', action=argparse.BooleanOptionalAction, default=None, help='Memory-map the model file')
+    llama.add_argument('--mlock', dest='use_mlock', action=argparse.BooleanOptionalAction, default=None, help='Lock the model in RAM')
+
+    whisper = parser.add_argument_group('speech model', 'Override the whisper settings of the configuration file and environment')
+    whisper.add_argument('--whisper-model', type=str, help='Set the Whisper model size or checkpoint path')
+    whisper.add_argument('--whisper-device', type=str, help='Set the Whisper torch device (e.g., cpu, cuda)')
+    whisper.add_argument('--whisper-threads', type=int, help='Set the number of torch threads')
 
     return parser.parse_args()
 
 
+def resolve_server_setting(args, value, env: str, key: str, default: str) -> str:
+    """Find a server setting before the application is imported, from the command line, the environment or the configuration file."""
+
+    if value:
+        return value
+    if os.getenv(env):
+        return os.environ[env]
+
+    config_file = args.config or os.getenv('APP_CONFIG')
+    if config_file:
+        try:
+            with open(config_file) as file:
+                return json.load(file).get('server', {}).get(key, default)
+        except (OSError, ValueError, AttributeError):
+            pass  # Reported when the configuration is loaded
+
+    return default
+
+
+def monkey_patch(worker: str):
+    """Patch the standard library for a green server, this must run before the application is imported.
+
+    subprocess is left unpatched: every call on an ffmpeg process (pipe reads and writes, waits) runs through
+    `run_blocking` instead, outside of the event loop.
+    """
+
+    if worker == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch(subprocess=False)
+    elif worker == 'gevent':
+        from gevent import monkey
+        monkey.patch_all(subprocess=False)
+
+
 def main():
     """Run the Flask application with Socket.IO support."""
 
@@ -46,19 +119,96 @@ def main():
     configure_logging(args.log_level, args.log_file)
     load_environment_variables()
 
-    app = create_app(headless=args.headless)
-
-    # It could be useful to put this initialisation elsewhere in order to distinguish between testing and production
-    debug_mode = os.getenv('FLASK_DEBUG', 'False') == 'True'
-    host = os.getenv('FLASK_HOST', '0.0.0.0')
-    port = int(os.getenv('FLASK_PORT', '5000'))
-    use_reloader = debug_mode
-    log_output = True
-
-    # Passed allow_unsafe_werkzeug=True to disable error : RuntimeError: The Werkzeug web server is not designed to run in production.
-    # TODO: Fix unsafe Werkzeug usage for production
-    socketio.run(app, host=host, port=port, debug=debug_mode, use_reloader=use_reloader, log_output=log_output, allow_unsafe_werkzeug=True)
+    worker = resolve_server_setting(args, args.server, 'SERVER_WORKER', 'worker', 'werkzeug')
+    if worker not in SERVER_WORKERS:
+        sys.exit(f"Invalid server worker {worker}, expected one of {', '.join(SERVER_WORKERS)}")
+    role = resolve_server_setting(args, args.role, 'SERVER_ROLE', 'role', 'all')
+    if role not in SERVER_ROLES:
+        sys.exit(f"Invalid server role {role}, expected one of {', '.join(SERVER_ROLES)}")
+
+    # An inference worker serves its connections with OS threads, it is never patched
+    if role != 'inference':
+        try:
+            monkey_patch(worker)
+        except ImportError as e:
+            sys.exit(f"The {worker} server requires the {e.name} package: pip install {worker}")
+
+    from app import create_app, socketio
+    from app.config import load_config, set_config, log_config
+    from app.lifecycle import shutdown, startup
+    from app.model_manager import models
+
+    # The models are declared with this configuration when create_app imports the socket routes, and by `startup`
+    config = load_config(args.config, overrides={
+        "llama": {
+            "model_path": args.llama_model_path,
+            "n_ctx": args.n_ctx,
+            "n_batch": args.n_batch,
+            "n_threads": args.n_threads,
+            "n_threads_batch": args.n_threads_batch,
+            "use_mmap": args.use_mmap,
+            "use_mlock": args.use_mlock,
+        },
+        "whisper": {
+            "model": args.whisper_model,
+            "device": args.whisper_device,
+            "num_threads": args.whisper_threads,
+        },
+        "server": {
+            "worker": worker,
+            "host": args.host,
+            "port": args.port,
+            "max_connections": args.max_connections,
+            "shutdown_timeout": args.shutdown_timeout,
+            "role": role,
+            "message_queue": args.message_queue,
+            "inference_endpoints": args.inference_endpoints,
+            "inference_bind": args.inference_bind,
+            "pipeline": args.pipeline,
+            "model_loading": args.model_loading,
+            "model_warmup": args.model_warmup,
+        },
+    })
+    config.validate()
+    log_config(config)
+    set_config(config)
+
+    def handle_stop_signal(signum, frame):
+        logging.info(f"Received signal {signal.Signals(signum).name}")
+        shutdown()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+
+    if role == 'inference':
+        from app.inference import serve_inference
+        try:
+            serve_inference(config)
+        finally:
+            shutdown()
+        return
+
+    app = create_app(headless=args.headless, async_mode='threading' if worker == 'werkzeug' else worker,
+                     message_queue=config.server.message_queue, metrics=config.server.metrics)
+    # The components start their workers and declare their remaining models, then the server starts while the
+    # models load, /readyz reports when they are ready
+    startup()
+    models.start(lazy=config.server.model_loading == 'lazy', warmup=config.server.model_warmup)
+
+    server = config.server
+    logging.info(f"Serving on {server.host}:{server.port} with {worker}")
+
+    try:
+        if worker == 'werkzeug':
+            # The Werkzeug server is meant for development, use --server eventlet or gevent in production
+            socketio.run(app, host=server.host, port=server.port, debug=server.debug, use_reloader=server.debug,
+                         log_output=True, allow_unsafe_werkzeug=True)
+        else:
+            socketio.run(app, host=server.host, port=server.port, debug=server.debug, use_reloader=False, log_output=True)
+    finally:
+        shutdown()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()